@@ -0,0 +1,220 @@
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import BinaryIO, Callable, Mapping, Optional, Tuple
+
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+from starlette.status import (
+    HTTP_200_OK,
+    HTTP_206_PARTIAL_CONTENT,
+    HTTP_304_NOT_MODIFIED,
+    HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+)
+
+from app.models.version import TableVersion
+
+
+# Download and Conditional Responses
+
+# Size of each chunk read and sent when zero copy sending is unavailable
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# ASGI extension letting the server send file contents with sendfile
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+
+# Parses a single byte range header into an inclusive start and end
+def parseRange(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        raise ValueError("Only single byte ranges are supported")
+    start, _, end = ranges.strip().partition("-")
+    if not start:
+        # Suffix range, the last n bytes
+        length = int(end)
+        if length <= 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start > end or start >= size:
+        return None
+    return start, min(end, size - 1)
+
+# Checks if an If-None-Match header holds the entity tag, comparing weakly
+# as conditional GETs do
+def matchesEntityTag(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = lambda tag: tag[2:] if tag.startswith("W/") else tag
+    return opaque(etag) in [opaque(tag.strip())
+        for tag in if_none_match.split(",")]
+
+# Builds validators of a response read from tables of the given version,
+# revalidated on every use since the tables can change at any time
+def buildVersionHeaders(name: str, table_version: TableVersion) -> dict:
+    headers = {
+        "etag": f'"{name}-{table_version.version:x}"',
+        "cache-control": "private, no-cache"
+    }
+    if table_version.updated_at:
+        headers["last-modified"] = formatdate(
+            table_version.updated_at.timestamp(), usegmt = True)
+    return headers
+
+# Returns 304 response if the client holds the current version of the
+# tables, otherwise adds the validators to the response being built
+def checkNotModified(request_headers: Headers, response: Response,
+        name: str, table_version: TableVersion) -> Optional[Response]:
+    headers = buildVersionHeaders(name = name, table_version = table_version)
+    if matchesEntityTag(request_headers.get("if-none-match"),
+            headers["etag"]):
+        return Response(status_code = HTTP_304_NOT_MODIFIED,
+            headers = headers)
+    response.headers.update(headers)
+    return None
+
+
+class ExportFileResponse(Response):
+    """
+    Serves a file in large chunks, or with sendfile where the server
+    supports it, honouring Range, If-Range and If-None-Match
+    """
+    def __init__(
+            self,
+            path: str,
+            request_headers: Headers,
+            media_type: str,
+            headers: Mapping[str, str] = None,
+            opener: Optional[Callable[[str], BinaryIO]] = None,
+            background: BackgroundTask = None
+            ) -> None:
+        self.path = path
+        self.opener = opener
+        self.media_type = media_type
+        self.background = background
+        self.status_code = HTTP_200_OK
+        self.range = None
+        self.init_headers(headers)
+        stat = os.stat(path)
+        # Decoded responses are a different representation of the same file
+        variant = "-decoded" if opener else ""
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}{variant}"'
+        self.headers.setdefault("etag", etag)
+        self.headers.setdefault(
+            "last-modified", formatdate(stat.st_mtime, usegmt = True))
+        # Client already holds this version of the file
+        if matchesEntityTag(request_headers.get("if-none-match"), etag):
+            self.status_code = HTTP_304_NOT_MODIFIED
+            return
+        # Files decoded on the fly have no known length to take ranges of
+        if opener:
+            self.headers["accept-ranges"] = "none"
+            return
+        size = stat.st_size
+        self.headers["accept-ranges"] = "bytes"
+        self.headers["content-length"] = str(size)
+        self.range = (0, size - 1) if size else None
+        range_header = request_headers.get("range")
+        if not range_header or not self._if_range_matches(
+                request_headers.get("if-range"), etag, stat.st_mtime):
+            return
+        try:
+            byte_range = parseRange(range_header, size)
+        except ValueError:
+            # Unsupported or malformed ranges are ignored as allowed
+            return
+        if byte_range is None:
+            self.status_code = HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            self.headers["content-range"] = f"bytes */{size}"
+            self.headers["content-length"] = "0"
+            self.range = None
+            return
+        start, end = byte_range
+        self.status_code = HTTP_206_PARTIAL_CONTENT
+        self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+        self.headers["content-length"] = str(end - start + 1)
+        self.range = byte_range
+
+    # Checks If-Range validator still matches the file being served
+    def _if_range_matches(self, if_range: Optional[str], etag: str,
+            mtime: float) -> bool:
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == etag
+        try:
+            return parsedate_to_datetime(if_range).timestamp() >= int(mtime)
+        except (TypeError, ValueError):
+            return False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send
+            ) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope.get("method") == "HEAD" or self.status_code not in (
+                HTTP_200_OK, HTTP_206_PARTIAL_CONTENT):
+            await send({"type": "http.response.body", "body": b""})
+        elif self.opener:
+            await self._send_decoded(send)
+        elif self.range is None:
+            await send({"type": "http.response.body", "body": b""})
+        elif ZEROCOPY_EXTENSION in scope.get("extensions", {}):
+            await self._send_zerocopy(send)
+        else:
+            await self._send_chunks(send)
+        if self.background is not None:
+            await self.background()
+
+    # Lets the server send the byte range straight from the file
+    async def _send_zerocopy(self, send: Send) -> None:
+        start, end = self.range
+        with open(self.path, mode = "rb") as file:
+            await send({
+                "type": ZEROCOPY_EXTENSION,
+                "file": file,
+                "offset": start,
+                "count": end - start + 1,
+                "more_body": False
+            })
+
+    # Reads the byte range in large fixed size chunks
+    async def _send_chunks(self, send: Send) -> None:
+        start, end = self.range
+        remaining = end - start + 1
+        with open(self.path, mode = "rb") as file:
+            await run_in_threadpool(file.seek, start)
+            while remaining > 0:
+                chunk = await run_in_threadpool(
+                    file.read, min(FILE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": remaining > 0
+                })
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b""})
+
+    # Streams the file through its decoder in large fixed size chunks
+    async def _send_decoded(self, send: Send) -> None:
+        with self.opener(self.path) as file:
+            while True:
+                chunk = await run_in_threadpool(file.read, FILE_CHUNK_SIZE)
+                await send({
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": bool(chunk)
+                })
+                if not chunk:
+                    break
@@ -1,21 +1,46 @@
 import os
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 
-from fastapi import APIRouter, Body, Depends, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
+from starlette.requests import Request
+from starlette.responses import Response
 from starlette.status import (
-    HTTP_201_CREATED, 
-    HTTP_404_NOT_FOUND
+    HTTP_202_ACCEPTED, 
+    HTTP_404_NOT_FOUND,
+    HTTP_410_GONE
 )
 
+from app.core.config import (
+    MAX_PAGE_SIZE, 
+    MAX_PREVIEW_SIZE, 
+    PAGE_SIZE, 
+    PREVIEW_SIZE
+)
+from app.api.responses import checkNotModified
+from app.api.services import export_job_service, export_service
+from app.db.repositories.batch import BatchExportRepository
+from app.db.repositories.cache import ExportCacheRepository
+from app.db.repositories.export import ExportRepository
 from app.db.repositories.mci import MCIRepository  
+from app.db.repositories.summary import SummaryRepository
+from app.db.repositories.version import TableVersionRepository
 from app.models.security import UserInDB
 from app.api.dependencies.database import get_repository 
 from app.api.dependencies.auth import (
     get_current_active_user,
+    check_user_admin,
     check_user_authorised
 )
-from app.models.filter import MCIFilter
+from app.models.export import ExportFormat, ExportJob
+from app.models.filter import (
+    FilterStatementStats, 
+    MCIFilter, 
+    MCIFilterBatch
+)
+from app.models.page import ChangesPage, Page
+from app.models.preview import Preview
+from app.models.summary import Summary
 
 
 # MCI API Router
@@ -23,54 +48,262 @@ from app.models.filter import MCIFilter
 router = APIRouter()
 
 
-# GET method, returns all MCI data if MCI data exists
-@router.get("/", name = "mcidata:get_all_mci_data")
+# GET method, returns a page of MCI data if MCI data exists
+@router.get("/", response_model = Page, name = "mcidata:get_all_mci_data")
 async def get_all_mci_data(
+        request: Request,
+        response: Response,
+        cursor: Optional[str] = None,
+        limit: int = Query(PAGE_SIZE, ge = 1, le = MAX_PAGE_SIZE),
+        fields: Optional[str] = None,
         mci_repo: MCIRepository = Depends(get_repository(MCIRepository)),
+        version_repo: TableVersionRepository = 
+            Depends(get_repository(TableVersionRepository)),
         current_user: UserInDB = Depends(get_current_active_user),
-        ) -> List[dict]:
+        ) -> Page:
     # Checks if authorised role
     check_user_authorised(
         current_user = current_user,
         detail = "Not authorised to retrieve data"
         )
-    # Retrieves data
-    mcidata = await mci_repo.get_all_data()
+    # Answers from the table version alone while the client's page is current
+    not_modified = checkNotModified(
+        request_headers = request.headers,
+        response = response,
+        name = "mci",
+        table_version = await version_repo.get_table_version(
+            tables = ["mci"])
+    )
+    if not_modified:
+        return not_modified
+    # Retrieves page of data following the cursor
+    page = await mci_repo.get_data_page(
+        cursor = cursor,
+        limit = limit,
+        fields = fields
+    )
     # If no data exists, returns error
-    if not mcidata:
+    if not cursor and not page.results:
         raise HTTPException(
             status_code=HTTP_404_NOT_FOUND, 
             detail="No data found for MCI."
         )
-    return mcidata
+    return page
 
 
-# POST method, will create a download based on a filter sent through
-@router.post("/", name = "mcidata:create_mci_download", 
-             status_code = HTTP_201_CREATED)
+# GET method, returns MCI data inserted or updated after a sync token, or from
+# the time given, with the token the next sync starts from
+@router.get("/changes", response_model = ChangesPage, 
+            name = "mcidata:get_mci_changes")
+async def get_mci_changes(
+        token: Optional[str] = None,
+        since: Optional[datetime] = None,
+        limit: int = Query(PAGE_SIZE, ge = 1, le = MAX_PAGE_SIZE),
+        fields: Optional[str] = None,
+        mci_repo: MCIRepository = Depends(get_repository(MCIRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> ChangesPage:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorised to retrieve data"
+        )
+    # Seeks past the token on the written rows index, so syncs read only
+    # the rows changed since the last one
+    return await mci_repo.get_data_changes(
+        token = token,
+        since = since,
+        limit = limit,
+        fields = fields
+    )
+
+# GET method, returns MCI aggregates grouped by the dimensions asked for
+@router.get("/summary", response_model = Summary, 
+            name = "mcidata:get_mci_summary")
+async def get_mci_summary(
+        group_by: List[str] = Query([]),
+        start_year: Optional[int] = None,
+        end_year: Optional[int] = None,
+        summary_repo: SummaryRepository = 
+            Depends(get_repository(SummaryRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> Summary:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorised to retrieve data"
+        )
+    # Reads aggregates from the summary tables, not the MCI table
+    results = await summary_repo.get_summary(
+        dataset = "mci",
+        group_by = group_by,
+        start_year = start_year,
+        end_year = end_year
+    )
+    return Summary(group_by = group_by, results = results)
+
+
+# POST method, returns count and first rows of the MCI data a filter matches
+@router.post("/preview", response_model = Preview, 
+             name = "mcidata:preview_mci_data")
+async def preview_mci_data(
+        filter: MCIFilter = Body(...),
+        limit: int = Query(PREVIEW_SIZE, ge = 0, le = MAX_PREVIEW_SIZE),
+        mci_repo: MCIRepository = Depends(get_repository(MCIRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> Preview:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorised to retrieve data"
+        )
+    # Estimates size of the export before it is queued
+    return await mci_repo.preview_data(filter = filter, limit = limit)
+
+
+# POST method, will queue a download based on a filter sent through
+@router.post("/", response_model = ExportJob, 
+             name = "mcidata:create_mci_download", 
+             status_code = HTTP_202_ACCEPTED)
 async def create_mci_download(
         filter: MCIFilter = Body(...),
+        format: ExportFormat = ExportFormat.csv,
         mci_repo: MCIRepository = Depends(get_repository(MCIRepository)),
+        cache_repo: ExportCacheRepository = 
+            Depends(get_repository(ExportCacheRepository)),
         current_user: UserInDB = Depends(get_current_active_user),
-        ):
+        ) -> ExportJob:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorized to create data download."
+        )
+    # Validates filter before queueing the export
+    mci_repo.build_filter_query(filter)
+    export_service.check_row_format(format = format)
+    # Reuses finished export of an equivalent filter if still current
+    cache_key = filter.cache_key(dataset = "mci", format = format)
+    cached = await cache_repo.get_cached_export(
+        dataset = "mci", 
+        cache_key = cache_key
+    )
+    if cached:
+        return await export_job_service.complete(
+            dataset = "mci", 
+            result = cached
+        )
+    # Queues data download based on filter and returns job
+    job = await export_job_service.submit(
+        dataset = "mci",
+        export = lambda: cache_repo.create_cached_export(
+            dataset = "mci",
+            cache_key = cache_key,
+            export = lambda: mci_repo.get_data_by_filter(
+                filter, 
+                owner = current_user.email,
+                format = format
+            )
+        )
+    )
+    return job
+
+
+# POST method, will queue one zip archive holding a download per filter sent
+# through, all read in a single pass over the MCI data
+@router.post("/batch", response_model = ExportJob, 
+             name = "mcidata:create_mci_batch_download", 
+             status_code = HTTP_202_ACCEPTED)
+async def create_mci_batch_download(
+        batch: MCIFilterBatch,
+        format: ExportFormat = ExportFormat.csv,
+        batch_repo: BatchExportRepository = 
+            Depends(get_repository(BatchExportRepository)),
+        cache_repo: ExportCacheRepository = 
+            Depends(get_repository(ExportCacheRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> ExportJob:
     # Checks if authorised role
     check_user_authorised(
         current_user = current_user,
         detail = "Not authorized to create data download."
         )
-    # Create data download based on filter and retrieve id
-    id = await mci_repo.get_data_by_filter(filter)
-    # Returns download id
-    payload = {
-        "download_id" : id
-    }
-    return payload
+    # Validates filters before queueing the export
+    batch_repo.build_batch_query(dataset = "mci", batch = batch)
+    export_service.check_row_format(format = format)
+    # Reuses finished archive of the same filters if still current
+    cache_key = batch.cache_key(dataset = "mci", format = format)
+    cached = await cache_repo.get_cached_export(
+        dataset = "mci", 
+        cache_key = cache_key
+    )
+    if cached:
+        return await export_job_service.complete(
+            dataset = "mci", 
+            result = cached
+        )
+    # Queues batch download and returns job
+    job = await export_job_service.submit(
+        dataset = "mci",
+        export = lambda: cache_repo.create_cached_export(
+            dataset = "mci",
+            cache_key = cache_key,
+            export = lambda: batch_repo.create_batch_download(
+                dataset = "mci",
+                batch = batch,
+                owner = current_user.email,
+                format = format
+            )
+        )
+    )
+    return job
+
+# GET method, returns status of a queued download if authorised
+@router.get("/jobs/{job_id}", response_model = ExportJob, 
+            name = "mcidata:get_mci_download_job")
+async def get_download_job(
+        job_id: str,
+        current_user: UserInDB = Depends(get_current_active_user)
+        ) -> ExportJob:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorized to retrieve downloads."
+        )
+    # Retrieves job and returns error if none exists
+    job = await export_job_service.get_job(job_id = job_id,
+        dataset = "mci")
+    if not job:
+        raise HTTPException(
+            status_code = HTTP_404_NOT_FOUND,
+            detail = "No download job of this id found"
+        )
+    return job
+
+
+# GET method, returns how filter statements are compiled and planned if admin
+@router.get("/statements", response_model = FilterStatementStats, 
+            name = "mcidata:get_mci_statement_stats")
+async def get_mci_statement_stats(
+        mci_repo: MCIRepository = Depends(get_repository(MCIRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> FilterStatementStats:
+    # Checks if admin role
+    check_user_admin(
+        current_user = current_user,
+        detail = "Not authorized to retrieve statement statistics."
+        )
+    # Reads compiler counters and the plans Postgres kept for them
+    return await mci_repo.get_filter_statement_stats()
 
 
 # GET method, will retrieve download based on id if authorised
 @router.get("/download/{download_id}", name = "mcidata:retrieve_mci_download")
 async def get_download_by_id(
         download_id: int,
+        request: Request,
+        format: Optional[ExportFormat] = None,
+        export_repo: ExportRepository = 
+            Depends(get_repository(ExportRepository)),
         current_user: UserInDB = Depends(get_current_active_user)
         ):
     # Checks if authorised role
@@ -78,19 +311,35 @@ async def get_download_by_id(
         current_user = current_user,
         detail = "Not authorized to retrieve downloads."
         )
-    # Retrieves download file from filepath
-    path = "./mci_download/" + f"file_{download_id}.csv"
-    if not os.path.exists(path):
+    # Looks up download file in the export registry
+    export = await export_repo.get_export(
+        id = download_id, 
+        dataset = "mci"
+    )
+    # Evicted files are gone for good, the export has to be requested again
+    if export and export.status == "evicted":
+        raise HTTPException(
+            status_code = HTTP_410_GONE,
+            detail = "This download was removed to free disk space, "
+                "please request the export again"
+        )
+    if (not export or export.status != "done" 
+            or not os.path.exists(export.path)):
         raise HTTPException(
             status_code = HTTP_404_NOT_FOUND,
             detail = "No download of this id found"
         )
-    # Returns download file in csv format
-    def datafile():
-        with open(path, mode = "rb") as file:
-            yield from file
-    response = StreamingResponse(datafile(), media_type = "text/csv")
-    response.headers["Content-Disposition"] = "attachment; filename=export.csv"
-    return response
+    if format and format != export.format:
+        raise HTTPException(
+            status_code = HTTP_404_NOT_FOUND,
+            detail = f"No {format.value} download of this id found"
+        )
+    # Records the download so retention keeps the file longer
+    await export_repo.touch_export(id = export.id)
+    # Returns download file in the format it was exported in
+    return export_service.download_response(
+        export = export,
+        request_headers = request.headers
+    )
 
         
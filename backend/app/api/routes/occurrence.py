@@ -1,22 +1,68 @@
 import os
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 
-from fastapi import APIRouter, Body, Depends, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import (
+    APIRouter, 
+    Body, 
+    Depends, 
+    File, 
+    HTTPException, 
+    Query, 
+    UploadFile
+)
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
 from starlette.status import (
-    HTTP_201_CREATED, 
+    HTTP_202_ACCEPTED, 
     HTTP_404_NOT_FOUND,
+    HTTP_410_GONE,
     HTTP_422_UNPROCESSABLE_ENTITY
 )
 
+from app.core.config import (
+    GRID_CELL_SIZE, 
+    MAX_PAGE_SIZE, 
+    MAX_PREVIEW_SIZE, 
+    MIN_GRID_CELL_SIZE, 
+    PAGE_SIZE, 
+    PREVIEW_SIZE
+)
+from app.api.responses import checkNotModified
+from app.api.services import export_job_service, export_service
+from app.db.repositories.batch import BatchExportRepository
+from app.db.repositories.cache import ExportCacheRepository
+from app.db.repositories.export import ExportRepository
+from app.db.repositories.grid import GridRepository
+from app.db.repositories.ingest import (
+    IngestRepository, 
+    getIngestFormat, 
+    saveIngestUpload
+)
 from app.db.repositories.occurrence import OccurrenceRepository  
+from app.db.repositories.summary import SummaryRepository
+from app.db.repositories.version import TableVersionRepository
+from app.db.repositories.tile import TileRepository
 from app.models.security import UserInDB
 from app.api.dependencies.database import get_repository 
 from app.api.dependencies.auth import (
     get_current_active_user,
+    check_user_admin,
     check_user_authorised
 )
-from app.models.filter import Filter
+from app.models.export import ExportFormat, ExportJob
+from app.models.filter import (
+    Filter, 
+    FilterBatch, 
+    FilterStatementStats, 
+    TaxonomyMatch
+)
+from app.models.grid import Grid, GridShape
+from app.models.ingest import IngestJob
+from app.models.page import ChangesPage, Page
+from app.models.preview import Preview
+from app.models.summary import Summary
 
 
 # Occurrence API Router 
@@ -24,56 +70,402 @@ from app.models.filter import Filter
 router = APIRouter()
 
 
-# GET method, returns all occurrence data if authorised and data exists
-@router.get("/", name = "occurrence:get_all_occurrences")
+# GET method, returns a page of occurrence data if authorised and data exists
+@router.get("/", response_model = Page, 
+            name = "occurrence:get_all_occurrences")
 async def get_all_occurrences(
+        request: Request,
+        response: Response,
+        cursor: Optional[str] = None,
+        limit: int = Query(PAGE_SIZE, ge = 1, le = MAX_PAGE_SIZE),
+        fields: Optional[str] = None,
         occurrence_repo: OccurrenceRepository = 
             Depends(get_repository(OccurrenceRepository)),
+        version_repo: TableVersionRepository = 
+            Depends(get_repository(TableVersionRepository)),
         current_user: UserInDB = Depends(get_current_active_user),
-        ) -> List[dict]:
+        ) -> Page:
     # Checks if authorised role
     check_user_authorised(
         current_user = current_user,
         detail = "Not authorised to retrieve data"
         )
-    # Retrieves data
-    occurrences = await occurrence_repo.get_all_occurrences()
+    # Answers from the table version alone while the client's page is current
+    not_modified = checkNotModified(
+        request_headers = request.headers,
+        response = response,
+        name = "occurrence",
+        table_version = await version_repo.get_table_version(
+            tables = ["occurrence"])
+    )
+    if not_modified:
+        return not_modified
+    # Retrieves page of data following the cursor
+    page = await occurrence_repo.get_occurrences_page(
+        cursor = cursor,
+        limit = limit,
+        fields = fields
+    )
     # If no data exists, returns error
-    if not occurrences:
+    if not cursor and not page.results:
         raise HTTPException(
             status_code = HTTP_404_NOT_FOUND, 
             detail = "No data found in occurrences."
         )
-    return occurrences
+    return page
+
+
+# GET method, returns occurrences inserted or updated after a sync token, or
+# from the time given, with the token the next sync starts from
+@router.get("/changes", response_model = ChangesPage, 
+            name = "occurrence:get_occurrence_changes")
+async def get_occurrence_changes(
+        token: Optional[str] = None,
+        since: Optional[datetime] = None,
+        limit: int = Query(PAGE_SIZE, ge = 1, le = MAX_PAGE_SIZE),
+        fields: Optional[str] = None,
+        occurrence_repo: OccurrenceRepository = 
+            Depends(get_repository(OccurrenceRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> ChangesPage:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorised to retrieve data"
+        )
+    # Seeks past the token on the written rows index, so syncs read only
+    # the rows changed since the last one
+    return await occurrence_repo.get_occurrence_changes(
+        token = token,
+        since = since,
+        limit = limit,
+        fields = fields
+    )
+
+# GET method, returns occurrence aggregates grouped by the dimensions asked for
+@router.get("/summary", response_model = Summary, 
+            name = "occurrence:get_occurrence_summary")
+async def get_occurrence_summary(
+        group_by: List[str] = Query([]),
+        start_year: Optional[int] = None,
+        end_year: Optional[int] = None,
+        summary_repo: SummaryRepository = 
+            Depends(get_repository(SummaryRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> Summary:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorised to retrieve data"
+        )
+    # Reads aggregates from the summary tables, not the occurrence table
+    results = await summary_repo.get_summary(
+        dataset = "occurrence",
+        group_by = group_by,
+        start_year = start_year,
+        end_year = end_year
+    )
+    return Summary(group_by = group_by, results = results)
+
+
+# POST method, returns count and first rows of the occurrences a filter matches
+@router.post("/preview", response_model = Preview, 
+             name = "occurrence:preview_occurrences")
+async def preview_occurrences(
+        filter: Filter,
+        limit: int = Query(PREVIEW_SIZE, ge = 0, le = MAX_PREVIEW_SIZE),
+        occurrence_repo: OccurrenceRepository = 
+            Depends(get_repository(OccurrenceRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> Preview:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorised to retrieve data"
+        )
+    # Estimates size of the export before it is queued
+    return await occurrence_repo.preview_occurrences(
+        filter = filter, 
+        limit = limit
+    )
+
+
+# GET method, returns vector tile of the occurrences a filter matches
+@router.get("/tiles/{z}/{x}/{y}.mvt", 
+            name = "occurrence:get_occurrence_tile")
+async def get_occurrence_tile(
+        z: int,
+        x: int,
+        y: int,
+        classification_level: str = "",
+        classification_name: str = "",
+        classification_match: TaxonomyMatch = TaxonomyMatch.prefix,
+        year: int = 0,
+        startDate: str = "",
+        endDate: str = "",
+        location_name: str = "",
+        location_type: str = "",
+        geometry: Optional[str] = None,
+        tile_repo: TileRepository = Depends(get_repository(TileRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> Response:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorised to retrieve data"
+        )
+    # Filter fields are sent as query parameters so tile urls can be cached
+    filter = Filter(
+        classification_level = classification_level,
+        classification_name = classification_name,
+        classification_match = classification_match,
+        year = year,
+        startDate = startDate,
+        endDate = endDate,
+        location_name = location_name,
+        location_type = location_type,
+        geometry = geometry
+    )
+    tile = await tile_repo.get_occurrence_tile(
+        filter = filter,
+        z = z,
+        x = x,
+        y = y
+    )
+    return Response(
+        content = tile, 
+        media_type = "application/vnd.mapbox-vector-tile"
+    )
+
+
+# POST method, returns occurrence and species counts per grid cell of the
+# occurrences a filter matches
+@router.post("/grid", response_model = Grid, 
+             name = "occurrence:get_occurrence_grid")
+async def get_occurrence_grid(
+        filter: Filter,
+        cell_size: float = Query(GRID_CELL_SIZE, ge = MIN_GRID_CELL_SIZE),
+        shape: GridShape = GridShape.hexagon,
+        grid_repo: GridRepository = Depends(get_repository(GridRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> Grid:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorised to retrieve data"
+        )
+    # Counts are aggregated in the database, never sent as rows
+    return await grid_repo.get_occurrence_grid(
+        filter = filter,
+        cell_size = cell_size,
+        shape = shape
+    )
 
 
-# POST method, will create download based on filter sent through
-@router.post("/", name = "occurrence:create_occurrence_download", 
-             status_code = HTTP_201_CREATED)
+# POST method, will queue a download based on filter sent through
+@router.post("/", response_model = ExportJob, 
+             name = "occurrence:create_occurrence_download", 
+             status_code = HTTP_202_ACCEPTED)
 async def create_occurrence_download(
         filter: Filter,
+        format: ExportFormat = ExportFormat.csv,
         occurrence_repo: OccurrenceRepository = 
             Depends(get_repository(OccurrenceRepository)),
+        cache_repo: ExportCacheRepository = 
+            Depends(get_repository(ExportCacheRepository)),
         current_user: UserInDB = Depends(get_current_active_user),
-        ):
+        ) -> ExportJob:
     # Checks if authorised role
     check_user_authorised(
         current_user = current_user,
         detail = "Not authorized to create data download."
         )
-    # Create data download based on filter and retrieve id
-    id = await occurrence_repo.create_filtered_download(filter = filter)
-    # Returns download id
-    payload = {
-        "download_id" : id
-    }
-    return payload
+    # Validates filter before queueing the export
+    occurrence_repo.build_filter_query(filter = filter)
+    export_service.check_row_format(format = format)
+    # Reuses finished export of an equivalent filter if still current
+    cache_key = filter.cache_key(dataset = "occurrence", format = format)
+    cached = await cache_repo.get_cached_export(
+        dataset = "occurrence", 
+        cache_key = cache_key
+    )
+    if cached:
+        return await export_job_service.complete(
+            dataset = "occurrence", 
+            result = cached
+        )
+    # Queues data download based on filter and returns job
+    job = await export_job_service.submit(
+        dataset = "occurrence",
+        export = lambda: cache_repo.create_cached_export(
+            dataset = "occurrence",
+            cache_key = cache_key,
+            export = lambda: occurrence_repo.create_filtered_download(
+                filter = filter,
+                owner = current_user.email,
+                format = format
+            )
+        )
+    )
+    return job
+
+
+# POST method, will queue one zip archive holding a download per filter sent
+# through, all read in a single pass over the occurrences
+@router.post("/batch", response_model = ExportJob, 
+             name = "occurrence:create_batch_download", 
+             status_code = HTTP_202_ACCEPTED)
+async def create_batch_download(
+        batch: FilterBatch,
+        format: ExportFormat = ExportFormat.csv,
+        batch_repo: BatchExportRepository = 
+            Depends(get_repository(BatchExportRepository)),
+        cache_repo: ExportCacheRepository = 
+            Depends(get_repository(ExportCacheRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> ExportJob:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorized to create data download."
+        )
+    # Validates filters before queueing the export
+    batch_repo.build_batch_query(dataset = "occurrence", batch = batch)
+    export_service.check_row_format(format = format)
+    # Reuses finished archive of the same filters if still current
+    cache_key = batch.cache_key(dataset = "occurrence", format = format)
+    cached = await cache_repo.get_cached_export(
+        dataset = "occurrence", 
+        cache_key = cache_key
+    )
+    if cached:
+        return await export_job_service.complete(
+            dataset = "occurrence", 
+            result = cached
+        )
+    # Queues batch download and returns job
+    job = await export_job_service.submit(
+        dataset = "occurrence",
+        export = lambda: cache_repo.create_cached_export(
+            dataset = "occurrence",
+            cache_key = cache_key,
+            export = lambda: batch_repo.create_batch_download(
+                dataset = "occurrence",
+                batch = batch,
+                owner = current_user.email,
+                format = format
+            )
+        )
+    )
+    return job
+
+# POST method, queues a bulk load of occurrences from a csv or Darwin Core
+# file if admin
+@router.post("/ingest", response_model = IngestJob, 
+             name = "occurrence:ingest_occurrences",
+             status_code = HTTP_202_ACCEPTED)
+async def ingest_occurrences(
+        file: UploadFile = File(...),
+        assign_locations: bool = True,
+        ingest_repo: IngestRepository = 
+            Depends(get_repository(IngestRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> IngestJob:
+    # Checks if admin role
+    check_user_admin(
+        current_user = current_user,
+        detail = "Not authorized to load data."
+        )
+    # Keeps the upload past the request, the load runs after it returns
+    delimiter, compression = getIngestFormat(filename = file.filename)
+    path = await run_in_threadpool(saveIngestUpload, file.file)
+    # Queues the load, which reports rows loaded and rejected once done
+    try:
+        return await export_job_service.submit_ingest(
+            dataset = "occurrence",
+            ingest = lambda: ingest_repo.ingest_occurrence_file(
+                path = path,
+                delimiter = delimiter,
+                compression = compression,
+                assign_locations = assign_locations
+            )
+        )
+    except HTTPException:
+        await run_in_threadpool(os.remove, path)
+        raise
+
+
+# GET method, returns status and outcome of a queued bulk load if admin
+@router.get("/ingest/{job_id}", response_model = IngestJob, 
+            name = "occurrence:get_ingest_job")
+async def get_ingest_job(
+        job_id: str,
+        current_user: UserInDB = Depends(get_current_active_user)
+        ) -> IngestJob:
+    # Checks if admin role
+    check_user_admin(
+        current_user = current_user,
+        detail = "Not authorized to load data."
+        )
+    # Retrieves job and returns error if none exists
+    job = await export_job_service.get_ingest_job(job_id = job_id,
+        dataset = "occurrence")
+    if not job:
+        raise HTTPException(
+            status_code = HTTP_404_NOT_FOUND,
+            detail = "No ingest job of this id found"
+        )
+    return job
+
+
+# GET method, returns status of a queued download if authorised
+@router.get("/jobs/{job_id}", response_model = ExportJob, 
+            name = "occurrence:get_download_job")
+async def get_download_job(
+        job_id: str,
+        current_user: UserInDB = Depends(get_current_active_user)
+        ) -> ExportJob:
+    # Checks if authorised role
+    check_user_authorised(
+        current_user = current_user,
+        detail = "Not authorized to retrieve downloads."
+        )
+    # Retrieves job and returns error if none exists
+    job = await export_job_service.get_job(job_id = job_id,
+        dataset = "occurrence")
+    if not job:
+        raise HTTPException(
+            status_code = HTTP_404_NOT_FOUND,
+            detail = "No download job of this id found"
+        )
+    return job
+
+
+# GET method, returns how filter statements are compiled and planned if admin
+@router.get("/statements", response_model = FilterStatementStats, 
+            name = "occurrence:get_filter_statement_stats")
+async def get_filter_statement_stats(
+        occurrence_repo: OccurrenceRepository = 
+            Depends(get_repository(OccurrenceRepository)),
+        current_user: UserInDB = Depends(get_current_active_user),
+        ) -> FilterStatementStats:
+    # Checks if admin role
+    check_user_admin(
+        current_user = current_user,
+        detail = "Not authorized to retrieve statement statistics."
+        )
+    # Reads compiler counters and the plans Postgres kept for them
+    return await occurrence_repo.get_filter_statement_stats()
 
 
 # GET method, will retrieve downlaod based on id if authorised
 @router.get("/download/{download_id}", name = "occurrence:retrieve_download")
 async def get_download_by_id(
         download_id: int,
+        request: Request,
+        format: Optional[ExportFormat] = None,
+        export_repo: ExportRepository = 
+            Depends(get_repository(ExportRepository)),
         current_user: UserInDB = Depends(get_current_active_user)
         ):
     # Checks if authorised role
@@ -81,19 +473,35 @@ async def get_download_by_id(
         current_user = current_user,
         detail = "Not authorized to retrieve downloads."
         )
-    # Retrieves download file from filepath
-    path = "./occurrence_download/" + f"file_{download_id}.csv"
-    if not os.path.exists(path):
+    # Looks up download file in the export registry
+    export = await export_repo.get_export(
+        id = download_id, 
+        dataset = "occurrence"
+    )
+    # Evicted files are gone for good, the export has to be requested again
+    if export and export.status == "evicted":
+        raise HTTPException(
+            status_code = HTTP_410_GONE,
+            detail = "This download was removed to free disk space, "
+                "please request the export again"
+        )
+    if (not export or export.status != "done" 
+            or not os.path.exists(export.path)):
         raise HTTPException(
             status_code = HTTP_404_NOT_FOUND,
             detail = "No download of this id found"
         )
-    # Returns download file in csv format
-    def datafile():
-        with open(path, mode = "rb") as file:
-            yield from file
-    response = StreamingResponse(datafile(), media_type = "text/csv")
-    response.headers["Content-Disposition"] = "attachment; filename=export.csv"
-    return response
+    if format and format != export.format:
+        raise HTTPException(
+            status_code = HTTP_404_NOT_FOUND,
+            detail = f"No {format.value} download of this id found"
+        )
+    # Records the download so retention keeps the file longer
+    await export_repo.touch_export(id = export.id)
+    # Returns download file in the format it was exported in
+    return export_service.download_response(
+        export = export,
+        request_headers = request.headers
+    )
 
         
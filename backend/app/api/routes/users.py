@@ -3,6 +3,8 @@ from typing import List
 from fastapi import APIRouter
 from fastapi import Depends, HTTPException, Body
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.requests import Request
+from starlette.responses import Response
 from starlette.status import (
     HTTP_201_CREATED, 
     HTTP_401_UNAUTHORIZED, 
@@ -10,6 +12,7 @@ from starlette.status import (
     HTTP_503_SERVICE_UNAVAILABLE
 )
 
+from app.api.responses import checkNotModified
 from app.api.services import auth_service, email_service
 from app.core.config import PASSWORD_URL
 from app.models.security import (
@@ -30,6 +33,7 @@ from app.api.dependencies.auth import (
     check_user_admin
 )
 from app.db.repositories.users import UserRepository
+from app.db.repositories.version import TableVersionRepository
 
 
 
@@ -116,7 +120,11 @@ async def update_role_of_user(
 # GET method, returns all users
 @router.get("/", name = "users:get_all_users")
 async def get_all_users(
+        request: Request,
+        response: Response,
         user_repo: UserRepository = Depends(get_repository(UserRepository)),
+        version_repo: TableVersionRepository = 
+            Depends(get_repository(TableVersionRepository)),
         current_user: UserInDB = Depends(get_current_active_user),
         ) -> List[dict]:
     # Checks if authorised to retrieve users
@@ -124,6 +132,16 @@ async def get_all_users(
         current_user = current_user, 
         detail = "Not authorized to retrieve users"
     )
+    # Answers from the table version alone while the client's list is current
+    not_modified = checkNotModified(
+        request_headers = request.headers,
+        response = response,
+        name = "users",
+        table_version = await version_repo.get_table_version(
+            tables = ["users"])
+    )
+    if not_modified:
+        return not_modified
     # Gets all users
     users = await user_repo.get_all_users()
     # If no users found, returns exception
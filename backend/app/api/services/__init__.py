@@ -1,5 +1,9 @@
 from app.api.services.authentication import AuthService
 from app.api.services.email import EmailService
+from app.api.services.export import ExportService
+from app.api.services.jobs import ExportJobService
 
 auth_service = AuthService()
-email_service = EmailService()
\ No newline at end of file
+email_service = EmailService()
+export_service = ExportService()
+export_job_service = ExportJobService()
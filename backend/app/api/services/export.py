@@ -0,0 +1,299 @@
+import csv
+import gzip
+import io
+import json
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from typing import AsyncIterator, BinaryIO, List, Mapping, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY
+
+from app.api.responses import ExportFileResponse
+from app.core.config import EXPORT_COMPRESSION
+from app.models.export import ExportEncoding, ExportFormat, ExportRecord
+
+
+# Export Service Class
+
+# File extension and media type of each export format
+EXPORT_FORMATS = {
+    ExportFormat.csv: {
+        "extension": "csv",
+        "media_type": "text/csv"
+    },
+    ExportFormat.parquet: {
+        "extension": "parquet",
+        "media_type": "application/vnd.apache.parquet"
+    },
+    ExportFormat.geojson: {
+        "extension": "geojson",
+        "media_type": "application/geo+json"
+    },
+    ExportFormat.ndjson: {
+        "extension": "ndjson",
+        "media_type": "application/x-ndjson"
+    },
+    ExportFormat.zip: {
+        "extension": "zip",
+        "media_type": "application/zip"
+    }
+}
+
+# Columns the point geometry of a GeoJSON feature is built from
+LATITUDE_COLUMN = "occurrence_latitude"
+LONGITUDE_COLUMN = "occurrence_longitude"
+
+GEOJSON_HEADER = '{"type": "FeatureCollection", "features": [\n'
+GEOJSON_FOOTER = "\n]}\n"
+
+# File extension of each compression applied to stored exports
+EXPORT_ENCODINGS = {
+    ExportEncoding.gzip: {
+        "extension": "gz"
+    },
+    ExportEncoding.zstd: {
+        "extension": "zst"
+    }
+}
+
+# Builds an arrow table with typed columns from a batch of records
+def buildArrowTable(schema: pa.Schema, batch: List[Mapping]) -> pa.Table:
+    arrays = []
+    for field in schema:
+        values = [record[field.name] for record in batch]
+        if pa.types.is_dictionary(field.type):
+            array = pa.array(values, type = field.type.value_type)
+            arrays.append(array.dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type = field.type))
+    return pa.Table.from_arrays(arrays, schema = schema)
+
+# Converts values json cannot encode by itself
+def encodeJsonValue(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+# Serialises a batch of records as one json object per line
+def buildJsonLines(columns: List[str], batch: List[Mapping]) -> str:
+    return "".join(json.dumps({column: record[column] for column in columns},
+        default = encodeJsonValue) + "\n" for record in batch)
+
+# Serialises a batch of records as GeoJSON point features, one per line
+def buildGeoJsonFeatures(columns: List[str], batch: List[Mapping]) -> str:
+    properties = [column for column in columns
+        if column not in ("id", LATITUDE_COLUMN, LONGITUDE_COLUMN)]
+    features = []
+    for record in batch:
+        latitude = record[LATITUDE_COLUMN]
+        longitude = record[LONGITUDE_COLUMN]
+        # Rows without coordinates are kept with a null geometry
+        geometry = None
+        if latitude is not None and longitude is not None:
+            geometry = {
+                "type": "Point",
+                "coordinates": [float(longitude), float(latitude)]
+            }
+        features.append(json.dumps({
+            "type": "Feature",
+            "id": record["id"],
+            "geometry": geometry,
+            "properties": {column: record[column] for column in properties}
+        }, default = encodeJsonValue))
+    return ",\n".join(features)
+
+# Opens stored export for binary writing, compressing if encoded
+def openEncodedWriter(path: str, encoding: Optional[ExportEncoding]
+        ) -> BinaryIO:
+    if encoding == ExportEncoding.gzip:
+        return gzip.open(path, mode = "wb")
+    if encoding == ExportEncoding.zstd:
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+    return open(path, mode = "wb")
+
+# Opens stored export for binary reading, decompressing if encoded
+def openEncodedReader(path: str, encoding: Optional[ExportEncoding]
+        ) -> BinaryIO:
+    if encoding == ExportEncoding.gzip:
+        return gzip.open(path, mode = "rb")
+    if encoding == ExportEncoding.zstd:
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, mode = "rb")
+
+# Writes zip archive of the files given under their archive names, with a
+# manifest describing them
+def writeZipArchive(path: str, members: List[Tuple[str, str]],
+        manifest: str, compress: bool) -> None:
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(path, mode = "w", compression = compression) as file:
+        for member_path, name in members:
+            file.write(member_path, arcname = name)
+        file.writestr("manifest.json", manifest)
+
+# Checks if an Accept-Encoding header allows the given encoding. Every entry
+# is read, as an entry naming the encoding overrides a * one and any q=0
+# of either refuses it.
+def acceptsEncoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    qualities = {encoding: [], "*": []}
+    for part in (accept_encoding or "").split(","):
+        name, *params = part.split(";")
+        name = name.strip().lower()
+        if name not in qualities:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name].append(quality)
+    matched = qualities[encoding] or qualities["*"]
+    return bool(matched) and min(matched) > 0
+
+
+class ExportService:
+    # Returns compression used to store exports of the given format
+    def get_encoding(self, format: ExportFormat) -> Optional[ExportEncoding]:
+        # Parquet and zip archives compress their own contents
+        if (format in (ExportFormat.parquet, ExportFormat.zip)
+                or EXPORT_COMPRESSION == "none"):
+            return None
+        return ExportEncoding(EXPORT_COMPRESSION)
+
+    # Checks rows can be written in the given format, zip archives are only
+    # built from the files of batch exports
+    def check_row_format(self, format: ExportFormat) -> None:
+        if format == ExportFormat.zip:
+            raise HTTPException(
+                status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+                detail = "Zip archives are only built by batch exports"
+            )
+
+    # Returns file extension of an export, including its compression
+    def get_extension(self, format: ExportFormat,
+            encoding: Optional[ExportEncoding]) -> str:
+        extension = EXPORT_FORMATS[format]["extension"]
+        if encoding:
+            extension += "." + EXPORT_ENCODINGS[encoding]["extension"]
+        return extension
+
+    # Writes batches of records in the given format, returns row count
+    async def write(self, format: ExportFormat, path: str, schema: pa.Schema,
+            batches: AsyncIterator[List[Mapping]],
+            encoding: Optional[ExportEncoding] = None) -> int:
+        if format == ExportFormat.parquet:
+            return await self.write_parquet(path, schema, batches)
+        if format == ExportFormat.geojson:
+            return await self.write_geojson(path, schema.names, batches,
+                encoding)
+        if format == ExportFormat.ndjson:
+            return await self.write_ndjson(path, schema.names, batches,
+                encoding)
+        return await self.write_csv(path, schema.names, batches, encoding)
+
+    # Writes batches of records to a csv file as they arrive, returns row count
+    async def write_csv(self, path: str, columns: List[str],
+            batches: AsyncIterator[List[Mapping]],
+            encoding: Optional[ExportEncoding] = None) -> int:
+        row_count = 0
+        with io.TextIOWrapper(openEncodedWriter(path, encoding),
+                encoding = "utf-8", newline = "") as file:
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            async for batch in batches:
+                rows = [[record[column] for column in columns]
+                    for record in batch]
+                await run_in_threadpool(writer.writerows, rows)
+                row_count += len(rows)
+        return row_count
+
+    # Writes batches of records as a GeoJSON feature collection as they
+    # arrive, returns row count
+    async def write_geojson(self, path: str, columns: List[str],
+            batches: AsyncIterator[List[Mapping]],
+            encoding: Optional[ExportEncoding] = None) -> int:
+        row_count = 0
+        with io.TextIOWrapper(openEncodedWriter(path, encoding),
+                encoding = "utf-8") as file:
+            file.write(GEOJSON_HEADER)
+            async for batch in batches:
+                features = await run_in_threadpool(buildGeoJsonFeatures,
+                    columns, batch)
+                # Features of earlier batches need a separator first
+                if row_count:
+                    features = ",\n" + features
+                await run_in_threadpool(file.write, features)
+                row_count += len(batch)
+            file.write(GEOJSON_FOOTER)
+        return row_count
+
+    # Writes batches of records as newline delimited json, returns row count
+    async def write_ndjson(self, path: str, columns: List[str],
+            batches: AsyncIterator[List[Mapping]],
+            encoding: Optional[ExportEncoding] = None) -> int:
+        row_count = 0
+        with io.TextIOWrapper(openEncodedWriter(path, encoding),
+                encoding = "utf-8") as file:
+            async for batch in batches:
+                lines = await run_in_threadpool(buildJsonLines, columns, batch)
+                await run_in_threadpool(file.write, lines)
+                row_count += len(batch)
+        return row_count
+
+    # Writes each batch of records as a parquet row group, returns row count
+    async def write_parquet(self, path: str, schema: pa.Schema,
+            batches: AsyncIterator[List[Mapping]]) -> int:
+        row_count = 0
+        writer = pq.ParquetWriter(path, schema, compression = "zstd")
+        try:
+            async for batch in batches:
+                table = await run_in_threadpool(buildArrowTable, schema, batch)
+                await run_in_threadpool(writer.write_table, table)
+                row_count += table.num_rows
+        finally:
+            writer.close()
+        return row_count
+
+    # Packs files written by a batch export into one zip archive, parquet
+    # files are stored as they are since they are already compressed
+    async def write_zip(self, path: str, members: List[Tuple[str, str]],
+            manifest: str, format: ExportFormat) -> None:
+        await run_in_threadpool(writeZipArchive, path, members, manifest,
+            format != ExportFormat.parquet)
+
+    # Returns response serving an export, compressed only when stored so
+    def download_response(self, export: ExportRecord,
+            request_headers: Headers) -> ExportFileResponse:
+        export_format = EXPORT_FORMATS[export.format]
+        headers = {
+            "Content-Disposition":
+                f"attachment; filename=export.{export_format['extension']}"
+        }
+        opener = None
+        if export.encoding:
+            headers["Vary"] = "Accept-Encoding"
+            # Stored bytes are sent as they are when the client can decode
+            # them, otherwise they are decompressed on the fly
+            if acceptsEncoding(request_headers.get("accept-encoding"),
+                    export.encoding.value):
+                headers["Content-Encoding"] = export.encoding.value
+            else:
+                opener = lambda path: openEncodedReader(path, export.encoding)
+        return ExportFileResponse(
+            path = export.path,
+            request_headers = request_headers,
+            media_type = export_format["media_type"],
+            headers = headers,
+            opener = opener
+        )
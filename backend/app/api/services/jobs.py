@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+from databases import Database
+from fastapi import HTTPException
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+
+from app.core.config import EXPORT_WORKERS, EXPORT_QUEUE_SIZE
+from app.db.repositories.jobs import ExportJobRepository
+from app.models.export import ExportJob, ExportJobStatus, ExportResult
+from app.models.ingest import IngestJob, IngestResult
+
+logger = logging.getLogger(__name__)
+
+
+# Export Job Service Class
+
+# Bulk loads share the export workers, so they queue behind exports rather
+# than running beside them
+
+class ExportJobService:
+    def __init__(self, workers: int = EXPORT_WORKERS,
+            queue_size: int = EXPORT_QUEUE_SIZE) -> None:
+        self.workers = workers
+        self.queue_size = queue_size
+        # Unfinished jobs of this process, their status is read back from
+        # the job table so every process can report it
+        self.jobs: Dict[str, Union[ExportJob, IngestJob]] = {}
+        self.job_repo: Optional[ExportJobRepository] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    # Starts the bounded pool of export workers
+    async def start(self, database: Database) -> None:
+        self.job_repo = ExportJobRepository(database)
+        self._queue = asyncio.Queue(maxsize = self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker())
+            for _ in range(self.workers)]
+
+    # Stops the export workers, unfinished jobs are marked as failed
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions = True)
+        self._tasks = []
+        for job in list(self.jobs.values()):
+            job.status = ExportJobStatus.failed
+            job.error = "Job was interrupted by a server shutdown"
+            await self._record(job)
+        self.jobs = {}
+
+    # Queues an export and returns its job straight away
+    async def submit(self, dataset: str,
+            export: Callable[[], Awaitable[ExportResult]]) -> ExportJob:
+        job = ExportJob(job_id = uuid.uuid4().hex, dataset = dataset)
+        await self._enqueue(job = job, run = export)
+        return job
+
+    # Queues a bulk load and returns its job straight away
+    async def submit_ingest(self, dataset: str,
+            ingest: Callable[[], Awaitable[IngestResult]]) -> IngestJob:
+        job = IngestJob(job_id = uuid.uuid4().hex, dataset = dataset)
+        await self._enqueue(job = job, run = ingest)
+        return job
+
+    # Returns an already finished job for an export that was reused
+    async def complete(self, dataset: str, result: ExportResult
+            ) -> ExportJob:
+        job = ExportJob(
+            job_id = uuid.uuid4().hex,
+            dataset = dataset,
+            status = ExportJobStatus.done,
+            **result.dict()
+        )
+        await self.job_repo.create_job(job = job)
+        return job
+
+    # Returns job of the given id and dataset if it exists
+    async def get_job(self, job_id: str, dataset: str
+            ) -> Optional[ExportJob]:
+        return await self.job_repo.get_job(job_id = job_id, dataset = dataset)
+
+    # Returns ingest job of the given id and dataset if it exists
+    async def get_ingest_job(self, job_id: str, dataset: str
+            ) -> Optional[IngestJob]:
+        return await self.job_repo.get_ingest_job(job_id = job_id,
+            dataset = dataset)
+
+    # Records a job and hands it to the workers
+    async def _enqueue(self, job: Union[ExportJob, IngestJob],
+            run: Callable[[], Awaitable]) -> None:
+        # Recorded before a worker can take it, so updates find it
+        await self.job_repo.create_job(job = job)
+        try:
+            self._queue.put_nowait((job, run))
+        except asyncio.QueueFull:
+            job.status = ExportJobStatus.failed
+            job.error = "Too many jobs queued"
+            await self._record(job)
+            raise HTTPException(
+                status_code = HTTP_503_SERVICE_UNAVAILABLE,
+                detail = "Too many jobs queued, please try again later."
+            )
+        self.jobs[job.job_id] = job
+
+    # Records job status, a failure to do so leaves the job to expire
+    async def _record(self, job: ExportJob) -> None:
+        try:
+            await self.job_repo.update_job(job = job)
+        except Exception as e:
+            logger.warning(f"Job {job.job_id} not recorded: {e}")
+
+    # Runs queued jobs one at a time
+    async def _worker(self) -> None:
+        while True:
+            job, run = await self._queue.get()
+            try:
+                job.status = ExportJobStatus.running
+                await self.job_repo.update_job(job = job)
+                result = await run()
+                if isinstance(job, IngestJob):
+                    job.result = result
+                else:
+                    job.download_id = result.download_id
+                    job.row_count = result.row_count
+                    job.file_size = result.file_size
+                job.status = ExportJobStatus.done
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Job {job.job_id} failed: {e}")
+                job.error = str(getattr(e, "detail", "Job failed"))
+                job.status = ExportJobStatus.failed
+            finally:
+                self._queue.task_done()
+            await self._record(job)
+            self.jobs.pop(job.job_id, None)
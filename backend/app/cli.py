@@ -0,0 +1,191 @@
+import argparse
+import asyncio
+import os
+
+from databases import Database
+
+from app.core.config import (
+    DATABASE_URL, 
+    INGEST_BATCH_SIZE,
+    LOCATION_BATCH_SIZE, 
+    LOCATION_LOAD_BATCH_SIZE,
+    TEST_DATABASE_URL
+)
+from app.db.repositories.ingest import IngestRepository, getIngestFormat
+from app.db.repositories.location import LOCATION_DATASETS, LocationRepository
+from app.db.repositories.summary import SUMMARY_DATASETS, SummaryRepository
+from app.db.schema import (
+    apply_table_migrations,
+    create_app_schema,
+    create_table_indexes
+)
+
+
+# Command Line Maintenance Tasks
+
+# Run from the backend directory, e.g.
+#     python -m app.cli assign-locations --dataset occurrence
+
+
+# Opens database the app would connect to and creates its schema
+async def connect() -> Database:
+    DB_URL = TEST_DATABASE_URL if os.environ.get("TESTING") else DATABASE_URL
+    database = Database(DB_URL)
+    await database.connect()
+    await create_app_schema(database)
+    return database
+
+# Assigns new points of the datasets to the locations containing them
+async def assign_locations(options: argparse.Namespace) -> None:
+    database = await connect()
+    try:
+        location_repo = LocationRepository(database)
+        for dataset in options.dataset or list(LOCATION_DATASETS):
+            assignment = await location_repo.assign_locations(
+                dataset = dataset,
+                batch_size = options.batch_size,
+                full = options.full
+            )
+            if assignment.waiting:
+                print(f"{dataset}: location links are not keyed yet, run "
+                    "create-indexes first")
+                continue
+            print(f"{dataset}: {assignment.points} points checked, "
+                f"{assignment.locations} locations assigned")
+    finally:
+        await database.disconnect()
+
+# Bulk loads occurrences from csv or Darwin Core files
+async def ingest_occurrences(options: argparse.Namespace) -> None:
+    database = await connect()
+    try:
+        ingest_repo = IngestRepository(database)
+        for path in options.path:
+            delimiter, compression = getIngestFormat(filename = path)
+            with open(path, mode = "rb") as source:
+                result = await ingest_repo.ingest_occurrences(
+                    source = source,
+                    delimiter = options.delimiter or delimiter,
+                    compression = compression,
+                    batch_size = options.batch_size,
+                    assign_locations = not options.no_assign
+                )
+            print(f"{path}: {result.rows_loaded} rows loaded, "
+                f"{result.rows_rejected} rejected")
+            for error in result.errors:
+                print(f"    {error}")
+    finally:
+        await database.disconnect()
+
+# Loads region and rohe polygons from csv files
+async def load_locations(options: argparse.Namespace) -> None:
+    database = await connect()
+    try:
+        location_repo = LocationRepository(database)
+        for path in options.path:
+            result = await location_repo.load_locations(
+                source = path,
+                update = options.update,
+                repair = not options.no_repair,
+                batch_size = options.batch_size
+            )
+            print(f"{path}: {result.loaded} locations loaded, "
+                f"{result.skipped} already loaded, {result.repaired} repaired")
+            for name in result.invalid:
+                print(f"    invalid geometry: {name}")
+    finally:
+        await database.disconnect()
+
+# Re-aggregates summaries of the months changed since they were last refreshed
+async def refresh_summaries(options: argparse.Namespace) -> None:
+    database = await connect()
+    try:
+        summary_repo = SummaryRepository(database)
+        for dataset in options.dataset or list(SUMMARY_DATASETS):
+            refresh = await summary_repo.refresh_summaries(
+                dataset = dataset,
+                full = options.full
+            )
+            print(f"{dataset}: {refresh.months} months refreshed")
+    finally:
+        await database.disconnect()
+
+# Applies changes to the large tables, rewriting them, outside of startup
+async def migrate_tables(options: argparse.Namespace) -> None:
+    database = await connect()
+    try:
+        await apply_table_migrations(database)
+        print("large table changes applied")
+    finally:
+        await database.disconnect()
+
+# Builds missing indexes of the large tables without blocking writes
+async def create_indexes(options: argparse.Namespace) -> None:
+    database = await connect()
+    try:
+        built = await create_table_indexes(database)
+        print(f"{len(built)} indexes built")
+        for name in built:
+            print(f"    {name}")
+    finally:
+        await database.disconnect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog = "python -m app.cli")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    assign = commands.add_parser("assign-locations",
+        help = "link new points to the regions and rohe containing them")
+    assign.add_argument("--dataset", action = "append",
+        choices = list(LOCATION_DATASETS),
+        help = "dataset to assign, all datasets when not given")
+    assign.add_argument("--batch-size", type = int,
+        default = LOCATION_BATCH_SIZE)
+    assign.add_argument("--full", action = "store_true",
+        help = "recheck every point, not only those added or moved since "
+            "the last run")
+    assign.set_defaults(handler = assign_locations)
+    ingest = commands.add_parser("ingest-occurrences",
+        help = "bulk load occurrences from csv or Darwin Core files")
+    ingest.add_argument("path", nargs = "+")
+    ingest.add_argument("--delimiter",
+        help = "field delimiter, guessed from the file name when not given")
+    ingest.add_argument("--batch-size", type = int,
+        default = INGEST_BATCH_SIZE)
+    ingest.add_argument("--no-assign", action = "store_true",
+        help = "skip assigning loaded occurrences to locations")
+    ingest.set_defaults(handler = ingest_occurrences)
+    load = commands.add_parser("load-locations",
+        help = "load region and rohe polygons from name, polygon, "
+            "locationtype csv files")
+    load.add_argument("path", nargs = "+")
+    load.add_argument("--update", action = "store_true",
+        help = "replace polygons of locations already loaded")
+    load.add_argument("--no-repair", action = "store_true",
+        help = "skip invalid geometries instead of repairing them")
+    load.add_argument("--batch-size", type = int,
+        default = LOCATION_LOAD_BATCH_SIZE)
+    load.set_defaults(handler = load_locations)
+    refresh = commands.add_parser("refresh-summaries",
+        help = "re-aggregate summaries of months changed since the last run")
+    refresh.add_argument("--dataset", action = "append",
+        choices = list(SUMMARY_DATASETS),
+        help = "dataset to refresh, all datasets when not given")
+    refresh.add_argument("--full", action = "store_true",
+        help = "rebuild every month, e.g. after writes with triggers "
+            "disabled")
+    refresh.set_defaults(handler = refresh_summaries)
+    migrate = commands.add_parser("migrate-tables",
+        help = "add the point columns of the large tables, locking them "
+            "while they are rewritten, and remove duplicate location links")
+    migrate.set_defaults(handler = migrate_tables)
+    indexes = commands.add_parser("create-indexes",
+        help = "build missing indexes of the large tables concurrently, "
+            "as the app does when it starts")
+    indexes.set_defaults(handler = create_indexes)
+    options = parser.parse_args()
+    asyncio.run(options.handler(options))
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,100 @@ JWT_AUDIENCE_RESET = config("JWT_AUDIENCE_RESET", cast = str,
 JWT_AUDIENCE = config("JWT_AUDIENCE", cast = str, default = "ecoindex:auth")
 JWT_TOKEN_PREFIX = config("JWT_TOKEN_PREFIX", cast = str, default = "Bearer")
 
+# directories download files are written to
+OCCURRENCE_DOWNLOAD_PATH = config("OCCURRENCE_DOWNLOAD_PATH", cast = str,
+                                  default = "./occurrence_download/")
+MCI_DOWNLOAD_PATH = config("MCI_DOWNLOAD_PATH", cast = str,
+                           default = "./mci_download/")
+# compression applied to stored csv exports, gzip, zstd or none
+EXPORT_COMPRESSION = config("EXPORT_COMPRESSION", cast = str, 
+                            default = "gzip")
+# number of rows fetched from the cursor and written per export batch
+EXPORT_BATCH_SIZE = config("EXPORT_BATCH_SIZE", cast = int, default = 5000)
+# number of exports run against the database at the same time
+EXPORT_WORKERS = config("EXPORT_WORKERS", cast = int, default = 2)
+# number of exports that can wait for a worker before new ones are refused
+EXPORT_QUEUE_SIZE = config("EXPORT_QUEUE_SIZE", cast = int, default = 100)
+# number of finished export jobs whose status is kept for polling
+EXPORT_JOB_HISTORY = config("EXPORT_JOB_HISTORY", cast = int, default = 1000)
+# disk space in bytes download files can use before the least recently
+# downloaded are evicted
+EXPORT_QUOTA = config(
+    "EXPORT_QUOTA",
+    cast = int,
+    default = 10 * 1024 ** 3 # 10 GiB
+)
+# days a download file is kept after it was last downloaded, 0 keeps them
+EXPORT_MAX_AGE = config("EXPORT_MAX_AGE", cast = int, default = 30)
+# seconds between runs of the download retention task
+EXPORT_RETENTION_INTERVAL = config("EXPORT_RETENTION_INTERVAL", cast = int,
+                                   default = 3600)
+# seconds an export can run before retention takes it as left behind by a
+# crash or restart and marks it failed
+EXPORT_MAX_RUNTIME = config("EXPORT_MAX_RUNTIME", cast = int,
+                            default = 6 * 3600)
+# most filters a batch export takes in one pass over a dataset
+EXPORT_BATCH_MAX_FILTERS = config("EXPORT_BATCH_MAX_FILTERS", cast = int,
+                                  default = 32)
+# directory batch exports write each filter's file to before packing them,
+# the system temporary directory when not set
+EXPORT_TEMP_PATH = config("EXPORT_TEMP_PATH", cast = str, default = None)
+# number of rows returned per page when listing data, and the most allowed
+PAGE_SIZE = config("PAGE_SIZE", cast = int, default = 100)
+MAX_PAGE_SIZE = config("MAX_PAGE_SIZE", cast = int, default = 1000)
+# number of rows a filter preview returns by default, and the most allowed
+PREVIEW_SIZE = config("PREVIEW_SIZE", cast = int, default = 10)
+MAX_PREVIEW_SIZE = config("MAX_PREVIEW_SIZE", cast = int, default = 100)
+# most rows a preview counts exactly, larger results only get an estimate
+PREVIEW_COUNT_LIMIT = config("PREVIEW_COUNT_LIMIT", cast = int, 
+                             default = 100000)
+# builds trigram indexes so taxonomy filters can match names by substring
+TAXONOMY_TRIGRAM_INDEXES = config("TAXONOMY_TRIGRAM_INDEXES", cast = bool,
+                                  default = False)
+# number of compiled filter statements kept per dataset, and prepared per
+# pooled connection
+FILTER_STATEMENT_CACHE_SIZE = config("FILTER_STATEMENT_CACHE_SIZE", 
+                                     cast = int, default = 256)
+# directory occurrence map tiles are cached in
+TILE_CACHE_PATH = config("TILE_CACHE_PATH", cast = str, 
+                         default = "./tile_cache/")
+# disk space in bytes cached map tiles can use before the least recently
+# read are evicted
+TILE_CACHE_QUOTA = config(
+    "TILE_CACHE_QUOTA",
+    cast = int,
+    default = 1024 ** 3 # 1 GiB
+)
+# highest zoom level whose tiles cluster points, deeper zooms draw each point
+TILE_CLUSTER_MAX_ZOOM = config("TILE_CLUSTER_MAX_ZOOM", cast = int, 
+                               default = 12)
+# number of cluster cells along each side of a clustered tile
+TILE_CLUSTER_GRID = config("TILE_CLUSTER_GRID", cast = int, default = 64)
+# width in web mercator metres of density grid cells by default, and the
+# smallest allowed
+GRID_CELL_SIZE = config("GRID_CELL_SIZE", cast = float, default = 10000)
+MIN_GRID_CELL_SIZE = config("MIN_GRID_CELL_SIZE", cast = float, 
+                            default = 1000)
+# most density grid cells the filter area may be split into
+MAX_GRID_CELLS = config("MAX_GRID_CELLS", cast = int, default = 100000)
+# spatial reference system of the locationref polygons
+LOCATION_SRID = config("LOCATION_SRID", cast = int, default = 4326)
+# number of new occurrences assigned to locations per batch
+LOCATION_BATCH_SIZE = config("LOCATION_BATCH_SIZE", cast = int, 
+                             default = 50000)
+# number of location polygons upserted per round trip when loading boundaries
+LOCATION_LOAD_BATCH_SIZE = config("LOCATION_LOAD_BATCH_SIZE", cast = int, 
+                                  default = 50)
+# seconds between runs assigning new points to locations and refreshing the
+# summaries of the months changed
+SUMMARY_REFRESH_INTERVAL = config("SUMMARY_REFRESH_INTERVAL", cast = int,
+                                  default = 300)
+# number of rows validated and copied into staging per bulk load batch
+INGEST_BATCH_SIZE = config("INGEST_BATCH_SIZE", cast = int, default = 100000)
+# directory uploads are copied to until their bulk load job runs, the system
+# temporary directory when not set
+INGEST_TEMP_PATH = config("INGEST_TEMP_PATH", cast = str, default = None)
+
 PASSWORD_URL = config("PASSWORD_URL", cast = str)
 
 MAIL_USERNAME = config('MAIL_USERNAME', cast = str)
@@ -2,16 +2,35 @@ from typing import Callable
 
 from fastapi import FastAPI
 
-from app.db.tasks import connect_to_db, close_db_connection
+from app.api.services import export_job_service
+from app.db.tasks import (
+    connect_to_db, 
+    close_db_connection, 
+    start_export_retention, 
+    start_index_builds,
+    start_summary_refresh,
+    stop_export_retention,
+    stop_index_builds,
+    stop_summary_refresh
+)
 
 def create_start_app_handler(app: FastAPI) -> Callable:
     async def start_app() -> None:
         await connect_to_db(app)
+        await export_job_service.start(
+            database = getattr(app.state, "_db", None))
+        start_export_retention(app)
+        start_summary_refresh(app)
+        start_index_builds(app)
 
     return start_app
 
 def create_stop_app_handler(app: FastAPI) -> Callable:
     async def stop_app() -> None:
+        await stop_index_builds(app)
+        await stop_summary_refresh(app)
+        await stop_export_retention(app)
+        await export_job_service.stop()
         await close_db_connection(app)
         
-    return stop_app
\ No newline at end of file
+    return stop_app
@@ -1,5 +1,347 @@
+import base64
+import binascii
+import json
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Mapping, Optional, Tuple
+
 from databases import Database
+from fastapi import HTTPException
+from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY
+
+from app.core.config import (
+    EXPORT_BATCH_SIZE, 
+    PAGE_SIZE, 
+    PREVIEW_COUNT_LIMIT, 
+    PREVIEW_SIZE
+)
+from app.db.repositories.compiler import FilterCompiler
+from app.models.filter import FilterStatementStats
+from app.models.page import ChangesPage, Page
+from app.models.preview import Preview
+
+# SQL Queries
+GET_FIRST_PAGE_QUERY = """
+    SELECT {columns} FROM {table}
+    ORDER BY id
+    LIMIT :limit
+"""
+
+GET_NEXT_PAGE_QUERY = """
+    SELECT {columns} FROM {table}
+    WHERE id > :after
+    ORDER BY id
+    LIMIT :limit
+"""
+
+# Rows changed after the sync token in the order their transactions wrote
+# them. Changes stop at the commit horizon, as rows of transactions still
+# running could commit behind the token.
+GET_CHANGES_QUERY = """
+    SELECT {columns}, updated_xid FROM {table}
+    WHERE (updated_xid, id) > (:updated_xid, :after) \
+        AND updated_xid < :horizon
+    ORDER BY updated_xid, id
+    LIMIT :limit
+"""
+
+# First transaction writing rows since the time given, served by the index
+# on updated_at
+GET_CHANGES_START_QUERY = """
+    SELECT MIN(updated_xid) FROM {table} WHERE updated_at >= :since
+"""
+
+# Id of the oldest transaction still writing. Rows are stamped with the id
+# of the transaction writing them and every id below it has committed or
+# rolled back, so no row can still appear below it. Read only transactions
+# such as export cursors take no id, so never hold it back.
+GET_COMMIT_HORIZON_QUERY = """
+    SELECT CAST(CAST(pg_snapshot_xmin(pg_current_snapshot()) AS text) \
+        AS bigint)
+"""
+
+# Planner estimate of the rows a query returns, read without running it
+ESTIMATE_ROWS_QUERY = """
+    EXPLAIN (FORMAT JSON) {query}
+"""
+
+# Counts at most limit rows, so large results cost no more than the limit
+COUNT_ROWS_QUERY = """
+    SELECT COUNT(*) AS count FROM ({query}
+        LIMIT :count_limit) AS counted
+"""
+
+PREVIEW_ROWS_QUERY = """{query}
+    LIMIT :preview_limit
+"""
+
+# Compiled statements prepared on this connection and how Postgres planned
+# their executions, generic plans being the ones reused
+GET_PREPARED_STATEMENT_STATS_QUERY = """
+    SELECT COUNT(*) AS prepared, \
+        COALESCE(SUM(generic_plans), 0) AS generic_plans, \
+        COALESCE(SUM(custom_plans), 0) AS custom_plans
+    FROM pg_prepared_statements
+    WHERE statement = ANY(:statements)
+"""
+
+CHECK_STATEMENT_STATISTICS_QUERY = """
+    SELECT to_regclass('pg_stat_statements') IS NOT NULL
+"""
+
+# Executions of compiled statements over every connection, and how many of
+# them were planned, plans counting only when track_planning is on
+GET_STATEMENT_EXECUTIONS_QUERY = """
+    SELECT COALESCE(SUM(calls), 0) AS executions, \
+        COALESCE(SUM(plans), 0) AS plans
+    FROM pg_stat_statements
+    WHERE dbid = (SELECT oid FROM pg_database \
+            WHERE datname = current_database()) \
+        AND query = ANY(:statements)
+"""
+
+# Encodes id of the last row on a page as an opaque cursor
+def encodeCursor(id: int) -> str:
+    token = json.dumps({"id": id}).encode()
+    return base64.urlsafe_b64encode(token).decode().rstrip("=")
+
+# Decodes cursor back into the id rows of the next page follow
+def decodeCursor(cursor: str) -> int:
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        token = json.loads(base64.urlsafe_b64decode(cursor + padding))
+        id = token["id"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        id = None
+    if not isinstance(id, int) or isinstance(id, bool):
+        raise HTTPException(
+            status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+            detail = "Not a valid page cursor"
+        )
+    return id
+
+# Encodes writing transaction and id of the last row changed as an opaque
+# sync token
+def encodeSyncToken(updated_xid: int, id: int) -> str:
+    token = json.dumps({"xid": updated_xid, "id": id})
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+# Decodes sync token back into the position changes are read from
+def decodeSyncToken(token: str) -> Tuple[int, int]:
+    try:
+        padding = "=" * (-len(token) % 4)
+        fields = json.loads(base64.urlsafe_b64decode(token + padding))
+        position = (fields["xid"], fields["id"])
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        position = (None, None)
+    if not all(isinstance(value, int) and not isinstance(value, bool)
+            for value in position):
+        raise HTTPException(
+            status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+            detail = "Not a valid sync token"
+        )
+    return position
+
+# Validates requested columns of a page, always keeping id for the cursor
+def buildPageColumns(fields: Optional[str], columns: List[str]) -> List[str]:
+    if not fields:
+        return columns
+    requested = [field.strip() for field in fields.split(",") 
+        if field.strip()]
+    unknown = [field for field in requested if field not in columns]
+    if unknown:
+        raise HTTPException(
+            status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+            detail = "Not a valid field: " + ", ".join(unknown)
+        )
+    return ["id"] + [field for field in columns 
+        if field in requested and field != "id"]
+
+# Joins conditions of a filter into the lines of its where clause
+def buildWhereClause(conditions: List[str]) -> str:
+    return "".join(
+        ("\n        WHERE " if index == 0 else "\n        AND ") + condition
+        for index, condition in enumerate(conditions))
+
 
 class BaseRepository:
     def __init__(self, db: Database) -> None:
         self.db = db
+
+    # Reads query results from a server side cursor in fixed size batches
+    async def iterate_batches(self, query: str, values: dict = None,
+            batch_size: int = EXPORT_BATCH_SIZE
+            ) -> AsyncIterator[List[Mapping]]:
+        batch = []
+        async for record in self.db.iterate(query = query, values = values):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    # Returns transaction id every row written below has committed by. Read
+    # in a statement of its own, so the statements following see them all.
+    async def get_commit_horizon(self) -> int:
+        return await self.db.fetch_val(query = GET_COMMIT_HORIZON_QUERY)
+
+    # Runs filter query as its compiled statement, prepared on the pooled
+    # connection so repeated filter shapes reuse the plan
+    async def fetch_compiled(self, compiler: FilterCompiler, query: str,
+            values: dict) -> List[Mapping]:
+        statement, args = compiler.compile(query = query, args = values)
+        async with self.db.connection() as connection:
+            return await connection.raw_connection.fetch(statement, *args)
+
+    # Returns reuse of a compiler's statements, from the compiler and from
+    # what Postgres recorded of their preparation and execution
+    async def get_statement_stats(self, compiler: FilterCompiler
+            ) -> FilterStatementStats:
+        stats = compiler.stats()
+        values = {"statements": compiler.compiled_statements()}
+        async with self.db.connection() as connection:
+            prepared = await connection.fetch_one(
+                query = GET_PREPARED_STATEMENT_STATS_QUERY,
+                values = values
+            )
+            stats.prepared = prepared["prepared"]
+            stats.generic_plans = prepared["generic_plans"]
+            stats.custom_plans = prepared["custom_plans"]
+            if await connection.fetch_val(
+                    query = CHECK_STATEMENT_STATISTICS_QUERY):
+                executions = await connection.fetch_one(
+                    query = GET_STATEMENT_EXECUTIONS_QUERY,
+                    values = values
+                )
+                stats.executions = executions["executions"]
+                stats.plans = executions["plans"]
+        return stats
+
+    # Reads compiled filter query from a server side cursor in batches
+    async def iterate_compiled(self, compiler: FilterCompiler, query: str,
+            values: dict, batch_size: int = EXPORT_BATCH_SIZE
+            ) -> AsyncIterator[List[Mapping]]:
+        statement, args = compiler.compile(query = query, args = values)
+        batch = []
+        async with self.db.connection() as connection:
+            # Cursors only live inside a transaction
+            async with connection.transaction():
+                async for record in connection.raw_connection.cursor(
+                        statement, *args, prefetch = batch_size):
+                    batch.append(record)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
+
+    # Returns estimated and, when cheap, exact count of a filter query's
+    # rows with the first of them
+    async def preview_filter(self, compiler: FilterCompiler, query: str,
+            values: dict, limit: int = PREVIEW_SIZE,
+            count_limit: int = PREVIEW_COUNT_LIMIT) -> Preview:
+        # Explains the compiled statement with its positional arguments, so
+        # the estimate is planned as the count and rows below are
+        statement, args = compiler.compile(query = query, args = values)
+        async with self.db.connection() as connection:
+            plan = await connection.raw_connection.fetchval(
+                ESTIMATE_ROWS_QUERY.format(query = statement), *args)
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimated_count = int(plan[0]["Plan"]["Plan Rows"])
+        # One row past the limit tells an exact count from a capped one
+        counted = await self.fetch_compiled(
+            compiler = compiler,
+            query = COUNT_ROWS_QUERY.format(query = query),
+            values = {**values, "count_limit": count_limit + 1}
+        )
+        count = counted[0]["count"]
+        exact = count <= count_limit
+        records = []
+        if limit:
+            records = await self.fetch_compiled(
+                compiler = compiler,
+                query = PREVIEW_ROWS_QUERY.format(query = query),
+                values = {**values, "preview_limit": limit}
+            )
+        # Capped counts are a floor the estimate should not fall below
+        return Preview(
+            estimated_count = count if exact 
+                else max(estimated_count, count),
+            count = count if exact else None,
+            exact = exact,
+            results = [dict(record) for record in records]
+        )
+
+    # Returns rows changed after the sync token, or from the time given,
+    # with the token the following changes are read from
+    async def fetch_changes(self, table: str, columns: List[str],
+            token: Optional[str] = None, since: Optional[datetime] = None,
+            limit: int = PAGE_SIZE, fields: Optional[str] = None
+            ) -> ChangesPage:
+        # Changes are read from the first transaction unless told otherwise
+        updated_xid, after = 0, 0
+        if token:
+            updated_xid, after = decodeSyncToken(token = token)
+        horizon = await self.get_commit_horizon()
+        if since and not token:
+            if since.tzinfo is None:
+                since = since.replace(tzinfo = timezone.utc)
+            # Reads start at the first transaction writing rows since then,
+            # so rows of transactions overlapping it may be returned too
+            start = await self.db.fetch_val(
+                query = GET_CHANGES_START_QUERY.format(table = table),
+                values = {"since": since}
+            )
+            updated_xid = horizon if start is None else start
+        # Updated at is always returned with the rows
+        selected = list(buildPageColumns(fields = fields, columns = columns))
+        if "updated_at" not in selected:
+            selected.append("updated_at")
+        records = await self.db.fetch_all(
+            query = GET_CHANGES_QUERY.format(
+                columns = ", ".join(selected), 
+                table = table
+            ),
+            values = {
+                "updated_xid": updated_xid,
+                "after": after,
+                "horizon": horizon,
+                "limit": limit + 1
+            }
+        )
+        # One extra row is read to tell whether more changes follow
+        results = []
+        for record in records[:limit]:
+            row = dict(record)
+            updated_xid, after = row.pop("updated_xid"), row["id"]
+            results.append(row)
+        return ChangesPage(
+            results = results,
+            token = encodeSyncToken(updated_xid = updated_xid, id = after),
+            more = len(records) > limit
+        )
+
+    # Returns page of rows ordered by id, following the row the cursor names
+    async def fetch_page(self, table: str, columns: List[str],
+            cursor: Optional[str] = None, limit: int = PAGE_SIZE,
+            fields: Optional[str] = None) -> Page:
+        # Seeks past the last id seen so each page costs the same to read
+        selected = ", ".join(buildPageColumns(fields = fields, 
+            columns = columns))
+        values = {"limit": limit + 1}
+        if cursor:
+            query = GET_NEXT_PAGE_QUERY
+            values["after"] = decodeCursor(cursor = cursor)
+        else:
+            query = GET_FIRST_PAGE_QUERY
+        records = await self.db.fetch_all(
+            query = query.format(columns = selected, table = table),
+            values = values
+        )
+        # One extra row is read to tell whether another page follows
+        results = [dict(record) for record in records[:limit]]
+        next = None
+        if len(records) > limit:
+            next = encodeCursor(id = results[-1]["id"])
+        return Page(results = results, next = next)
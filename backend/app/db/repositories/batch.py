@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import tempfile
+from typing import AsyncIterator, List, Mapping, Optional, Tuple
+
+import pyarrow as pa
+from databases import Database
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY
+
+from app.api.services import export_service
+from app.core.config import EXPORT_BATCH_MAX_FILTERS, EXPORT_TEMP_PATH
+from app.db.repositories.base import BaseRepository
+from app.db.repositories.compiler import PARAMETER_PATTERN, FilterCompiler
+from app.db.repositories.export import ExportRepository
+from app.db.repositories.mci import MCI_EXPORT_SCHEMA, MCIRepository
+from app.db.repositories.occurrence import (
+    OCCURRENCE_EXPORT_SCHEMA,
+    OccurrenceRepository
+)
+from app.models.export import ExportFormat, ExportResult
+from app.models.filter import ExportFilterBatch
+
+
+# Batch Export Repository Actions
+
+
+# Table, typed columns and filter builder of each dataset
+BATCH_DATASETS = {
+    "occurrence": {
+        "table": "main.occurrence",
+        "schema": OCCURRENCE_EXPORT_SCHEMA,
+        "repository": OccurrenceRepository
+    },
+    "mci": {
+        "table": "main.mci",
+        "schema": MCI_EXPORT_SCHEMA,
+        "repository": MCIRepository
+    }
+}
+
+# Batches of rows a file can fall behind the scan before the scan waits
+MEMBER_QUEUE_SIZE = 2
+
+# Compiled statements of the batch queries, shared by every request
+BATCH_FILTER_COMPILER = FilterCompiler()
+
+# SQL Queries
+
+# One scan returns every row some filter matches, flagged with the filters
+# it matches in the order they were given
+BATCH_EXPORT_QUERY = """
+    SELECT {columns}, ARRAY[{matches}] AS matches
+    FROM {table}
+    WHERE {conditions}
+"""
+
+# Returns conditions of a filter as one expression, with parameters
+# prefixed by the filter's index so many filters can share a query
+def buildBatchCondition(conditions: List[str], args: dict, index: int
+        ) -> Tuple[str, dict]:
+    # Filters without conditions match every row
+    if not conditions:
+        return "TRUE", {}
+    prefix = f"f{index}_"
+    condition = " AND ".join(f"({condition.strip()})"
+        for condition in conditions)
+    condition = PARAMETER_PATTERN.sub(
+        lambda match: f":{prefix}{match.group(1)}", condition)
+    return condition, {prefix + name: value for name, value in args.items()}
+
+# Splits batch of scanned rows into the rows each filter matches
+def routeBatch(batch: List[Mapping], members: int) -> List[List[Mapping]]:
+    routed = [[] for _ in range(members)]
+    for record in batch:
+        for index, matched in enumerate(record["matches"]):
+            if matched:
+                routed[index].append(record)
+    return routed
+
+# Yields batches sent to a file until the scan is done
+async def iterateQueue(queue: asyncio.Queue) -> AsyncIterator[List[Mapping]]:
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            return
+        yield batch
+
+
+class BatchExportRepository(BaseRepository):
+    """
+    All database actions associated with exports of many filters at once
+    """
+    def __init__(self, db: Database) -> None:
+        super().__init__(db)
+        self.export_repo = ExportRepository(db)
+        self.repositories = {dataset: settings["repository"](db)
+            for dataset, settings in BATCH_DATASETS.items()}
+
+    # Builds query scanning the dataset once for every filter of the batch
+    def build_batch_query(self, dataset: str, batch: ExportFilterBatch
+            ) -> Tuple[str, dict]:
+        if not 0 < len(batch.filters) <= EXPORT_BATCH_MAX_FILTERS:
+            raise HTTPException(
+                status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+                detail = "A batch export takes 1 to "
+                    f"{EXPORT_BATCH_MAX_FILTERS} filters"
+            )
+        settings = BATCH_DATASETS[dataset]
+        conditions = []
+        args = {}
+        for index, filter in enumerate(batch.filters):
+            # Builders validate each filter and return its conditions
+            filter_conditions, filter_args = self.repositories[
+                dataset].build_filter_conditions(filter = filter)
+            condition, filter_args = buildBatchCondition(
+                conditions = filter_conditions,
+                args = filter_args,
+                index = index
+            )
+            conditions.append(condition)
+            args.update(filter_args)
+        query = BATCH_EXPORT_QUERY.format(
+            columns = ", ".join(f"{settings['table']}.{name}"
+                for name in settings["schema"].names),
+            matches = ", ".join(f"COALESCE({condition}, FALSE)"
+                for condition in conditions),
+            table = settings["table"],
+            conditions = " OR ".join(f"({condition})"
+                for condition in conditions)
+        )
+        return query, args
+
+    # Exports every filter of the batch from a single scan of the dataset,
+    # returns the download of a zip archive holding a file per filter
+    async def create_batch_download(self, dataset: str,
+            batch: ExportFilterBatch, owner: Optional[str] = None,
+            format: ExportFormat = ExportFormat.csv) -> ExportResult:
+        query, args = self.build_batch_query(dataset = dataset, batch = batch)
+        export = await self.export_repo.create_export(
+            dataset = dataset,
+            filter = batch,
+            owner = owner,
+            format = ExportFormat.zip
+        )
+        extension = export_service.get_extension(
+            format = format,
+            encoding = None
+        )
+        try:
+            # Files of each filter stay out of the download directory,
+            # whose retention removes files it has no record of
+            with tempfile.TemporaryDirectory(
+                    dir = EXPORT_TEMP_PATH) as directory:
+                members = [(os.path.join(directory, f"{index}.part"),
+                    f"filter_{index + 1}.{extension}")
+                    for index in range(len(batch.filters))]
+                row_counts = await self.write_members(
+                    query = query,
+                    values = args,
+                    schema = BATCH_DATASETS[dataset]["schema"],
+                    format = format,
+                    paths = [path for path, _ in members]
+                )
+                manifest = json.dumps([{
+                    "file": name,
+                    "filter": json.loads(filter.json()),
+                    "row_count": row_count
+                } for (_, name), filter, row_count
+                    in zip(members, batch.filters, row_counts)], indent = 2)
+                await export_service.write_zip(
+                    path = export.path,
+                    members = members,
+                    manifest = manifest,
+                    format = format
+                )
+        except Exception:
+            await self.export_repo.fail_export(id = export.id)
+            if os.path.exists(export.path):
+                os.remove(export.path)
+            raise
+        return await self.export_repo.complete_export(
+            id = export.id,
+            row_count = sum(row_counts),
+            file_size = os.path.getsize(export.path)
+        )
+
+    # Streams rows of one scan into the files of the filters they match,
+    # returns row count of each file
+    async def write_members(self, query: str, values: dict,
+            schema: pa.Schema, format: ExportFormat,
+            paths: List[str]) -> List[int]:
+        # Bounded queues hold the scan back while any file is behind
+        queues = [asyncio.Queue(maxsize = MEMBER_QUEUE_SIZE)
+            for _ in paths]
+        async def scan() -> None:
+            async for batch in self.iterate_compiled(
+                    compiler = BATCH_FILTER_COMPILER,
+                    query = query,
+                    values = values):
+                routed = await run_in_threadpool(routeBatch, batch,
+                    len(queues))
+                for queue, rows in zip(queues, routed):
+                    if rows:
+                        await queue.put(rows)
+            for queue in queues:
+                await queue.put(None)
+        tasks = [asyncio.ensure_future(scan())]
+        tasks += [asyncio.ensure_future(export_service.write(
+            format = format,
+            path = path,
+            schema = schema,
+            batches = iterateQueue(queue)
+        )) for path, queue in zip(paths, queues)]
+        try:
+            results = await asyncio.gather(*tasks)
+        except Exception:
+            # A failed file would leave the scan waiting on its queue
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+            raise
+        return results[1:]
@@ -0,0 +1,104 @@
+import os
+from typing import Awaitable, Callable, Optional
+
+from databases import Database
+
+from app.db.repositories.base import BaseRepository
+from app.db.repositories.export import EXPORT_DATASETS, ExportRepository
+from app.db.repositories.version import TableVersionRepository
+from app.models.export import ExportResult
+
+
+# Export Cache Repository Actions
+
+
+# SQL Queries
+GET_CACHED_EXPORT_QUERY = """
+    UPDATE main.export_cache SET last_used_at = now()
+    FROM main.export
+    WHERE main.export_cache.cache_key = :cache_key \
+        AND main.export_cache.table_version = :table_version \
+        AND main.export.id = main.export_cache.download_id \
+        AND main.export.status = 'done'
+    RETURNING main.export_cache.download_id, main.export_cache.row_count, \
+        main.export_cache.file_size, main.export.path
+"""
+
+DELETE_CACHED_EXPORT_QUERY = """
+    DELETE FROM main.export_cache WHERE cache_key = :cache_key
+"""
+
+UPSERT_CACHED_EXPORT_QUERY = """
+    INSERT INTO main.export_cache (cache_key, dataset, download_id, \
+        table_version, row_count, file_size)
+    VALUES (:cache_key, :dataset, :download_id, :table_version, :row_count, \
+        :file_size)
+    ON CONFLICT (cache_key) DO UPDATE
+    SET download_id = EXCLUDED.download_id, \
+        table_version = EXCLUDED.table_version, \
+        row_count = EXCLUDED.row_count, file_size = EXCLUDED.file_size, \
+        created_at = now(), last_used_at = now()
+"""
+
+
+class ExportCacheRepository(BaseRepository):
+    """
+    All database actions associated with the Export Cache Table
+    """
+    def __init__(self, db: Database) -> None:
+        super().__init__(db)
+        self.export_repo = ExportRepository(db)
+        self.version_repo = TableVersionRepository(db)
+
+    # Returns current version of the tables a dataset is built from
+    async def get_table_version(self, dataset: str) -> int:
+        table_version = await self.version_repo.get_table_version(
+            tables = EXPORT_DATASETS[dataset]["tables"])
+        return table_version.version
+
+    # Returns cached export for the key if still current and on disk
+    async def get_cached_export(self, dataset: str, cache_key: str
+            ) -> Optional[ExportResult]:
+        table_version = await self.get_table_version(dataset = dataset)
+        record = await self.db.fetch_one(
+            query = GET_CACHED_EXPORT_QUERY,
+            values = {
+                "cache_key": cache_key,
+                "table_version": table_version
+            }
+        )
+        if not record:
+            return None
+        if not os.path.exists(record["path"]):
+            await self.db.execute(
+                query = DELETE_CACHED_EXPORT_QUERY,
+                values = {"cache_key": cache_key}
+            )
+            return None
+        # Reused exports count as used so retention keeps them
+        await self.export_repo.touch_export(id = record["download_id"])
+        return ExportResult(
+            download_id = record["download_id"],
+            row_count = record["row_count"],
+            file_size = record["file_size"]
+        )
+
+    # Runs the export and caches its result against the table version
+    async def create_cached_export(self, dataset: str, cache_key: str,
+            export: Callable[[], Awaitable[ExportResult]]) -> ExportResult:
+        # Version is read first so writes during the export invalidate it
+        table_version = await self.get_table_version(dataset = dataset)
+        result = await export()
+        await self.db.execute(
+            query = UPSERT_CACHED_EXPORT_QUERY,
+            values = {
+                "cache_key": cache_key,
+                "dataset": dataset,
+                "table_version": table_version,
+                **result.dict()
+            }
+        )
+        # New files may take the downloads over their disk quota, the one
+        # just written is kept even when it is larger than the quota alone
+        await self.export_repo.evict_exports(keep = result.download_id)
+        return result
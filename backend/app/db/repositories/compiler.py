@@ -0,0 +1,71 @@
+import re
+from collections import OrderedDict
+from typing import List, Tuple
+
+from app.core.config import FILTER_STATEMENT_CACHE_SIZE
+from app.models.filter import FilterStatementStats
+
+
+# Filter Query Compiler
+
+# Filter builders bind every value, so each combination of set filter fields
+# yields one query text. The compiler turns that text into a positional
+# statement once, and each connection of the pool prepares it on first use.
+# Postgres plans the first executions of a prepared statement one by one and
+# may then settle on a generic plan, so reuse of plans is read from
+# pg_prepared_statements rather than from the counters kept here.
+
+# Named parameters of a query, skipping :: casts
+PARAMETER_PATTERN = re.compile(r"(?<!:):([A-Za-z_][A-Za-z0-9_]*)")
+
+# Rewrites named parameters as positional ones, returns the statement and
+# the parameter names in position order
+def compileFilterQuery(query: str) -> Tuple[str, List[str]]:
+    names = []
+    # Repeated names share the position they were first given
+    def position(match: re.Match) -> str:
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return f"${names.index(name) + 1}"
+    statement = PARAMETER_PATTERN.sub(position, query)
+    return statement, names
+
+
+class FilterCompiler:
+    """
+    Compiled filter statements of a dataset, least recently used dropped
+    """
+    def __init__(self, size: int = FILTER_STATEMENT_CACHE_SIZE) -> None:
+        self.size = size
+        self.statements = OrderedDict()
+        self.compile_hits = 0
+        self.compile_misses = 0
+
+    # Returns statement and positional arguments of a filter query
+    def compile(self, query: str, args: dict) -> Tuple[str, list]:
+        compiled = self.statements.get(query)
+        if compiled:
+            self.compile_hits += 1
+            self.statements.move_to_end(query)
+        else:
+            self.compile_misses += 1
+            compiled = compileFilterQuery(query = query)
+            self.statements[query] = compiled
+            if len(self.statements) > self.size:
+                self.statements.popitem(last = False)
+        statement, names = compiled
+        return statement, [args[name] for name in names]
+
+    # Returns statements compiled in this process
+    def compiled_statements(self) -> List[str]:
+        return [statement for statement, _ in self.statements.values()]
+
+    # Returns how often query text was found compiled in this process, which
+    # says nothing of whether Postgres reused a plan
+    def stats(self) -> FilterStatementStats:
+        return FilterStatementStats(
+            statements = len(self.statements),
+            compile_hits = self.compile_hits,
+            compile_misses = self.compile_misses
+        )
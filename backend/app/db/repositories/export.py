@@ -0,0 +1,271 @@
+import os
+import time
+from typing import AsyncIterator, List, Mapping, Optional, Union
+
+import pyarrow as pa
+from starlette.concurrency import run_in_threadpool
+
+from app.api.services import export_service
+from app.core.config import (
+    EXPORT_MAX_AGE, 
+    EXPORT_MAX_RUNTIME,
+    EXPORT_QUOTA, 
+    EXPORT_RETENTION_INTERVAL, 
+    MCI_DOWNLOAD_PATH, 
+    OCCURRENCE_DOWNLOAD_PATH
+)
+from app.db.repositories.base import BaseRepository
+from app.models.export import (
+    ExportEviction, 
+    ExportFormat, 
+    ExportRecord, 
+    ExportResult
+)
+from app.models.filter import ExportFilter, ExportFilterBatch
+
+
+# Export Registry Repository Actions
+
+
+# Download directory and tables each dataset's exports are built from
+EXPORT_DATASETS = {
+    "occurrence": {
+        "path": OCCURRENCE_DOWNLOAD_PATH,
+        "tables": ["occurrence", "location", "locationref"]
+    },
+    "mci": {
+        "path": MCI_DOWNLOAD_PATH,
+        "tables": ["mci", "mci_location", "locationref"]
+    }
+}
+
+# SQL Queries
+CREATE_EXPORT_QUERY = """
+    INSERT INTO main.export (id, dataset, format, encoding, filter, owner, \
+        path)
+    SELECT next_id.id, :dataset, :format, :encoding, CAST(:filter AS jsonb), \
+        :owner, :directory || 'export_' || next_id.id || '.' || :extension
+    FROM (SELECT nextval('main.export_id_seq') AS id) AS next_id
+    RETURNING id, dataset, format, encoding, filter::text AS filter, owner, \
+        path, status, row_count, file_size, created_at, completed_at
+"""
+
+COMPLETE_EXPORT_QUERY = """
+    UPDATE main.export
+    SET status = 'done', row_count = :row_count, file_size = :file_size, \
+        completed_at = now()
+    WHERE id = :id
+"""
+
+FAIL_EXPORT_QUERY = """
+    UPDATE main.export SET status = 'failed', completed_at = now()
+    WHERE id = :id
+"""
+
+GET_EXPORT_QUERY = """
+    SELECT id, dataset, format, encoding, filter::text AS filter, owner, \
+        path, status, row_count, file_size, created_at, completed_at, \
+        accessed_at, evicted_at
+    FROM main.export
+    WHERE id = :id AND dataset = :dataset
+"""
+
+TOUCH_EXPORT_QUERY = """
+    UPDATE main.export SET accessed_at = now() WHERE id = :id
+"""
+
+# Evicts least recently downloaded files beyond the quota and files not
+# downloaded within the age limit, dropping cache entries pointing at them.
+# The export kept still counts against the quota, evicting others instead.
+EVICT_EXPORTS_QUERY = """
+    WITH usage AS (
+        SELECT id, COALESCE(accessed_at, completed_at) AS last_used, \
+            SUM(file_size) OVER (
+                ORDER BY COALESCE(accessed_at, completed_at) DESC, id DESC
+            ) AS used
+        FROM main.export
+        WHERE status = 'done'
+    ),
+    evicted AS (
+        UPDATE main.export SET status = 'evicted', evicted_at = now()
+        FROM usage
+        WHERE main.export.id = usage.id \
+            AND main.export.id IS DISTINCT FROM CAST(:keep AS bigint) \
+            AND (usage.used > :quota \
+            OR (:max_age > 0 \
+                AND usage.last_used < now() - make_interval(days => :max_age)))
+        RETURNING main.export.id, main.export.path, main.export.file_size
+    ),
+    uncached AS (
+        DELETE FROM main.export_cache USING evicted
+        WHERE main.export_cache.download_id = evicted.id
+    )
+    SELECT id, path, file_size FROM evicted
+"""
+
+# Exports running for longer than any could, whose process stopped before
+# they finished, so their files are no longer kept
+FAIL_ABANDONED_EXPORTS_QUERY = """
+    UPDATE main.export SET status = 'failed', completed_at = now()
+    WHERE status = 'running' \
+        AND created_at < now() - make_interval(secs => :max_runtime)
+    RETURNING id
+"""
+
+# Paths of a dataset's files that are being written or can be downloaded
+GET_LIVE_EXPORT_PATHS_QUERY = """
+    SELECT path FROM main.export
+    WHERE dataset = :dataset AND status IN ('running', 'done')
+"""
+
+# Removes files of a download directory no live export owns, such as files
+# of evicted or failed exports and files written before the registry existed
+def removeUnregisteredFiles(directory: str, paths: List[str],
+        min_age: float) -> int:
+    if not os.path.isdir(directory):
+        return 0
+    live = {os.path.abspath(path) for path in paths}
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.abspath(os.path.join(directory, name))
+        if path in live or not os.path.isfile(path):
+            continue
+        # Recent files may belong to an export registered since the query
+        try:
+            if time.time() - os.path.getmtime(path) < min_age:
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+    return removed
+
+
+class ExportRepository(BaseRepository):
+    """
+    All database actions associated with the Export Registry Table
+    """
+    # Allocates a new export id and its download path
+    async def create_export(self, dataset: str,
+            filter: Union[ExportFilter, ExportFilterBatch],
+            owner: Optional[str] = None,
+            format: ExportFormat = ExportFormat.csv) -> ExportRecord:
+        # Id comes from a sequence so concurrent exports never share a file
+        directory = os.path.join(EXPORT_DATASETS[dataset]["path"], "")
+        encoding = export_service.get_encoding(format = format)
+        record = await self.db.fetch_one(
+            query = CREATE_EXPORT_QUERY,
+            values = {
+                "dataset": dataset,
+                "format": format.value,
+                "encoding": encoding.value if encoding else None,
+                "filter": filter.json(),
+                "owner": owner,
+                "directory": directory,
+                "extension": export_service.get_extension(
+                    format = format, 
+                    encoding = encoding
+                )
+            }
+        )
+        return ExportRecord(**record)
+
+    # Records size and row count of a finished export
+    async def complete_export(self, id: int, row_count: int, file_size: int
+            ) -> ExportResult:
+        await self.db.execute(
+            query = COMPLETE_EXPORT_QUERY,
+            values = {
+                "id": id,
+                "row_count": row_count,
+                "file_size": file_size
+            }
+        )
+        return ExportResult(
+            download_id = id,
+            row_count = row_count,
+            file_size = file_size
+        )
+
+    # Marks an export as failed
+    async def fail_export(self, id: int) -> None:
+        await self.db.execute(query = FAIL_EXPORT_QUERY, values = {"id": id})
+
+    # Records an export was downloaded, so retention keeps it longer
+    async def touch_export(self, id: int) -> None:
+        await self.db.execute(query = TOUCH_EXPORT_QUERY, values = {"id": id})
+
+    # Fails exports left running, evicts downloads beyond the disk quota or
+    # age limit and removes files no export owns, keeping the export given
+    async def evict_exports(self, quota: int = EXPORT_QUOTA,
+            max_age: int = EXPORT_MAX_AGE,
+            min_age: float = EXPORT_RETENTION_INTERVAL,
+            keep: Optional[int] = None,
+            max_runtime: int = EXPORT_MAX_RUNTIME) -> ExportEviction:
+        eviction = ExportEviction()
+        abandoned = await self.db.fetch_all(
+            query = FAIL_ABANDONED_EXPORTS_QUERY,
+            values = {"max_runtime": max_runtime}
+        )
+        eviction.abandoned = [record["id"] for record in abandoned]
+        evicted = await self.db.fetch_all(
+            query = EVICT_EXPORTS_QUERY,
+            values = {"quota": quota, "max_age": max_age, "keep": keep}
+        )
+        for record in evicted:
+            if os.path.exists(record["path"]):
+                await run_in_threadpool(os.remove, record["path"])
+            eviction.evicted.append(record["id"])
+            eviction.bytes_freed += record["file_size"] or 0
+        for dataset, settings in EXPORT_DATASETS.items():
+            paths = await self.db.fetch_all(
+                query = GET_LIVE_EXPORT_PATHS_QUERY,
+                values = {"dataset": dataset}
+            )
+            eviction.files_removed += await run_in_threadpool(
+                removeUnregisteredFiles,
+                settings["path"],
+                [record["path"] for record in paths],
+                min_age
+            )
+        return eviction
+
+    # Returns export of the given id and dataset if it exists
+    async def get_export(self, id: int, dataset: str
+            ) -> Optional[ExportRecord]:
+        record = await self.db.fetch_one(
+            query = GET_EXPORT_QUERY,
+            values = {"id": id, "dataset": dataset}
+        )
+        if not record:
+            return None
+        return ExportRecord(**record)
+
+    # Registers an export and streams its rows into the download file
+    async def write_export(self, dataset: str, filter: ExportFilter,
+            owner: Optional[str], format: ExportFormat, schema: pa.Schema,
+            batches: AsyncIterator[List[Mapping]]) -> ExportResult:
+        export = await self.create_export(
+            dataset = dataset,
+            filter = filter,
+            owner = owner,
+            format = format
+        )
+        try:
+            row_count = await export_service.write(
+                format = format,
+                path = export.path,
+                schema = schema,
+                batches = batches,
+                encoding = export.encoding
+            )
+        except Exception:
+            await self.fail_export(id = export.id)
+            if os.path.exists(export.path):
+                os.remove(export.path)
+            raise
+        return await self.complete_export(
+            id = export.id,
+            row_count = row_count,
+            file_size = os.path.getsize(export.path)
+        )
@@ -0,0 +1,227 @@
+import json
+import math
+from typing import List, Optional, Tuple
+
+from databases import Database
+from fastapi import HTTPException
+from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY
+
+from app.core.config import GRID_CELL_SIZE, MAX_GRID_CELLS
+from app.db.repositories.base import BaseRepository
+from app.db.repositories.cache import ExportCacheRepository
+from app.db.repositories.compiler import FilterCompiler
+from app.db.repositories.occurrence import (
+    GET_OCCURRENCE_POINTS_BY_FILTER_QUERY,
+    OccurrenceRepository
+)
+from app.db.repositories.spatial import (
+    buildBoundingBoxArgs,
+    buildGeometryArea,
+    buildGeometryArgs
+)
+from app.models.filter import Filter
+from app.models.grid import Grid, GridCell, GridShape
+
+
+# Density Grid Repository Actions
+
+
+# PostGIS functions finding the cell of a point and drawing a cell, and the
+# area of a cell relative to the square of its size
+GRID_FUNCTIONS = {
+    GridShape.hexagon: {
+        "grid": "ST_HexagonGrid",
+        "cell": "ST_Hexagon",
+        "area": 3 * math.sqrt(3) / 2
+    },
+    GridShape.square: {
+        "grid": "ST_SquareGrid",
+        "cell": "ST_Square",
+        "area": 1
+    }
+}
+
+# Extent of the occurrences from planner statistics, unknown until the table
+# is first analysed
+OCCURRENCE_EXTENT = """ST_SetSRID(CAST(ST_EstimatedExtent('main', \
+    'occurrence', 'geom') AS geometry), 4326)"""
+
+# Compiled statements of the grid queries, shared by every request
+GRID_FILTER_COMPILER = FilterCompiler()
+
+# SQL Queries
+
+# Cells are laid out in web mercator metres, points beyond its latitude
+# limits cannot be projected so are left out
+GET_OCCURRENCE_GRID_QUERY = """
+    SELECT cell.i, cell.j, COUNT(*) AS occurrences, \
+        COUNT(DISTINCT filtered.occurrence_species) AS species, \
+        ST_AsGeoJSON(ST_Transform({cell}(:cell_size, cell.i, cell.j), \
+            4326), 6) AS geometry
+    FROM ({query}) AS filtered
+    CROSS JOIN LATERAL (
+        SELECT i, j FROM {grid}(:cell_size, \
+            ST_Transform(filtered.geom, 3857))
+        LIMIT 1
+    ) AS cell
+    WHERE filtered.geom && ST_MakeEnvelope(-180, -85.05, 180, 85.05, 4326)
+    GROUP BY cell.i, cell.j
+    ORDER BY cell.i, cell.j
+"""
+
+# Area in web mercator square metres of the extent cells are laid over
+GET_GRID_AREA_QUERY = """
+    SELECT ST_Area(ST_Transform(ST_Intersection({extent}, \
+        ST_MakeEnvelope(-180, -85.05, 180, 85.05, 4326)), 3857))
+"""
+
+GET_CACHED_GRID_QUERY = """
+    SELECT cells FROM main.grid_cache
+    WHERE cache_key = :cache_key AND table_version = :table_version
+"""
+
+UPSERT_CACHED_GRID_QUERY = """
+    INSERT INTO main.grid_cache (cache_key, table_version, cells)
+    VALUES (:cache_key, :table_version, CAST(:cells AS jsonb))
+    ON CONFLICT (cache_key) DO UPDATE
+    SET table_version = EXCLUDED.table_version, cells = EXCLUDED.cells, \
+        created_at = now()
+"""
+
+# Grids of older table versions can never be served again
+DELETE_STALE_GRIDS_QUERY = """
+    DELETE FROM main.grid_cache WHERE table_version < :table_version
+"""
+
+# Returns extent of the area a filter is limited to, or of every occurrence
+# if it has none, and its bound arguments
+def buildGridExtent(filter: Filter) -> Tuple[str, dict]:
+    extents = []
+    args = {}
+    if filter.bbox:
+        args.update(buildBoundingBoxArgs(bbox = filter.bbox))
+        extents.append("ST_MakeEnvelope(:bbox_min_lon, :bbox_min_lat, \
+            :bbox_max_lon, :bbox_max_lat, 4326)")
+    if filter.geometry:
+        geometry_format, geometry_args = buildGeometryArgs(
+            geometry = filter.geometry)
+        args.update(geometry_args)
+        extents.append("ST_Envelope({area})".format(
+            area = buildGeometryArea(geometry_format = geometry_format)))
+    if not extents:
+        return OCCURRENCE_EXTENT, args
+    extent = extents[0]
+    for other in extents[1:]:
+        extent = f"ST_Intersection({extent}, {other})"
+    return extent, args
+
+
+class GridRepository(BaseRepository):
+    """
+    All database actions associated with occurrence density grids
+    """
+    def __init__(self, db: Database) -> None:
+        super().__init__(db)
+        self.occurrence_repo = OccurrenceRepository(db)
+        self.cache_repo = ExportCacheRepository(db)
+
+    # Returns cells of the grid holding occurrences the filter matches, from
+    # the cache while the occurrence tables are unchanged
+    async def get_occurrence_grid(self, filter: Filter,
+            cell_size: float = GRID_CELL_SIZE,
+            shape: GridShape = GridShape.hexagon) -> Grid:
+        await self.check_grid_cells(
+            filter = filter,
+            cell_size = cell_size,
+            shape = shape
+        )
+        query, args = self.occurrence_repo.build_filter_query(
+            filter = filter,
+            select = GET_OCCURRENCE_POINTS_BY_FILTER_QUERY
+        )
+        cache_key = filter.cache_key(
+            dataset = "occurrence",
+            format = f"{shape.value}-grid-{cell_size:g}"
+        )
+        # Version is read first so writes while counting invalidate the grid
+        table_version = await self.cache_repo.get_table_version(
+            dataset = "occurrence")
+        cells = await self.get_cached_grid(
+            cache_key = cache_key,
+            table_version = table_version
+        )
+        if cells is None:
+            records = await self.fetch_compiled(
+                compiler = GRID_FILTER_COMPILER,
+                query = GET_OCCURRENCE_GRID_QUERY.format(
+                    query = query,
+                    **GRID_FUNCTIONS[shape]
+                ),
+                values = {**args, "cell_size": cell_size}
+            )
+            cells = [GridCell(
+                i = record["i"],
+                j = record["j"],
+                occurrences = record["occurrences"],
+                species = record["species"],
+                geometry = json.loads(record["geometry"])
+            ) for record in records]
+            await self.cache_grid(
+                cache_key = cache_key,
+                table_version = table_version,
+                cells = cells
+            )
+        return Grid(shape = shape, cell_size = cell_size, cells = cells)
+
+    # Raises error if the extent of the filter, or of the occurrences when
+    # it has no area, would be split into more cells than are allowed
+    async def check_grid_cells(self, filter: Filter, cell_size: float,
+            shape: GridShape = GridShape.hexagon,
+            max_cells: int = MAX_GRID_CELLS) -> None:
+        extent, args = buildGridExtent(filter = filter)
+        area = await self.db.fetch_val(
+            query = GET_GRID_AREA_QUERY.format(extent = extent),
+            values = args
+        )
+        cell_area = GRID_FUNCTIONS[shape]["area"] * cell_size ** 2
+        cells = math.ceil((area or 0) / cell_area)
+        if cells > max_cells:
+            raise HTTPException(
+                status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+                detail = f"Grid would hold about {cells} cells, more than "
+                    f"the {max_cells} allowed. Use larger cells or a "
+                    "smaller area."
+            )
+
+    # Returns cached cells of a grid if computed at the current version
+    async def get_cached_grid(self, cache_key: str, table_version: int
+            ) -> Optional[List[GridCell]]:
+        cells = await self.db.fetch_val(
+            query = GET_CACHED_GRID_QUERY,
+            values = {
+                "cache_key": cache_key,
+                "table_version": table_version
+            }
+        )
+        if cells is None:
+            return None
+        if isinstance(cells, str):
+            cells = json.loads(cells)
+        return [GridCell(**cell) for cell in cells]
+
+    # Caches cells of a grid against the table version they were read at
+    async def cache_grid(self, cache_key: str, table_version: int,
+            cells: List[GridCell]) -> None:
+        async with self.db.transaction():
+            await self.db.execute(
+                query = DELETE_STALE_GRIDS_QUERY,
+                values = {"table_version": table_version}
+            )
+            await self.db.execute(
+                query = UPSERT_CACHED_GRID_QUERY,
+                values = {
+                    "cache_key": cache_key,
+                    "table_version": table_version,
+                    "cells": json.dumps([cell.dict() for cell in cells])
+                }
+            )
@@ -0,0 +1,252 @@
+import csv
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, List, Optional, Tuple
+
+import pandas as pd
+from databases import Database
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY
+
+from app.core.config import INGEST_BATCH_SIZE, INGEST_TEMP_PATH
+from app.db.repositories.base import BaseRepository
+from app.db.repositories.location import LocationRepository
+from app.db.repositories.summary import SummaryRepository
+from app.models.ingest import IngestResult
+
+
+# Bulk Ingest Repository Actions
+
+
+# Occurrence columns a bulk load fills, in copy order
+INGEST_COLUMNS = [
+    "scientific_name",
+    "observation_count",
+    "observation_date",
+    "occurrence_latitude",
+    "occurrence_longitude",
+    "occurrence_elevation",
+    "occurrence_depth",
+    "taxon_rank",
+    "infraspecific_epithet",
+    "occurrence_species",
+    "occurrence_genus",
+    "occurrence_family",
+    "occurrence_order",
+    "occurrence_class",
+    "occurrence_phylum",
+    "occurrence_kingdom"
+]
+
+# Darwin Core terms and the occurrence columns they load into
+DWC_COLUMNS = {
+    "scientificName": "scientific_name",
+    "individualCount": "observation_count",
+    "eventDate": "observation_date",
+    "decimalLatitude": "occurrence_latitude",
+    "decimalLongitude": "occurrence_longitude",
+    "elevation": "occurrence_elevation",
+    "depth": "occurrence_depth",
+    "taxonRank": "taxon_rank",
+    "infraspecificEpithet": "infraspecific_epithet",
+    "species": "occurrence_species",
+    "genus": "occurrence_genus",
+    "family": "occurrence_family",
+    "order": "occurrence_order",
+    "class": "occurrence_class",
+    "phylum": "occurrence_phylum",
+    "kingdom": "occurrence_kingdom"
+}
+
+REQUIRED_COLUMNS = ["scientific_name", "observation_date", "taxon_rank"]
+
+NUMERIC_COLUMNS = [
+    "observation_count",
+    "occurrence_latitude",
+    "occurrence_longitude",
+    "occurrence_elevation",
+    "occurrence_depth"
+]
+
+# Number of rejected rows whose reason is reported back
+INGEST_ERROR_SAMPLE = 20
+
+# SQL Queries
+CREATE_STAGING_TABLE_QUERY = f"""
+    CREATE TEMP TABLE occurrence_ingest ON COMMIT DROP AS
+    SELECT {", ".join(INGEST_COLUMNS)} FROM main.occurrence
+    WITH NO DATA
+"""
+
+MERGE_STAGING_TABLE_QUERY = f"""
+    WITH merged AS (
+        INSERT INTO main.occurrence ({", ".join(INGEST_COLUMNS)})
+        SELECT {", ".join(INGEST_COLUMNS)} FROM occurrence_ingest
+        RETURNING 1
+    )
+    SELECT COUNT(*) FROM merged
+"""
+
+# Guesses delimiter and compression of an input file from its name
+def getIngestFormat(filename: str) -> Tuple[str, Optional[str]]:
+    name = (filename or "").lower()
+    compression = None
+    if name.endswith(".gz"):
+        compression = "gzip"
+        name = name[:-3]
+    # Darwin Core archives hold tab separated occurrence.txt files
+    delimiter = "\t" if name.endswith((".txt", ".tsv")) else ","
+    return delimiter, compression
+
+# Copies an upload to a file of its own, as uploads are closed once the
+# request sending them returns and the load runs after it
+def saveIngestUpload(source: BinaryIO) -> str:
+    with tempfile.NamedTemporaryFile(delete = False, 
+            dir = INGEST_TEMP_PATH) as file:
+        shutil.copyfileobj(source, file)
+        return file.name
+
+# Validates a batch of rows at once, returns valid records to copy, the
+# number of rows rejected and the reasons for the first of them
+def validateOccurrenceBatch(frame: pd.DataFrame, first_line: int
+        ) -> Tuple[List[tuple], int, List[str]]:
+    frame = frame.rename(columns = DWC_COLUMNS).reindex(
+        columns = INGEST_COLUMNS)
+    for column in frame.columns:
+        if column not in NUMERIC_COLUMNS:
+            values = frame[column].fillna("").astype(str).str.strip()
+            frame[column] = values.where(values != "")
+    reasons = {}
+    for column in REQUIRED_COLUMNS:
+        reasons[f"missing {column}"] = frame[column].isna()
+    # Darwin Core dates may carry a time or be a range, the start day is kept
+    given = frame["observation_date"].notna()
+    frame["observation_date"] = pd.to_datetime(
+        frame["observation_date"].str[:10], format = "%Y-%m-%d",
+        errors = "coerce").dt.date
+    reasons["invalid observation_date"] = (
+        given & frame["observation_date"].isna())
+    for column in NUMERIC_COLUMNS:
+        given = frame[column].notna()
+        frame[column] = pd.to_numeric(frame[column], errors = "coerce")
+        reasons[f"invalid {column}"] = given & frame[column].isna()
+    count = frame["observation_count"]
+    reasons["invalid observation_count"] |= count.notna() & (
+        (count % 1 != 0) | (count < 0))
+    for column, limit in (("occurrence_latitude", 90),
+            ("occurrence_longitude", 180)):
+        reasons[f"invalid {column}"] |= frame[column].notna() & ~frame[
+            column].between(-limit, limit)
+    rejected = pd.concat(reasons, axis = 1)
+    invalid = rejected.any(axis = 1)
+    errors = []
+    for position in invalid.to_numpy().nonzero()[0][:INGEST_ERROR_SAMPLE]:
+        row = rejected.iloc[position]
+        errors.append(f"line {first_line + position + 1}: "
+            + ", ".join(row[row].index))
+    valid = frame[~invalid].astype(object)
+    valid = valid.where(valid.notna(), None)
+    valid["observation_count"] = [None if count is None else int(count)
+        for count in valid["observation_count"]]
+    records = list(valid.itertuples(index = False, name = None))
+    return records, int(invalid.sum()), errors
+
+
+class IngestRepository(BaseRepository):
+    """
+    All database actions associated with bulk loading occurrences
+    """
+    def __init__(self, db: Database) -> None:
+        super().__init__(db)
+        self.location_repo = LocationRepository(db)
+        self.summary_repo = SummaryRepository(db)
+
+    # Streams csv or Darwin Core rows into occurrences through a staging
+    # table, returns how many rows were loaded and rejected
+    async def ingest_occurrences(self, source: BinaryIO,
+            delimiter: str = ",", compression: Optional[str] = None,
+            batch_size: int = INGEST_BATCH_SIZE,
+            assign_locations: bool = True) -> IngestResult:
+        result = IngestResult()
+        # Darwin Core archives use unquoted tab separated text
+        reader = await run_in_threadpool(
+            pd.read_csv,
+            source,
+            sep = delimiter,
+            dtype = str,
+            keep_default_na = False,
+            na_values = [""],
+            quoting = csv.QUOTE_NONE if delimiter == "\t"
+                else csv.QUOTE_MINIMAL,
+            compression = compression,
+            chunksize = batch_size
+        )
+        line = 1
+        # Rows only reach occurrences if the whole load succeeds
+        try:
+            async with self.db.transaction():
+                await self.db.execute(query = CREATE_STAGING_TABLE_QUERY)
+                connection = self.db.connection().raw_connection
+                while True:
+                    frame = await run_in_threadpool(next, reader, None)
+                    if frame is None:
+                        break
+                    if line == 1:
+                        self.check_ingest_columns(columns = frame.columns)
+                    records, rejected, errors = await run_in_threadpool(
+                        validateOccurrenceBatch, frame, line)
+                    line += len(frame)
+                    result.rows_rejected += rejected
+                    result.errors += errors[:INGEST_ERROR_SAMPLE 
+                        - len(result.errors)]
+                    if records:
+                        await connection.copy_records_to_table(
+                            "occurrence_ingest",
+                            records = records,
+                            columns = INGEST_COLUMNS
+                        )
+                result.rows_loaded = await self.db.fetch_val(
+                    query = MERGE_STAGING_TABLE_QUERY)
+        finally:
+            reader.close()
+        # New occurrences are linked to the regions and rohe they fall in
+        if assign_locations and result.rows_loaded:
+            assignment = await self.location_repo.assign_locations(
+                dataset = "occurrence")
+            if not assignment.waiting:
+                result.locations_assigned = assignment.locations
+        # Months the load touched are re-aggregated for summaries
+        if result.rows_loaded:
+            refresh = await self.summary_repo.refresh_summaries(
+                dataset = "occurrence")
+            result.months_summarised = refresh.months
+        return result
+
+    # Loads a saved upload as ingest_occurrences does, removing the file
+    # once the load is over
+    async def ingest_occurrence_file(self, path: str,
+            delimiter: str = ",", compression: Optional[str] = None,
+            assign_locations: bool = True) -> IngestResult:
+        try:
+            with open(path, "rb") as source:
+                return await self.ingest_occurrences(
+                    source = source,
+                    delimiter = delimiter,
+                    compression = compression,
+                    assign_locations = assign_locations
+                )
+        finally:
+            await run_in_threadpool(os.remove, path)
+
+    # Checks the required columns are present under either naming
+    def check_ingest_columns(self, columns: List[str]) -> None:
+        present = {DWC_COLUMNS.get(column, column) for column in columns}
+        missing = [column for column in REQUIRED_COLUMNS
+            if column not in present]
+        if missing:
+            raise HTTPException(
+                status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+                detail = "Missing columns: " + ", ".join(missing)
+            )
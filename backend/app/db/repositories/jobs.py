@@ -0,0 +1,134 @@
+from typing import Optional, Union
+
+from app.core.config import EXPORT_JOB_HISTORY, EXPORT_MAX_RUNTIME
+from app.db.repositories.base import BaseRepository
+from app.models.export import ExportJob
+from app.models.ingest import IngestJob, IngestResult
+
+
+# Export Job Repository Actions
+
+
+# SQL Queries
+CREATE_JOB_QUERY = """
+    INSERT INTO main.export_job (job_id, kind, dataset, status, download_id)
+    VALUES (:job_id, :kind, :dataset, :status, :download_id)
+"""
+
+UPDATE_JOB_QUERY = """
+    UPDATE main.export_job
+    SET status = :status, download_id = :download_id, \
+        result = CAST(:result AS jsonb), error = :error, updated_at = now()
+    WHERE job_id = :job_id
+"""
+
+# Counts of a finished job are read from the export registry, so any
+# process can report the jobs another ran
+GET_JOB_QUERY = """
+    SELECT main.export_job.job_id, main.export_job.dataset, \
+        main.export_job.status, main.export_job.download_id, \
+        main.export.row_count, main.export.file_size, main.export_job.error
+    FROM main.export_job
+    LEFT JOIN main.export ON main.export.id = main.export_job.download_id
+    WHERE main.export_job.job_id = :job_id \
+        AND main.export_job.dataset = :dataset \
+        AND main.export_job.kind = 'export'
+"""
+
+GET_INGEST_JOB_QUERY = """
+    SELECT job_id, dataset, status, CAST(result AS text) AS result, error
+    FROM main.export_job
+    WHERE job_id = :job_id AND dataset = :dataset AND kind = 'ingest'
+"""
+
+# Jobs queued or running for longer than any could, whose process stopped
+# before they finished
+FAIL_ABANDONED_JOBS_QUERY = """
+    UPDATE main.export_job
+    SET status = 'failed', error = :error, updated_at = now()
+    WHERE status IN ('queued', 'running') \
+        AND created_at < now() - make_interval(secs => :max_runtime)
+"""
+
+# Forgets the oldest finished jobs beyond the history kept for polling
+DELETE_OLD_JOBS_QUERY = """
+    DELETE FROM main.export_job
+    WHERE job_id IN (
+        SELECT job_id FROM main.export_job
+        WHERE status IN ('done', 'failed')
+        ORDER BY updated_at DESC
+        OFFSET :history
+    )
+"""
+
+
+class ExportJobRepository(BaseRepository):
+    """
+    All database actions associated with the Export Job Table
+    """
+    # Records a new export or ingest job
+    async def create_job(self, job: Union[ExportJob, IngestJob]) -> None:
+        await self.db.execute(
+            query = CREATE_JOB_QUERY,
+            values = {
+                "job_id": job.job_id,
+                "kind": "ingest" if isinstance(job, IngestJob) else "export",
+                "dataset": job.dataset,
+                "status": job.status.value,
+                "download_id": getattr(job, "download_id", None)
+            }
+        )
+
+    # Records status, outcome and error of a job
+    async def update_job(self, job: Union[ExportJob, IngestJob]) -> None:
+        result = getattr(job, "result", None)
+        await self.db.execute(
+            query = UPDATE_JOB_QUERY,
+            values = {
+                "job_id": job.job_id,
+                "status": job.status.value,
+                "download_id": getattr(job, "download_id", None),
+                "result": result.json() if result else None,
+                "error": job.error
+            }
+        )
+
+    # Returns job of the given id and dataset if it exists
+    async def get_job(self, job_id: str, dataset: str
+            ) -> Optional[ExportJob]:
+        record = await self.db.fetch_one(
+            query = GET_JOB_QUERY,
+            values = {"job_id": job_id, "dataset": dataset}
+        )
+        if not record:
+            return None
+        return ExportJob(**record)
+
+    # Returns ingest job of the given id and dataset if it exists
+    async def get_ingest_job(self, job_id: str, dataset: str
+            ) -> Optional[IngestJob]:
+        record = await self.db.fetch_one(
+            query = GET_INGEST_JOB_QUERY,
+            values = {"job_id": job_id, "dataset": dataset}
+        )
+        if not record:
+            return None
+        job = IngestJob(**{**record, "result": None})
+        if record["result"]:
+            job.result = IngestResult.parse_raw(record["result"])
+        return job
+
+    # Fails jobs left unfinished by a crash and forgets old finished ones
+    async def expire_jobs(self, max_runtime: int = EXPORT_MAX_RUNTIME,
+            history: int = EXPORT_JOB_HISTORY) -> None:
+        await self.db.execute(
+            query = FAIL_ABANDONED_JOBS_QUERY,
+            values = {
+                "error": "Job was interrupted by a server restart",
+                "max_runtime": max_runtime
+            }
+        )
+        await self.db.execute(
+            query = DELETE_OLD_JOBS_QUERY,
+            values = {"history": history}
+        )
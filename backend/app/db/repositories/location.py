@@ -0,0 +1,247 @@
+from typing import BinaryIO, Union
+
+import pandas as pd
+from starlette.concurrency import run_in_threadpool
+
+from app.core.config import (
+    LOCATION_BATCH_SIZE, 
+    LOCATION_LOAD_BATCH_SIZE, 
+    LOCATION_SRID
+)
+from app.db.repositories.base import BaseRepository
+from app.db.schema import GET_INDEX_VALID_QUERY
+from app.models.location import LocationAssignment, LocationLoad
+
+
+# Location Assignment Repository Actions
+
+
+# Point table of each dataset, the link table its locations go into and the
+# unique index keeping its links from being inserted twice
+LOCATION_DATASETS = {
+    "occurrence": {
+        "table": "main.occurrence",
+        "link_table": "main.location",
+        "link_column": "occurrence_id",
+        "link_key": "location_location_key"
+    },
+    "mci": {
+        "table": "main.mci",
+        "link_table": "main.mci_location",
+        "link_column": "mci_id",
+        "link_key": "mci_location_location_key"
+    }
+}
+
+# SQL Queries
+
+# Full runs queue every point of the dataset again
+QUEUE_ALL_POINTS_QUERY = """
+    INSERT INTO main.location_pending (dataset, id)
+    SELECT CAST(:dataset AS text), id FROM {table}
+    ON CONFLICT DO NOTHING
+"""
+
+# Takes a batch of queued points off the queue and links each to every
+# polygon containing it in one statement, the polygon GiST index finding
+# candidates for each point. Skipping locked entries lets concurrent runs
+# take other batches, links the point no longer falls in are removed and
+# the months of points whose links changed are queued for summaries.
+ASSIGN_LOCATIONS_QUERY = """
+    WITH queued AS (
+        DELETE FROM main.location_pending
+        WHERE dataset = :dataset AND id IN (
+            SELECT id FROM main.location_pending
+            WHERE dataset = :dataset
+            ORDER BY id
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED)
+        RETURNING id
+    ), batch AS (
+        SELECT {table}.id, \
+            CAST(date_trunc('month', {table}.observation_date) AS date) \
+                AS month, \
+            ST_Transform(ST_SetSRID(ST_MakePoint(
+                occurrence_longitude, occurrence_latitude), 4326),
+                {srid}) AS point
+        FROM {table}
+        JOIN queued ON queued.id = {table}.id
+    ), located AS (
+        SELECT batch.id, main.locationref.name AS location_name
+        FROM batch
+        JOIN main.locationref
+            ON ST_Intersects(main.locationref.polygon, batch.point)
+    ), cleared AS (
+        DELETE FROM {link_table}
+        USING queued
+        WHERE {link_table}.{link_column} = queued.id
+        AND NOT EXISTS (
+            SELECT 1 FROM located
+            WHERE located.id = queued.id
+            AND located.location_name = {link_table}.location_name)
+        RETURNING {link_table}.{link_column} AS id
+    ), assigned AS (
+        INSERT INTO {link_table} ({link_column}, location_name)
+        SELECT id, location_name FROM located
+        ON CONFLICT DO NOTHING
+        RETURNING {link_column} AS id
+    ), relinked AS (
+        INSERT INTO main.summary_pending (dataset, month)
+        SELECT DISTINCT CAST(:dataset AS text), batch.month
+        FROM batch
+        WHERE batch.month IS NOT NULL
+        AND (batch.id IN (SELECT id FROM cleared)
+            OR batch.id IN (SELECT id FROM assigned))
+    )
+    SELECT (SELECT COUNT(*) FROM queued) AS points, \
+        (SELECT COUNT(*) FROM assigned) AS locations
+"""
+
+# Upserts a batch of polygons given as WKT, EWKT or hex WKB in one round
+# trip, repairing invalid geometries when asked and reporting the rest
+LOAD_LOCATIONS_QUERY = """
+    WITH source AS (
+        SELECT name, locationtype, CAST(polygon AS geometry) AS polygon
+        FROM unnest(CAST(:names AS text[]), CAST(:polygons AS text[]), \
+            CAST(:location_types AS text[])) AS rows(name, polygon, \
+            locationtype)
+    ), checked AS (
+        SELECT name, locationtype, ST_IsValid(polygon) AS valid, \
+            CASE WHEN ST_SRID(polygon) = 0 
+                THEN ST_SetSRID(polygon, {srid}) ELSE polygon END AS polygon
+        FROM source
+    ), loaded AS (
+        INSERT INTO main.locationref (name, polygon, locationtype)
+        SELECT name, CASE WHEN valid THEN polygon \
+            ELSE ST_CollectionExtract(ST_MakeValid(polygon), 3) END, \
+            locationtype
+        FROM checked
+        WHERE valid OR :repair
+        ON CONFLICT (name) DO {conflict_action}
+        RETURNING name
+    )
+    SELECT (SELECT COUNT(*) FROM loaded) AS loaded, \
+        (SELECT COUNT(*) FROM checked WHERE NOT valid AND :repair) \
+            AS repaired, \
+        (SELECT array_agg(name) FROM checked WHERE NOT valid AND NOT :repair) \
+            AS invalid
+"""
+
+# Action taken when a loaded location already exists
+LOAD_CONFLICT_ACTIONS = {
+    False: "NOTHING",
+    True: "UPDATE SET polygon = EXCLUDED.polygon, \
+        locationtype = EXCLUDED.locationtype"
+}
+
+# Builds location load query replacing or keeping existing locations
+def buildLoadLocationsQuery(update: bool) -> str:
+    return LOAD_LOCATIONS_QUERY.format(
+        srid = int(LOCATION_SRID),
+        conflict_action = LOAD_CONFLICT_ACTIONS[update]
+    )
+
+# Builds assignment query for the tables of a dataset
+def buildAssignLocationsQuery(dataset: str) -> str:
+    return ASSIGN_LOCATIONS_QUERY.format(
+        srid = int(LOCATION_SRID),
+        **LOCATION_DATASETS[dataset]
+    )
+
+
+class LocationRepository(BaseRepository):
+    """
+    All database actions associated with assigning points to locations
+    """
+    # Assigns the next batch of queued points, returns what was assigned
+    async def assign_location_batch(self, dataset: str,
+            batch_size: int = LOCATION_BATCH_SIZE) -> LocationAssignment:
+        record = await self.db.fetch_one(
+            query = buildAssignLocationsQuery(dataset = dataset),
+            values = {"dataset": dataset, "batch_size": batch_size}
+        )
+        return LocationAssignment(
+            dataset = dataset,
+            points = record["points"],
+            locations = record["locations"]
+        )
+
+    # Checks the unique key the assignment inserts links against is built
+    async def has_link_key(self, dataset: str) -> bool:
+        valid = await self.db.fetch_val(
+            query = GET_INDEX_VALID_QUERY,
+            values = {"name": LOCATION_DATASETS[dataset]["link_key"]}
+        )
+        return bool(valid)
+
+    # Assigns every point added or moved since the last run in batches
+    async def assign_locations(self, dataset: str,
+            batch_size: int = LOCATION_BATCH_SIZE,
+            full: bool = False) -> LocationAssignment:
+        # Full runs recheck every point, e.g. after polygons were added
+        if full:
+            await self.db.execute(
+                query = QUEUE_ALL_POINTS_QUERY.format(
+                    table = LOCATION_DATASETS[dataset]["table"]),
+                values = {"dataset": dataset}
+            )
+        total = LocationAssignment(dataset = dataset)
+        # Links are only inserted once their key is built in the background
+        # after startup, until then points stay queued for a later run
+        if not await self.has_link_key(dataset = dataset):
+            total.waiting = True
+            return total
+        while True:
+            batch = await self.assign_location_batch(
+                dataset = dataset,
+                batch_size = batch_size
+            )
+            total.points += batch.points
+            total.locations += batch.locations
+            if batch.points < batch_size:
+                return total
+
+    # Streams a csv of name, polygon and locationtype rows into the location
+    # references in batches within one transaction
+    async def load_locations(self, source: Union[str, BinaryIO],
+            update: bool = False, repair: bool = True,
+            batch_size: int = LOCATION_LOAD_BATCH_SIZE) -> LocationLoad:
+        result = LocationLoad()
+        query = buildLoadLocationsQuery(update = update)
+        # Polygon fields hold very long WKT, which the csv module limits
+        reader = await run_in_threadpool(
+            pd.read_csv,
+            source,
+            dtype = str,
+            keep_default_na = False,
+            usecols = ["name", "polygon", "locationtype"],
+            chunksize = batch_size
+        )
+        try:
+            async with self.db.transaction():
+                while True:
+                    frame = await run_in_threadpool(next, reader, None)
+                    if frame is None:
+                        break
+                    # One upsert cannot write a name twice, so the last row
+                    # of a repeated name is kept and the others skipped
+                    rows = frame.drop_duplicates(subset = "name", 
+                        keep = "last")
+                    record = await self.db.fetch_one(
+                        query = query,
+                        values = {
+                            "names": list(rows["name"]),
+                            "polygons": list(rows["polygon"]),
+                            "location_types": list(rows["locationtype"]),
+                            "repair": repair
+                        }
+                    )
+                    invalid = list(record["invalid"] or [])
+                    result.loaded += record["loaded"]
+                    result.repaired += record["repaired"]
+                    result.invalid += invalid
+                    result.skipped += (len(frame) - record["loaded"] 
+                        - len(invalid))
+        finally:
+            reader.close()
+        return result
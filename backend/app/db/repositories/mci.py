@@ -1,62 +1,118 @@
-import os
-import pandas as pd
-from typing import List
+from typing import List, Optional, Tuple
 from datetime import datetime
 
-from app.db.repositories.base import BaseRepository
-from app.models.filter import MCIFilter
+import pyarrow as pa
+from databases import Database
+from fastapi import HTTPException
+from starlette.status import (
+    HTTP_422_UNPROCESSABLE_ENTITY
+)
+
+from app.core.config import PAGE_SIZE, PREVIEW_SIZE
+from app.db.repositories.base import BaseRepository, buildWhereClause
+from app.db.repositories.compiler import FilterCompiler
+from app.db.repositories.export import ExportRepository
+from app.db.repositories.occurrence import escapeLikePattern
+from app.db.repositories.spatial import buildSpatialConditions
+from app.models.export import ExportFormat, ExportResult
+from app.models.filter import FilterStatementStats, MCIFilter
+from app.models.page import ChangesPage, Page
+from app.models.preview import Preview
 
 
 # MCI Repository Actions
 
 
-# SQL Queries
-GET_ALL_DATA_QUERY = """
-    SELECT * FROM main.mci
-"""
+# Typed columns written to MCI download files
+CATEGORY_TYPE = pa.dictionary(pa.int32(), pa.string())
+MCI_EXPORT_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("value", pa.float64()),
+    ("indicator", CATEGORY_TYPE),
+    ("observation_date", pa.date32()),
+    ("occurrence_latitude", pa.float64()),
+    ("occurrence_longitude", pa.float64()),
+    ("river_catchment", CATEGORY_TYPE),
+    ("landcover_type", CATEGORY_TYPE),
+    ("created_at", pa.timestamp("us", tz = "UTC")),
+    ("updated_at", pa.timestamp("us", tz = "UTC"))
+])
 
+# Compiled statements of the MCI filter queries, shared by every request
+MCI_FILTER_COMPILER = FilterCompiler()
+
+# SQL Queries
 GET_DATA_BY_FILTER = """
     SELECT main.mci.id, main.mci.value, main.mci.indicator, \
         main.mci.observation_date, main.mci.occurrence_latitude, \
         main.mci.occurrence_longitude, main.mci.river_catchment, \
         main.mci.landcover_type, main.mci.created_at, main.mci.updated_at
-	FROM main.mci, main.mci_location, main.locationref
-    WHERE main.mci.id = main.mci_location.mci_id
-	AND main.mci_location.location_name = main.locationref.name"""
+	FROM main.mci"""
 
 # Location query builder
-def buildLocationQueryLine(location_name: str, location_type: str) :
-    query = "        AND "
+def buildLocationCondition(location_name: str, location_type: str) -> str:
+    # Semi-join keeps one row per measurement however many locations match
+    query = "EXISTS (SELECT 1 FROM main.mci_location"
+    if location_type:
+        query += "\n            JOIN main.locationref ON \
+            main.mci_location.location_name = main.locationref.name"
+    query += "\n            WHERE main.mci_location.mci_id = main.mci.id"
+    # Names and types compare case folded so their indexes serve them
     if location_name:
-        query += "main.mci_location.location_name = :location_name"
+        query += "\n            AND LOWER(main.mci_location.location_name) \
+            = LOWER(:location_name)"
     if location_type:
-        query += "main.locationref.locationtype = :location_type"
+        query += "\n            AND LOWER(main.locationref.locationtype) = \
+            LOWER(:location_type)"
+    query += ")"
     return query
 
 
 # Observation date query builder
-def buildObservationDateQueryLine() :
-    query = "        AND main.mci.observation_date >= :startDate AND \
+def buildObservationDateCondition() -> str:
+    return "main.mci.observation_date >= :startDate AND \
         main.mci.observation_date <= :endDate"
-    return query
 
 
 class MCIRepository(BaseRepository):
     """"
     All database actions associated with the MCI Table
     """
-    # Returns all data
-    async def get_all_data(self) -> List[dict]:    
-        data = await self.db.fetch_all(query = GET_ALL_DATA_QUERY)
-        if not data:
-            return None
-        return data
+    def __init__(self, db: Database) -> None:
+        super().__init__(db)
+        self.export_repo = ExportRepository(db)
 
-    # Creates download by filter given and returns download id
-    async def get_data_by_filter(self, filter: MCIFilter):
-        query = GET_DATA_BY_FILTER
+    # Returns page of MCI data following the cursor given
+    async def get_data_page(self, cursor: Optional[str] = None,
+            limit: int = PAGE_SIZE, fields: Optional[str] = None) -> Page:
+        return await self.fetch_page(
+            table = "main.mci",
+            columns = MCI_EXPORT_SCHEMA.names,
+            cursor = cursor,
+            limit = limit,
+            fields = fields
+        )
+
+    # Returns MCI data inserted or updated after the sync token given
+    async def get_data_changes(self, token: Optional[str] = None,
+            since: Optional[datetime] = None, limit: int = PAGE_SIZE,
+            fields: Optional[str] = None) -> ChangesPage:
+        return await self.fetch_changes(
+            table = "main.mci",
+            columns = MCI_EXPORT_SCHEMA.names,
+            token = token,
+            since = since,
+            limit = limit,
+            fields = fields
+        )
+
+    # Builds conditions a filter puts on MCI data and the arguments they
+    # bind, validating the filter
+    def build_filter_conditions(self, filter: MCIFilter
+            ) -> Tuple[List[str], dict]:
+        conditions = []
         args = {}
-        # If no filer, returns all data
+        # If no filer, all data is matched
         if (not filter.startValue 
                 and not filter.endValue 
                 and not filter.indicator 
@@ -66,70 +122,99 @@ class MCIRepository(BaseRepository):
                 and not filter.location_name 
                 and not filter.location_type 
                 and not filter.landcover_type 
-                and not filter.river_catchment):
-            mcidata = await self.get_all_data()
-        # Build query based on filter
-        else:
-            if filter.startValue and filter.endValue:
-                query += "\n"
-                query += "        AND main.mci.value >= :startValue AND \
-                    main.mci.value <= :endValue"
-                args["startValue"] = filter.startValue
-                args["endValue"] = filter.endValue
-            if filter.indicator:
-                query += "\n"
-                query += "        AND LOWER(main.mci.indicator) = \
-                    LOWER(:indicator)"
-                args["indicator"] = filter.indicator
-            if filter.river_catchment:
-                query += "\n"
-                query += "        AND main.mci.river_catchment ~* \
-                    :river_catchment"
-                args["river_catchment"] = filter.river_catchment
-            if filter.landcover_type:
-                query += "\n"
-                query += "        AND main.mci.landcover_type ~* \
-                    :landcover_type"
-                args["landcover_type"] = filter.landcover_type
-            if filter.year and filter.year != 0:
-                filter.startDate = str(filter.year) + "-01-01"
-                filter.endDate = str(filter.year) + "-12-31"              
-            if filter.startDate and filter.endDate:
+                and not filter.river_catchment
+                and not filter.bbox
+                and not filter.geometry):
+            return conditions, args
+        # Build conditions based on filter
+        if filter.startValue and filter.endValue:
+            conditions.append("main.mci.value >= :startValue AND \
+                main.mci.value <= :endValue")
+            args["startValue"] = filter.startValue
+            args["endValue"] = filter.endValue
+        if filter.indicator:
+            conditions.append("LOWER(main.mci.indicator) = LOWER(:indicator)")
+            args["indicator"] = filter.indicator
+        # Catchments match by case folded prefix, served by a pattern index
+        if filter.river_catchment:
+            conditions.append("LOWER(main.mci.river_catchment) LIKE \
+                LOWER(:river_catchment)")
+            args["river_catchment"] = escapeLikePattern(
+                filter.river_catchment) + "%"
+        if filter.landcover_type:
+            conditions.append(
+                "LOWER(main.mci.landcover_type) = LOWER(:landcover_type)")
+            args["landcover_type"] = filter.landcover_type
+        if filter.year and filter.year != 0:
+            filter.startDate = str(filter.year) + "-01-01"
+            filter.endDate = str(filter.year) + "-12-31"              
+        if filter.startDate and filter.endDate:
+            try:
                 startDate = datetime.strptime(filter.startDate, '%Y-%m-%d')
                 endDate = datetime.strptime(filter.endDate, '%Y-%m-%d')
-                query += "\n"
-                query += buildObservationDateQueryLine()
-                args["startDate"] = startDate
-                args["endDate"] = endDate
+            except ValueError:
+                raise HTTPException(
+                    status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail = "Not a valid date format"
+                )
+            conditions.append(buildObservationDateCondition())
+            args["startDate"] = startDate
+            args["endDate"] = endDate
+        # Name and type must hold for the same location of a measurement
+        if filter.location_name or filter.location_type:
+            conditions.append(buildLocationCondition(filter.location_name, 
+                filter.location_type))
             if filter.location_name:
-                query += "\n"
-                query += buildLocationQueryLine(filter.location_name, "")
                 args["location_name"] = filter.location_name
             if filter.location_type:
-                query += "\n"
-                query += buildLocationQueryLine("", filter.location_type)
                 args["location_type"] = filter.location_type
-            mcidata = await self.db.fetch_all(query, args)
-        i = 0
-        # Finds latest download number
-        path = "./mci_download/"
-        while os.path.exists(path + f"file_{i}.csv"):  
-            i += 1
-        path = path + f"file_{i}.csv"
-        # Saves download file
-        download = pd.DataFrame(mcidata, columns = [
-            "id", 
-            "value", 
-            "indicator", 
-            "observation_date", 
-            "occurrence_latitude", 
-            "occurrence_longitude", 
-            "river_catchment", 
-            "landcover_type", 
-            "created_at", 
-            "updated_at"
-        ])
-        download.to_csv(path, index = False)
-        # Returns download ID
-        return i
-    
\ No newline at end of file
+        # Spatial filters match the indexed point of each row
+        spatial_conditions, spatial_args = buildSpatialConditions(
+            table = "main.mci",
+            filter = filter
+        )
+        conditions += spatial_conditions
+        args.update(spatial_args)
+        return conditions, args
+
+    # Builds filter query and arguments from the filter given, selecting
+    # the export columns unless another select is given
+    def build_filter_query(self, filter: MCIFilter,
+            select: str = GET_DATA_BY_FILTER) -> Tuple[str, dict]:
+        conditions, args = self.build_filter_conditions(filter = filter)
+        return select + buildWhereClause(conditions), args
+
+    # Creates download by filter given and returns download id
+    async def get_data_by_filter(self, filter: MCIFilter, 
+            owner: Optional[str] = None,
+            format: ExportFormat = ExportFormat.csv) -> ExportResult:
+        query, args = self.build_filter_query(filter)
+        # Streams filtered rows from a cursor into a registered download file
+        return await self.export_repo.write_export(
+            dataset = "mci",
+            filter = filter,
+            owner = owner,
+            format = format,
+            schema = MCI_EXPORT_SCHEMA,
+            batches = self.iterate_compiled(
+                compiler = MCI_FILTER_COMPILER,
+                query = query,
+                values = args
+            )
+        )
+
+    # Returns count and first rows of the MCI data the filter matches
+    async def preview_data(self, filter: MCIFilter,
+            limit: int = PREVIEW_SIZE) -> Preview:
+        query, args = self.build_filter_query(filter = filter)
+        return await self.preview_filter(
+            compiler = MCI_FILTER_COMPILER,
+            query = query,
+            values = args,
+            limit = limit
+        )
+
+    # Returns how often compiled filter statements were reused, in this
+    # process and by Postgres
+    async def get_filter_statement_stats(self) -> FilterStatementStats:
+        return await self.get_statement_stats(compiler = MCI_FILTER_COMPILER)
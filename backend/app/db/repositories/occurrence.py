@@ -1,26 +1,60 @@
-import os
-import pandas as pd
-from typing import List
+from typing import List, Optional, Tuple
 from datetime import datetime
 
+import pyarrow as pa
+from databases import Database
 from fastapi import HTTPException
 from starlette.status import (
     HTTP_422_UNPROCESSABLE_ENTITY
 )
 
-from app.db.repositories.base import BaseRepository
-from app.models.filter import Filter
+from app.core.config import (
+    PAGE_SIZE, 
+    PREVIEW_SIZE, 
+    TAXONOMY_TRIGRAM_INDEXES
+)
+from app.db.repositories.base import BaseRepository, buildWhereClause
+from app.db.repositories.compiler import FilterCompiler
+from app.db.repositories.export import ExportRepository
+from app.db.repositories.spatial import buildSpatialConditions
+from app.models.export import ExportFormat, ExportResult
+from app.models.filter import Filter, FilterStatementStats, TaxonomyMatch
 from app.models.occurrence import OccurrenceCreate, OccurrencePublic
+from app.models.page import ChangesPage, Page
+from app.models.preview import Preview
 
 
 # Occurrence Repository Actions
 
 
-# SQL Queries
-GET_ALL_OCCURRENCES_QUERY = """
-    SELECT * FROM main.occurrence
-"""
+# Typed columns written to occurrence download files
+TAXONOMY_TYPE = pa.dictionary(pa.int32(), pa.string())
+OCCURRENCE_EXPORT_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("scientific_name", TAXONOMY_TYPE),
+    ("observation_count", pa.int64()),
+    ("observation_date", pa.date32()),
+    ("occurrence_latitude", pa.float64()),
+    ("occurrence_longitude", pa.float64()),
+    ("occurrence_elevation", pa.float64()),
+    ("occurrence_depth", pa.float64()),
+    ("taxon_rank", TAXONOMY_TYPE),
+    ("infraspecific_epithet", pa.string()),
+    ("occurrence_species", TAXONOMY_TYPE),
+    ("occurrence_genus", TAXONOMY_TYPE),
+    ("occurrence_family", TAXONOMY_TYPE),
+    ("occurrence_order", TAXONOMY_TYPE),
+    ("occurrence_class", TAXONOMY_TYPE),
+    ("occurrence_phylum", TAXONOMY_TYPE),
+    ("occurrence_kingdom", TAXONOMY_TYPE),
+    ("created_at", pa.timestamp("us", tz = "UTC")),
+    ("updated_at", pa.timestamp("us", tz = "UTC"))
+])
+
+# Compiled statements of the occurrence filter queries, shared by every request
+OCCURRENCE_FILTER_COMPILER = FilterCompiler()
 
+# SQL Queries
 GET_OCCURRENCES_BY_FILTER_QUERY = """
     SELECT main.occurrence.id, main.occurrence.scientific_name, \
         main.occurrence.observation_count, main.occurrence.observation_date, \
@@ -34,10 +68,14 @@ GET_OCCURRENCES_BY_FILTER_QUERY = """
         main.occurrence.occurrence_class, main.occurrence.occurrence_phylum, \
         main.occurrence.occurrence_kingdom, main.occurrence.created_at, \
         main.occurrence.updated_at
-	FROM main.occurrence 
-    LEFT JOIN main.location ON main.occurrence.id = main.location.occurrence_id
-    LEFT JOIN main.locationref ON main.location.location_name = \
-        main.locationref.name"""
+	FROM main.occurrence"""
+
+# Columns of the points drawn on map tiles and counted in density grids
+GET_OCCURRENCE_POINTS_BY_FILTER_QUERY = """
+    SELECT main.occurrence.id, main.occurrence.scientific_name, \
+        main.occurrence.observation_count, main.occurrence.observation_date, \
+        main.occurrence.occurrence_species, main.occurrence.geom
+	FROM main.occurrence"""
 
 INSERT_OCCURRENCE_QUERY = """
     INSERT INTO main.occurrence (scientific_name, observation_count, \
@@ -72,83 +110,98 @@ GET_OCCURRENCE_BY_ID = """
     WHERE id = :id
 """
 
-ADD_LOCATION_QUERY = """
-    INSERT INTO main.locationref (name, polygon, locationtype)
-    VALUES (:name, :polygon, :locationtype)
-    RETURNING name
-"""
+# Column each classification level filters on, scientific name by default
+CLASSIFICATION_COLUMNS = {
+    "": "scientific_name",
+    "kingdom": "occurrence_kingdom",
+    "phylum": "occurrence_phylum",
+    "class": "occurrence_class",
+    "order": "occurrence_order",
+    "family": "occurrence_family",
+    "genus": "occurrence_genus",
+    "species": "occurrence_species"
+}
 
-RETRIEVE_LOCATION_QUERY = """
-    SELECT name FROM main.locationref WHERE name = :name
-"""
+# Escapes LIKE wildcards so names are matched literally
+def escapeLikePattern(value: str) -> str:
+    return (value.replace("\\", "\\\\").replace("%", "\\%")
+        .replace("_", "\\_"))
 
 # Classification query builder
-def buildClassificationQueryLine(classification_level: str, first: bool):
-    if(first):
-        query = "        WHERE"
-    else:
-        query = "        AND"
-    if classification_level == 'phylum':
-        query += " main.occurrence.occurrence_phylum ~* \
-            :classification_name"
-    if classification_level == 'kingdom':
-        query += " main.occurrence.occurrence_kingdom ~* \
-            :classification_name"
-    if classification_level == 'order':
-        query += " main.occurrence.occurrence_order ~* \
-            :classification_name"
-    if classification_level == 'class':
-        query += " main.occurrence.occurrence_class ~* \
-            :classification_name"
-    if classification_level == 'family':
-        query += " main.occurrence.occurrence_family ~* \
-            :classification_name"
-    if classification_level == 'genus':
-        query += " main.occurrence.occurrence_genus ~* \
-            :classification_name"
-    if classification_level == 'species':
-        query += " main.occurrence.occurrence_species ~* \
-            :classification_name"
-    if not classification_level:
-        query += " main.occurrence.scientific_name ~* \
-            :classification_name"
-    return query
+def buildClassificationCondition(classification_level: str, 
+        classification_match: TaxonomyMatch) -> str:
+    # Predicates compare LOWER(column) so the case folded indexes serve them
+    column = "main.occurrence." + CLASSIFICATION_COLUMNS[classification_level]
+    if classification_match == TaxonomyMatch.exact:
+        return f"LOWER({column}) = LOWER(:classification_name)"
+    return f"LOWER({column}) LIKE LOWER(:classification_pattern)"
+
+# Builds arguments the classification condition binds
+def buildClassificationArgs(classification_name: str, 
+        classification_match: TaxonomyMatch) -> dict:
+    if classification_match == TaxonomyMatch.exact:
+        return {"classification_name": classification_name}
+    pattern = escapeLikePattern(classification_name) + "%"
+    if classification_match == TaxonomyMatch.contains:
+        pattern = "%" + pattern
+    return {"classification_pattern": pattern}
 
 # Location Query Builder
-def buildLocationQueryLine(location_name: str, location_type: str, first: bool):
-    if(first):
-        query = "        WHERE"
-    else:
-        query = "        AND"
+def buildLocationCondition(location_name: str, location_type: str) -> str:
+    # Semi-join keeps one row per occurrence however many locations match
+    query = "EXISTS (SELECT 1 FROM main.location"
+    if(location_type):
+        query += "\n            JOIN main.locationref ON \
+            main.location.location_name = main.locationref.name"
+    query += "\n            WHERE main.location.occurrence_id = \
+            main.occurrence.id"
     if(location_name):
-        query += " LOWER(main.location.location_name) = \
+        query += "\n            AND LOWER(main.location.location_name) = \
             LOWER(:location_name)"
     if(location_type):
-        query += " LOWER(main.locationref.locationtype) = \
+        query += "\n            AND LOWER(main.locationref.locationtype) = \
             LOWER(:location_type)"
+    query += ")"
     return query
 
 # Observation date query builder
-def buildObservationDateQueryLine(first: bool):
-    if(first):
-        query = "        WHERE"
-    else:
-        query = "        AND"
-    query += " main.occurrence.observation_date >= :startDate AND \
+def buildObservationDateCondition() -> str:
+    return "main.occurrence.observation_date >= :startDate AND \
         main.occurrence.observation_date <= :endDate"
-    return query
 
 
 class OccurrenceRepository(BaseRepository):
     """"
     All database actions associated with the Occurrence Table
     """
-    # Returns all data
-    async def get_all_occurrences(self) -> List[dict]:    
-        occurrences = await self.db.fetch_all(query=GET_ALL_OCCURRENCES_QUERY)
-        if not occurrences:
-            return None
-        return occurrences
+    def __init__(self, db: Database) -> None:
+        super().__init__(db)
+        self.export_repo = ExportRepository(db)
+
+    # Returns page of occurrences following the cursor given
+    async def get_occurrences_page(self, cursor: Optional[str] = None,
+            limit: int = PAGE_SIZE, fields: Optional[str] = None) -> Page:
+        return await self.fetch_page(
+            table = "main.occurrence",
+            columns = OCCURRENCE_EXPORT_SCHEMA.names,
+            cursor = cursor,
+            limit = limit,
+            fields = fields
+        )
+
+
+    # Returns occurrences inserted or updated after the sync token given
+    async def get_occurrence_changes(self, token: Optional[str] = None,
+            since: Optional[datetime] = None, limit: int = PAGE_SIZE,
+            fields: Optional[str] = None) -> ChangesPage:
+        return await self.fetch_changes(
+            table = "main.occurrence",
+            columns = OCCURRENCE_EXPORT_SCHEMA.names,
+            token = token,
+            since = since,
+            limit = limit,
+            fields = fields
+        )
     
     # Creates Occurrence for Testing Purposes
     async def create_occurrence(self, occurrence: OccurrenceCreate
@@ -167,141 +220,133 @@ class OccurrenceRepository(BaseRepository):
         )
         return occurrence
 
-    # Creates download by filter given and returns download id
-    async def get_occurrences_by_filter(self, filter: Filter) -> List[dict]:
-        query = GET_OCCURRENCES_BY_FILTER_QUERY
+    # Builds conditions a filter puts on occurrences and the arguments they
+    # bind, validating the filter
+    def build_filter_conditions(self, filter: Filter
+            ) -> Tuple[List[str], dict]:
+        conditions = []
         args = {}
-        first = True
-        # If no filter, returns all data
+        # If no filter, all data is matched
         if ((not filter.classification_level)
                 and (not filter.classification_name)
                 and (not filter.startDate)
                 and (not filter.endDate)
                 and ((not filter.year) or (filter.year == 0))
                 and (not filter.location_name)
-                and (not filter.location_type)):
-            occurrences = await self.get_all_occurrences()
-        # Build query based on filter
-        else:
-            if(filter.classification_name):
-                if(filter.classification_level):
-                    classification_level = filter.classification_level.casefold()
-                    if(classification_level not in ["phylum", "kingdom", "class", 
-                            "order", "family", "genus", "species"]):
-                        raise HTTPException(
-                            status_code = HTTP_422_UNPROCESSABLE_ENTITY,
-                            detail = "Not a valid classification level"
-                        )
-                    else:
-                        query += "\n"
-                        query += buildClassificationQueryLine(
-                            classification_level = classification_level,
-                            first = first)              
-                        args["classification_name"] = filter.classification_name
-                        first = False
-                else:
-                    query += "\n"
-                    query += buildClassificationQueryLine(
-                        classification_level = filter.classification_level,
-                        first = first)              
-                    args["classification_name"] = filter.classification_name
-                    first = False
-            if(filter.year) and (filter.year != 0):
-                filter.startDate = str(filter.year) + "-01-01"
-                filter.endDate = str(filter.year) + "-12-31"              
-            if(filter.startDate) and (filter.endDate):
-                try:
-                    startDate = datetime.strptime(filter.startDate, '%Y-%m-%d')
-                    endDate = datetime.strptime(filter.endDate, '%Y-%m-%d')
-                except ValueError:
-                    raise HTTPException(
-                        status_code = HTTP_422_UNPROCESSABLE_ENTITY,
-                        detail = "Not a valid date format"
-                    )
-                query += "\n"
-                query += buildObservationDateQueryLine(first = first)
-                args["startDate"] = startDate
-                args["endDate"] = endDate
-                first = False
-            if(filter.location_name):
-                query += "\n"
-                query += buildLocationQueryLine(
-                    location_name = filter.location_name, 
-                    location_type = "",
-                    first = first)
-                args["location_name"] = filter.location_name
-                first = False
-            if(filter.location_type):
-                location_type = filter.location_type.casefold()
-                if(location_type not in ["region", "rohe"]):
-                    raise HTTPException(
-                        status_code = HTTP_422_UNPROCESSABLE_ENTITY,
-                        detail = "Not a valid location type"
-                    )
-                else:
-                    query += "\n"
-                    query += buildLocationQueryLine(
-                        location_name = "", 
-                        location_type = location_type,
-                        first = first)
-                    args["location_type"] = location_type
-                    first = False
-            occurrences = await self.db.fetch_all(query, args)
-        return occurrences
+                and (not filter.location_type)
+                and (not filter.bbox)
+                and (not filter.geometry)):
+            return conditions, args
+        # Build conditions based on filter
+        if(filter.classification_name):
+            classification_level = filter.classification_level.casefold()
+            if(classification_level not in CLASSIFICATION_COLUMNS):
+                raise HTTPException(
+                    status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail = "Not a valid classification level"
+                )
+            # Substring matches are only served by the opt in trigram indexes
+            if(filter.classification_match == TaxonomyMatch.contains 
+                    and not TAXONOMY_TRIGRAM_INDEXES):
+                raise HTTPException(
+                    status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail = "Substring classification matching is disabled"
+                )
+            conditions.append(buildClassificationCondition(
+                classification_level = classification_level,
+                classification_match = filter.classification_match))
+            args.update(buildClassificationArgs(
+                classification_name = filter.classification_name,
+                classification_match = filter.classification_match))
+        if(filter.year) and (filter.year != 0):
+            filter.startDate = str(filter.year) + "-01-01"
+            filter.endDate = str(filter.year) + "-12-31"              
+        if(filter.startDate) and (filter.endDate):
+            try:
+                startDate = datetime.strptime(filter.startDate, '%Y-%m-%d')
+                endDate = datetime.strptime(filter.endDate, '%Y-%m-%d')
+            except ValueError:
+                raise HTTPException(
+                    status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail = "Not a valid date format"
+                )
+            conditions.append(buildObservationDateCondition())
+            args["startDate"] = startDate
+            args["endDate"] = endDate
+        if(filter.location_type):
+            location_type = filter.location_type.casefold()
+            if(location_type not in ["region", "rohe"]):
+                raise HTTPException(
+                    status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail = "Not a valid location type"
+                )
+            args["location_type"] = location_type
+        if(filter.location_name):
+            args["location_name"] = filter.location_name
+        # Name and type must hold for the same location of an occurrence
+        if(filter.location_name or filter.location_type):
+            conditions.append(buildLocationCondition(
+                location_name = filter.location_name, 
+                location_type = filter.location_type))
+        # Spatial filters match the indexed point of each row
+        spatial_conditions, spatial_args = buildSpatialConditions(
+            table = "main.occurrence",
+            filter = filter
+        )
+        conditions += spatial_conditions
+        args.update(spatial_args)
+        return conditions, args
 
-    # Create filtered download file
-    async def create_filtered_download(self, filter: Filter):
-        i = 0
-        occurrences = await self.get_occurrences_by_filter(filter = filter)
-        # Finds latest download number
-        path = "./occurrence_download/"
-        while os.path.exists(path + f"file_{i}.csv"):  
-            i += 1
-        path = path + f"file_{i}.csv"
-        # Saves download file
-        download = pd.DataFrame(occurrences, columns=[
-            "id", 
-            "scientific_name", 
-            "observation_count", 
-            "observation_date", 
-            "occurrence_latitude", 
-            "occurrence_longitude", 
-            "occurrence_elevation", 
-            "occurrence_depth", 
-            "taxon_rank", 
-            "infraspecific_epithet", 
-            "occurrence_species", 
-            "occurrence_genus", 
-            "occurrence_family", 
-            "occurrence_order", 
-            "occurrence_class", 
-            "occurrence_phylum", 
-            "occurrence_kingdom", 
-            "created_at", 
-            "updated_at"])
-        download.to_csv(path, index=False)
-        # Returns download id
-        return i
-    
-    async def add_location(self, name: str, polygon: str, location_type: str):
-        location_exists = await self.db.fetch_one(
-            query = RETRIEVE_LOCATION_QUERY,
-            values = {
-                'name': name
-            }
+    # Builds filter query and arguments from the filter given, selecting
+    # the export columns unless another select is given
+    def build_filter_query(self, filter: Filter,
+            select: str = GET_OCCURRENCES_BY_FILTER_QUERY
+            ) -> Tuple[str, dict]:
+        conditions, args = self.build_filter_conditions(filter = filter)
+        return select + buildWhereClause(conditions), args
+
+    # Retrieves occurrences matching the filter given
+    async def get_occurrences_by_filter(self, filter: Filter) -> List[dict]:
+        query, args = self.build_filter_query(filter = filter)
+        occurrences = await self.fetch_compiled(
+            compiler = OCCURRENCE_FILTER_COMPILER,
+            query = query,
+            values = args
         )
-        if not location_exists:
-            args = {
-                'name' : name,
-                'polygon' : polygon,
-                'locationtype' : location_type
-            }
-            location = await self.db.fetch_one(
-                query = ADD_LOCATION_QUERY,
+        return occurrences
+
+    # Create filtered download file and returns download id
+    async def create_filtered_download(self, filter: Filter, 
+            owner: Optional[str] = None,
+            format: ExportFormat = ExportFormat.csv) -> ExportResult:
+        query, args = self.build_filter_query(filter = filter)
+        # Streams filtered rows from a cursor into a registered download file
+        return await self.export_repo.write_export(
+            dataset = "occurrence",
+            filter = filter,
+            owner = owner,
+            format = format,
+            schema = OCCURRENCE_EXPORT_SCHEMA,
+            batches = self.iterate_compiled(
+                compiler = OCCURRENCE_FILTER_COMPILER,
+                query = query,
                 values = args
             )
-            return location
-        else:
-            return None
-        
-        
\ No newline at end of file
+        )
+
+    # Returns count and first rows of the occurrences the filter matches
+    async def preview_occurrences(self, filter: Filter,
+            limit: int = PREVIEW_SIZE) -> Preview:
+        query, args = self.build_filter_query(filter = filter)
+        return await self.preview_filter(
+            compiler = OCCURRENCE_FILTER_COMPILER,
+            query = query,
+            values = args,
+            limit = limit
+        )
+
+    # Returns how often compiled filter statements were reused, in this
+    # process and by Postgres
+    async def get_filter_statement_stats(self) -> FilterStatementStats:
+        return await self.get_statement_stats(
+            compiler = OCCURRENCE_FILTER_COMPILER)
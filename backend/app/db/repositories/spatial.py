@@ -0,0 +1,164 @@
+import json
+import math
+import re
+from typing import List, Tuple
+
+from fastapi import HTTPException
+from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY
+
+from app.models.filter import ExportFilter
+
+
+# Spatial Filter Query Builders
+
+# Geometry types a filter area can be given as
+AREA_GEOMETRY_TYPES = ["POLYGON", "MULTIPOLYGON"]
+
+# Raises error for a filter area that cannot be used
+def raiseInvalidArea(detail: str):
+    raise HTTPException(
+        status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+        detail = detail
+    )
+
+# Validates bounding box, returns its bound arguments
+def buildBoundingBoxArgs(bbox: list) -> dict:
+    if len(bbox) != 4:
+        raiseInvalidArea("Bounding box needs min lon, min lat, max lon and "
+            "max lat")
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if (min_lon >= max_lon or min_lat >= max_lat
+            or not (-180 <= min_lon and max_lon <= 180)
+            or not (-90 <= min_lat and max_lat <= 90)):
+        raiseInvalidArea("Not a valid bounding box")
+    return {
+        "bbox_min_lon": min_lon,
+        "bbox_min_lat": min_lat,
+        "bbox_max_lon": max_lon,
+        "bbox_max_lat": max_lat
+    }
+
+# Parentheses, commas and the words between them in WKT text
+WKT_TOKEN_PATTERN = re.compile(r"\s*([(),]|[^\s(),]+)")
+
+# Parses WKT POLYGON or MULTIPOLYGON into its type and GeoJSON style
+# coordinates, raises ValueError if the text is malformed
+def parseWktArea(wkt: str) -> Tuple[str, list]:
+    tokens = WKT_TOKEN_PATTERN.findall(wkt.strip())
+    position = 0
+    def take(expected: str = None) -> str:
+        nonlocal position
+        if position >= len(tokens):
+            raise ValueError("WKT ended early")
+        token = tokens[position]
+        if expected and token != expected:
+            raise ValueError(f"Expected {expected} in WKT")
+        position += 1
+        return token
+    def takeList(takeItem) -> list:
+        take("(")
+        items = [takeItem()]
+        while position < len(tokens) and tokens[position] == ",":
+            take(",")
+            items.append(takeItem())
+        take(")")
+        return items
+    def takePosition() -> list:
+        return [float(take()), float(take())]
+    geometry_type = take().upper()
+    if geometry_type == "POLYGON":
+        coordinates = takeList(lambda: takeList(takePosition))
+    elif geometry_type == "MULTIPOLYGON":
+        coordinates = takeList(lambda: takeList(lambda: takeList(
+            takePosition)))
+    else:
+        raise ValueError("Not a WKT POLYGON or MULTIPOLYGON")
+    if position != len(tokens):
+        raise ValueError("Unexpected text after WKT")
+    return geometry_type, coordinates
+
+# Checks a position is a longitude and latitude within WGS 84 bounds, with
+# an optional elevation
+def isValidPosition(position) -> bool:
+    if not isinstance(position, list) or len(position) not in (2, 3):
+        return False
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool)
+            and math.isfinite(value) for value in position):
+        return False
+    return -180 <= position[0] <= 180 and -90 <= position[1] <= 90
+
+# Checks polygon rings are closed and have at least four positions
+def isValidPolygon(rings) -> bool:
+    if not isinstance(rings, list) or not rings:
+        return False
+    for ring in rings:
+        if (not isinstance(ring, list) or len(ring) < 4
+                or not all(isValidPosition(position) for position in ring)
+                or ring[0][:2] != ring[-1][:2]):
+            return False
+    return True
+
+# Checks coordinates of a POLYGON or MULTIPOLYGON could be built by PostGIS
+def isValidArea(geometry_type: str, coordinates) -> bool:
+    if geometry_type == "POLYGON":
+        return isValidPolygon(coordinates)
+    return (isinstance(coordinates, list) and bool(coordinates)
+        and all(isValidPolygon(polygon) for polygon in coordinates))
+
+# Validates WKT or GeoJSON area, returns its format and text to bind. Areas
+# are parsed here so malformed ones are refused before they reach PostGIS.
+def buildGeometryArgs(geometry) -> Tuple[str, dict]:
+    if isinstance(geometry, dict):
+        # Features are filtered by their geometry
+        if str(geometry.get("type", "")).upper() == "FEATURE":
+            geometry = geometry.get("geometry") or {}
+        geometry_type = str(geometry.get("type", "")).upper()
+        if (geometry_type not in AREA_GEOMETRY_TYPES
+                or not isValidArea(geometry_type,
+                    geometry.get("coordinates"))):
+            raiseInvalidArea("Geometry must be a valid GeoJSON Polygon or "
+                "MultiPolygon")
+        return "geojson", {"geometry": json.dumps(geometry)}
+    try:
+        geometry_type, coordinates = parseWktArea(wkt = geometry)
+    except ValueError:
+        geometry_type, coordinates = None, None
+    if (geometry_type not in AREA_GEOMETRY_TYPES
+            or not isValidArea(geometry_type, coordinates)):
+        raiseInvalidArea("Geometry must be a valid WKT POLYGON or "
+            "MULTIPOLYGON")
+    return "wkt", {"geometry": geometry.strip()}
+
+# Bounding box condition, served by the GiST index on the point
+def buildBoundingBoxCondition(table: str) -> str:
+    return f"{table}.geom && ST_MakeEnvelope(:bbox_min_lon, \
+        :bbox_min_lat, :bbox_max_lon, :bbox_max_lat, 4326)"
+
+# Builds the filter area from its bound text
+def buildGeometryArea(geometry_format: str) -> str:
+    if geometry_format == "geojson":
+        return "ST_SetSRID(ST_GeomFromGeoJSON(:geometry), 4326)"
+    return "ST_GeomFromText(:geometry, 4326)"
+
+# Geometry condition, served by the GiST index on the point
+def buildGeometryCondition(table: str, geometry_format: str) -> str:
+    area = buildGeometryArea(geometry_format = geometry_format)
+    return f"ST_Intersects({table}.geom, {area})"
+
+# Builds spatial conditions and arguments of a filter
+def buildSpatialConditions(table: str, filter: ExportFilter
+        ) -> Tuple[List[str], dict]:
+    conditions = []
+    args = {}
+    if filter.bbox:
+        conditions.append(buildBoundingBoxCondition(table = table))
+        args.update(buildBoundingBoxArgs(bbox = filter.bbox))
+    if filter.geometry:
+        geometry_format, geometry_args = buildGeometryArgs(
+            geometry = filter.geometry)
+        conditions.append(buildGeometryCondition(
+            table = table,
+            geometry_format = geometry_format
+        ))
+        args.update(geometry_args)
+    return conditions, args
@@ -0,0 +1,304 @@
+from typing import List, Optional
+
+from fastapi import HTTPException
+from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY
+
+from app.db.repositories.base import BaseRepository
+from app.models.summary import SummaryRefresh
+
+
+# Summary Repository Actions
+
+
+# Dimensions each dataset's summaries can be grouped by, and their columns
+TIME_DIMENSIONS = {
+    "year": "CAST(EXTRACT(year FROM month) AS integer)",
+    "month": "month"
+}
+
+LOCATION_DIMENSIONS = {
+    "location_name": "location_name",
+    "locationtype": "locationtype"
+}
+
+SUMMARY_DATASETS = {
+    "occurrence": {
+        "table": "main.occurrence",
+        "summary_table": "main.occurrence_summary",
+        "dimensions": {
+            "kingdom": "occurrence_kingdom",
+            "phylum": "occurrence_phylum",
+            "class": "occurrence_class",
+            "order": "occurrence_order",
+            "family": "occurrence_family",
+            "genus": "occurrence_genus",
+            "species": "occurrence_species",
+            **TIME_DIMENSIONS,
+            **LOCATION_DIMENSIONS
+        },
+        "measures": [
+            "SUM(occurrences) AS occurrences",
+            "SUM(individuals) AS individuals"
+        ]
+    },
+    "mci": {
+        "table": "main.mci",
+        "summary_table": "main.mci_summary",
+        "dimensions": {
+            "indicator": "indicator",
+            "river_catchment": "river_catchment",
+            "landcover_type": "landcover_type",
+            **TIME_DIMENSIONS,
+            **LOCATION_DIMENSIONS
+        },
+        "measures": [
+            "SUM(measurements) AS measurements",
+            "SUM(value_sum) / NULLIF(SUM(measurements), 0) AS mean",
+            "MIN(value_min) AS min",
+            "MAX(value_max) AS max"
+        ]
+    }
+}
+
+# SQL Queries
+CREATE_WATERMARK_QUERY = """
+    INSERT INTO main.summary_watermark (dataset) VALUES (:dataset)
+    ON CONFLICT (dataset) DO NOTHING
+"""
+
+# Row lock keeps concurrent refreshes of a dataset from interleaving
+LOCK_WATERMARK_QUERY = """
+    SELECT updated_xid FROM main.summary_watermark
+    WHERE dataset = :dataset
+    FOR UPDATE
+"""
+
+RESET_WATERMARK_QUERY = """
+    UPDATE main.summary_watermark SET updated_xid = 0
+    WHERE dataset = :dataset
+"""
+
+# Watermarks only move forward
+UPDATE_WATERMARK_QUERY = """
+    UPDATE main.summary_watermark
+    SET updated_xid = GREATEST(updated_xid, :updated_xid), \
+        refreshed_at = now()
+    WHERE dataset = :dataset
+"""
+
+# Months holding rows written between the watermark and the commit horizon
+GET_CHANGED_MONTHS_QUERY = """
+    SELECT array_agg(DISTINCT CAST(date_trunc('month', observation_date) \
+        AS date))
+    FROM {table}
+    WHERE updated_xid >= :updated_xid AND updated_xid < :horizon
+"""
+
+# Months queued by writes the row stamps do not show, e.g. points linked to
+# other locations, taken off the queue as they are rebuilt
+TAKE_PENDING_MONTHS_QUERY = """
+    WITH taken AS (
+        DELETE FROM main.summary_pending
+        WHERE dataset = :dataset
+        RETURNING month
+    )
+    SELECT array_agg(month) FROM taken
+"""
+
+DELETE_SUMMARY_MONTHS_QUERY = """
+    DELETE FROM {summary_table} WHERE month = ANY(CAST(:months AS date[]))
+"""
+
+# Months are rebuilt whole from range scans of the observation date
+REFRESH_OCCURRENCE_SUMMARY_QUERY = """
+    INSERT INTO main.occurrence_summary (month, by_location, location_name, \
+        locationtype, occurrence_kingdom, occurrence_phylum, \
+        occurrence_class, occurrence_order, occurrence_family, \
+        occurrence_genus, occurrence_species, occurrences, individuals)
+    SELECT months.month, FALSE, NULL, NULL, occurrence_kingdom, \
+        occurrence_phylum, occurrence_class, occurrence_order, \
+        occurrence_family, occurrence_genus, occurrence_species, COUNT(*), \
+        SUM(observation_count)
+    FROM unnest(CAST(:months AS date[])) AS months(month)
+    JOIN main.occurrence \
+        ON main.occurrence.observation_date >= months.month \
+        AND main.occurrence.observation_date < \
+            months.month + interval '1 month'
+    GROUP BY months.month, occurrence_kingdom, occurrence_phylum, \
+        occurrence_class, occurrence_order, occurrence_family, \
+        occurrence_genus, occurrence_species
+"""
+
+REFRESH_OCCURRENCE_LOCATION_SUMMARY_QUERY = """
+    INSERT INTO main.occurrence_summary (month, by_location, location_name, \
+        locationtype, occurrence_kingdom, occurrence_phylum, \
+        occurrence_class, occurrence_order, occurrence_family, \
+        occurrence_genus, occurrence_species, occurrences, individuals)
+    SELECT months.month, TRUE, main.location.location_name, \
+        main.locationref.locationtype, occurrence_kingdom, \
+        occurrence_phylum, occurrence_class, occurrence_order, \
+        occurrence_family, occurrence_genus, occurrence_species, COUNT(*), \
+        SUM(observation_count)
+    FROM unnest(CAST(:months AS date[])) AS months(month)
+    JOIN main.occurrence \
+        ON main.occurrence.observation_date >= months.month \
+        AND main.occurrence.observation_date < \
+            months.month + interval '1 month'
+    JOIN main.location ON main.location.occurrence_id = main.occurrence.id
+    JOIN main.locationref \
+        ON main.locationref.name = main.location.location_name
+    GROUP BY months.month, main.location.location_name, \
+        main.locationref.locationtype, occurrence_kingdom, \
+        occurrence_phylum, occurrence_class, occurrence_order, \
+        occurrence_family, occurrence_genus, occurrence_species
+"""
+
+REFRESH_MCI_SUMMARY_QUERY = """
+    INSERT INTO main.mci_summary (month, by_location, location_name, \
+        locationtype, indicator, river_catchment, landcover_type, \
+        measurements, value_sum, value_min, value_max)
+    SELECT months.month, FALSE, NULL, NULL, indicator, river_catchment, \
+        landcover_type, COUNT(*), SUM(value), MIN(value), MAX(value)
+    FROM unnest(CAST(:months AS date[])) AS months(month)
+    JOIN main.mci \
+        ON main.mci.observation_date >= months.month \
+        AND main.mci.observation_date < months.month + interval '1 month'
+    GROUP BY months.month, indicator, river_catchment, landcover_type
+"""
+
+REFRESH_MCI_LOCATION_SUMMARY_QUERY = """
+    INSERT INTO main.mci_summary (month, by_location, location_name, \
+        locationtype, indicator, river_catchment, landcover_type, \
+        measurements, value_sum, value_min, value_max)
+    SELECT months.month, TRUE, main.mci_location.location_name, \
+        main.locationref.locationtype, indicator, river_catchment, \
+        landcover_type, COUNT(*), SUM(value), MIN(value), MAX(value)
+    FROM unnest(CAST(:months AS date[])) AS months(month)
+    JOIN main.mci \
+        ON main.mci.observation_date >= months.month \
+        AND main.mci.observation_date < months.month + interval '1 month'
+    JOIN main.mci_location ON main.mci_location.mci_id = main.mci.id
+    JOIN main.locationref \
+        ON main.locationref.name = main.mci_location.location_name
+    GROUP BY months.month, main.mci_location.location_name, \
+        main.locationref.locationtype, indicator, river_catchment, \
+        landcover_type
+"""
+
+REFRESH_SUMMARY_QUERIES = {
+    "occurrence": [
+        REFRESH_OCCURRENCE_SUMMARY_QUERY,
+        REFRESH_OCCURRENCE_LOCATION_SUMMARY_QUERY
+    ],
+    "mci": [
+        REFRESH_MCI_SUMMARY_QUERY,
+        REFRESH_MCI_LOCATION_SUMMARY_QUERY
+    ]
+}
+
+# Builds query aggregating the summary of a dataset by the dimensions given
+def buildSummaryQuery(dataset: str, group_by: List[str],
+        start_year: Optional[int], end_year: Optional[int]) -> str:
+    summary = SUMMARY_DATASETS[dataset]
+    unknown = [name for name in group_by if name not in summary["dimensions"]]
+    if unknown:
+        raise HTTPException(
+            status_code = HTTP_422_UNPROCESSABLE_ENTITY,
+            detail = "Not a valid summary dimension: " + ", ".join(unknown)
+        )
+    columns = [summary["dimensions"][name] for name in group_by]
+    selected = [f'{column} AS "{name}"'
+        for name, column in zip(group_by, columns)]
+    query = f"SELECT {', '.join(selected + summary['measures'])}"
+    query += f"\n    FROM {summary['summary_table']}"
+    query += "\n    WHERE by_location = :by_location"
+    if start_year:
+        query += "\n    AND month >= make_date(:start_year, 1, 1)"
+    if end_year:
+        query += "\n    AND month < make_date(:end_year + 1, 1, 1)"
+    if columns:
+        query += f"\n    GROUP BY {', '.join(columns)}"
+        query += f"\n    ORDER BY {', '.join(columns)}"
+    return query
+
+
+class SummaryRepository(BaseRepository):
+    """
+    All database actions associated with the summary tables
+    """
+    # Returns aggregates of a dataset grouped by the dimensions given
+    async def get_summary(self, dataset: str, group_by: List[str],
+            start_year: Optional[int] = None,
+            end_year: Optional[int] = None) -> List[dict]:
+        query = buildSummaryQuery(
+            dataset = dataset,
+            group_by = group_by,
+            start_year = start_year,
+            end_year = end_year
+        )
+        # Rows are summarised per location only when grouped by location
+        values = {
+            "by_location": any(name in LOCATION_DIMENSIONS
+                for name in group_by)
+        }
+        if start_year:
+            values["start_year"] = start_year
+        if end_year:
+            values["end_year"] = end_year
+        records = await self.db.fetch_all(query = query, values = values)
+        return [dict(record) for record in records]
+
+    # Rebuilds summaries of the months changed since the last refresh
+    async def refresh_summaries(self, dataset: str,
+            full: bool = False) -> SummaryRefresh:
+        summary = SUMMARY_DATASETS[dataset]
+        await self.db.execute(
+            query = CREATE_WATERMARK_QUERY,
+            values = {"dataset": dataset}
+        )
+        async with self.db.transaction():
+            # Full refreshes rebuild every month, e.g. after writes with
+            # triggers disabled
+            if full:
+                await self.db.execute(
+                    query = RESET_WATERMARK_QUERY,
+                    values = {"dataset": dataset}
+                )
+            watermark = await self.db.fetch_one(
+                query = LOCK_WATERMARK_QUERY,
+                values = {"dataset": dataset}
+            )
+            horizon = await self.get_commit_horizon()
+            changed = await self.db.fetch_val(
+                query = GET_CHANGED_MONTHS_QUERY.format(
+                    table = summary["table"]),
+                values = {
+                    "updated_xid": watermark["updated_xid"],
+                    "horizon": horizon
+                }
+            )
+            pending = await self.db.fetch_val(
+                query = TAKE_PENDING_MONTHS_QUERY,
+                values = {"dataset": dataset}
+            )
+            months = sorted({month for month in
+                (changed or []) + (pending or []) if month is not None})
+            if months:
+                await self.db.execute(
+                    query = DELETE_SUMMARY_MONTHS_QUERY.format(
+                        summary_table = summary["summary_table"]),
+                    values = {"months": months}
+                )
+                for query in REFRESH_SUMMARY_QUERIES[dataset]:
+                    await self.db.execute(
+                        query = query,
+                        values = {"months": months}
+                    )
+            await self.db.execute(
+                query = UPDATE_WATERMARK_QUERY,
+                values = {
+                    "dataset": dataset,
+                    "updated_xid": horizon
+                }
+            )
+        return SummaryRefresh(dataset = dataset, months = len(months))
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import shutil
+import time
+import uuid
+from typing import Optional
+
+from databases import Database
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.status import HTTP_404_NOT_FOUND
+
+from app.core.config import (
+    EXPORT_RETENTION_INTERVAL,
+    TILE_CACHE_PATH,
+    TILE_CACHE_QUOTA,
+    TILE_CLUSTER_GRID,
+    TILE_CLUSTER_MAX_ZOOM
+)
+from app.db.repositories.base import BaseRepository
+from app.db.repositories.cache import ExportCacheRepository
+from app.db.repositories.compiler import FilterCompiler
+from app.db.repositories.occurrence import (
+    GET_OCCURRENCE_POINTS_BY_FILTER_QUERY,
+    OccurrenceRepository
+)
+from app.models.filter import Filter
+from app.models.tile import TileEviction
+
+
+# Map Tile Repository Actions
+
+
+# Deepest zoom level tiles are served for
+MAX_TILE_ZOOM = 22
+
+# Width of the web mercator world in metres
+WORLD_SIZE = 2 * 20037508.342789244
+
+# Compiled statements of the tile queries, shared by every request
+TILE_FILTER_COMPILER = FilterCompiler()
+
+# SQL Queries
+
+# Points are matched in WGS 84 so the GiST index on geom serves the tile
+# bounds, then projected to web mercator for encoding
+GET_OCCURRENCE_TILE_QUERY = """
+    WITH points AS (
+        SELECT filtered.id, filtered.scientific_name, \
+            filtered.observation_count, filtered.observation_date, \
+            ST_Transform(filtered.geom, 3857) AS geom
+        FROM ({query}) AS filtered
+        WHERE filtered.geom && \
+            ST_Transform(ST_TileEnvelope(:z, :x, :y), 4326)
+    ),
+    features AS ({features}
+    )
+    SELECT COALESCE(ST_AsMVT(features, 'occurrence', 4096, 'geom'), '') \
+        AS tile
+    FROM features
+"""
+
+# Points sharing a grid cell are drawn as one feature at their centre
+CLUSTERED_FEATURES_QUERY = """
+        SELECT ST_AsMVTGeom(ST_Centroid(ST_Collect(geom)), \
+                ST_TileEnvelope(:z, :x, :y), 4096, 64) AS geom, \
+            COUNT(*) AS count
+        FROM points
+        GROUP BY ST_SnapToGrid(geom, :cell_size)"""
+
+POINT_FEATURES_QUERY = """
+        SELECT ST_AsMVTGeom(geom, ST_TileEnvelope(:z, :x, :y), 4096, 64) \
+                AS geom, \
+            id, scientific_name, observation_count, \
+            CAST(observation_date AS text) AS observation_date, 1 AS count
+        FROM points"""
+
+# Checks tile coordinates exist at their zoom level
+def checkTileCoordinates(z: int, x: int, y: int) -> None:
+    if (not 0 <= z <= MAX_TILE_ZOOM
+            or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z):
+        raise HTTPException(
+            status_code = HTTP_404_NOT_FOUND,
+            detail = "No tile at these coordinates"
+        )
+
+# Returns path a tile is cached at, under a directory of the table version
+def getTilePath(filter: Filter, table_version: int, z: int, x: int,
+        y: int) -> str:
+    key = filter.cache_key(dataset = "occurrence", format = "mvt")
+    name = hashlib.sha256(f"{key}/{z}/{x}/{y}".encode()).hexdigest()
+    return os.path.join(TILE_CACHE_PATH, "occurrence", str(table_version),
+        str(z), name + ".mvt")
+
+# Reads cached tile, returns None if it is not cached. Reads stamp the
+# tile's modification time, so eviction finds the least recently read.
+def readTile(path: str) -> Optional[bytes]:
+    try:
+        with open(path, mode = "rb") as file:
+            tile = file.read()
+        os.utime(path)
+        return tile
+    except FileNotFoundError:
+        return None
+
+# Writes tile to the cache, dropping tiles of older table versions
+def writeTile(path: str, tile: bytes) -> None:
+    version_path = os.path.dirname(os.path.dirname(path))
+    dataset_path = os.path.dirname(version_path)
+    current = int(os.path.basename(version_path))
+    versions = os.listdir(dataset_path) if os.path.isdir(dataset_path) else []
+    for version in [int(name) for name in versions if name.isdigit()]:
+        # Tiles read before the tables changed again are not kept
+        if version > current:
+            return
+        if version < current:
+            shutil.rmtree(os.path.join(dataset_path, str(version)),
+                ignore_errors = True)
+    # Tiles are renamed into place so readers never see a partial file
+    partial = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(partial, mode = "wb") as file:
+            file.write(tile)
+        os.replace(partial, path)
+    except OSError:
+        # A newer version pruned the directory, the tile is just not cached
+        if os.path.exists(partial):
+            os.remove(partial)
+
+# Removes least recently read tiles until the cache fits its quota, and
+# partial files of failed writes once older than min_age
+def evictTiles(directory: str = TILE_CACHE_PATH,
+        quota: int = TILE_CACHE_QUOTA,
+        min_age: float = EXPORT_RETENTION_INTERVAL) -> TileEviction:
+    eviction = TileEviction()
+    tiles = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+                if not name.endswith(".mvt"):
+                    if time.time() - stat.st_mtime >= min_age:
+                        os.remove(path)
+                        eviction.bytes_freed += stat.st_size
+                    continue
+            except FileNotFoundError:
+                continue
+            tiles.append((stat.st_mtime, stat.st_size, path))
+    used = sum(size for _, size, _ in tiles)
+    for _, size, path in sorted(tiles):
+        if used <= quota:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        used -= size
+        eviction.tiles_removed += 1
+        eviction.bytes_freed += size
+    return eviction
+
+
+class TileRepository(BaseRepository):
+    """
+    All database actions associated with occurrence map tiles
+    """
+    def __init__(self, db: Database) -> None:
+        super().__init__(db)
+        self.occurrence_repo = OccurrenceRepository(db)
+        self.cache_repo = ExportCacheRepository(db)
+
+    # Returns vector tile of the occurrences matching the filter, from the
+    # cache while the occurrence tables are unchanged
+    async def get_occurrence_tile(self, filter: Filter, z: int, x: int,
+            y: int) -> bytes:
+        checkTileCoordinates(z = z, x = x, y = y)
+        query, args = self.occurrence_repo.build_filter_query(
+            filter = filter,
+            select = GET_OCCURRENCE_POINTS_BY_FILTER_QUERY
+        )
+        table_version = await self.cache_repo.get_table_version(
+            dataset = "occurrence")
+        path = getTilePath(
+            filter = filter,
+            table_version = table_version,
+            z = z,
+            x = x,
+            y = y
+        )
+        tile = await run_in_threadpool(readTile, path)
+        if tile is not None:
+            return tile
+        args.update({"z": z, "x": x, "y": y})
+        # Low zooms cluster points so tiles stay small however many match
+        if z <= TILE_CLUSTER_MAX_ZOOM:
+            features = CLUSTERED_FEATURES_QUERY
+            args["cell_size"] = WORLD_SIZE / 2 ** z / TILE_CLUSTER_GRID
+        else:
+            features = POINT_FEATURES_QUERY
+        records = await self.fetch_compiled(
+            compiler = TILE_FILTER_COMPILER,
+            query = GET_OCCURRENCE_TILE_QUERY.format(
+                query = query,
+                features = features
+            ),
+            values = args
+        )
+        tile = bytes(records[0]["tile"])
+        await run_in_threadpool(writeTile, path, tile)
+        return tile
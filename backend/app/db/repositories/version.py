@@ -0,0 +1,29 @@
+from typing import List
+
+from app.db.repositories.base import BaseRepository
+from app.models.version import TableVersion
+
+
+# Table Version Repository Actions
+
+
+# SQL Queries
+GET_TABLE_VERSION_QUERY = """
+    SELECT COALESCE(SUM(version), 0) AS version, MAX(updated_at) AS updated_at
+    FROM main.table_version
+    WHERE table_name = ANY(:tables)
+"""
+
+
+class TableVersionRepository(BaseRepository):
+    """
+    All database actions associated with the Table Version Table
+    """
+    # Returns current version of the tables given, tables never written
+    # since their trigger was added count as version 0
+    async def get_table_version(self, tables: List[str]) -> TableVersion:
+        record = await self.db.fetch_one(
+            query = GET_TABLE_VERSION_QUERY,
+            values = {"tables": tables}
+        )
+        return TableVersion(**record)
@@ -0,0 +1,595 @@
+import logging
+from typing import List, Tuple
+
+from databases import Database
+
+from app.core.config import TAXONOMY_TRIGRAM_INDEXES
+
+logger = logging.getLogger(__name__)
+
+# Application Schema
+
+# Table migrations are maintained in the ecoindex-db-migrations repo, objects
+# owned by the API itself are created here on startup. Every statement must be
+# idempotent as it runs each time the app starts.
+
+# Arbitrary advisory lock key so concurrent workers create the schema in turn
+SCHEMA_LOCK_KEY = 7305221
+
+# Arbitrary advisory lock key so one worker at a time builds the indexes of
+# the large tables
+INDEX_LOCK_KEY = 7305222
+
+# Per table version counters, bumped by a statement trigger on every write
+CREATE_TABLE_VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.table_version (
+        table_name text PRIMARY KEY,
+        version bigint NOT NULL DEFAULT 0,
+        updated_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+CREATE_BUMP_TABLE_VERSION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION main.bump_table_version() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO main.table_version (table_name, version, updated_at)
+        VALUES (TG_TABLE_NAME, 1, now())
+        ON CONFLICT (table_name) DO UPDATE
+        SET version = main.table_version.version + 1, updated_at = now();
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# Tables whose writes invalidate cached exports and the validators of the
+# read endpoints, users is found on the search path like its queries
+VERSIONED_TABLES = [
+    "main.occurrence",
+    "main.location",
+    "main.locationref",
+    "main.mci",
+    "main.mci_location",
+    "users"
+]
+
+# Cached exports by canonical filter key
+CREATE_EXPORT_CACHE_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.export_cache (
+        cache_key text PRIMARY KEY,
+        dataset text NOT NULL,
+        download_id bigint NOT NULL,
+        table_version bigint NOT NULL,
+        row_count bigint NOT NULL,
+        file_size bigint NOT NULL,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        last_used_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+# Cached density grids by canonical filter, shape and cell size
+CREATE_GRID_CACHE_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.grid_cache (
+        cache_key text PRIMARY KEY,
+        table_version bigint NOT NULL,
+        cells jsonb NOT NULL,
+        created_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+# Registry of download files, ids are handed out by its sequence
+CREATE_EXPORT_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.export (
+        id bigserial PRIMARY KEY,
+        dataset text NOT NULL,
+        filter jsonb NOT NULL,
+        owner text,
+        path text NOT NULL,
+        status text NOT NULL DEFAULT 'running',
+        row_count bigint,
+        file_size bigint,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        completed_at timestamptz
+    )
+"""
+
+# Background export and ingest jobs, so any process can report their status
+CREATE_EXPORT_JOB_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.export_job (
+        job_id text PRIMARY KEY,
+        kind text NOT NULL DEFAULT 'export',
+        dataset text NOT NULL,
+        status text NOT NULL DEFAULT 'queued',
+        download_id bigint,
+        result jsonb,
+        error text,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        updated_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+ADD_EXPORT_FORMAT_COLUMN = """
+    ALTER TABLE main.export
+    ADD COLUMN IF NOT EXISTS format text NOT NULL DEFAULT 'csv'
+"""
+
+# Compression of the stored file, null when stored as is
+ADD_EXPORT_ENCODING_COLUMN = """
+    ALTER TABLE main.export ADD COLUMN IF NOT EXISTS encoding text
+"""
+
+# Last download and eviction of each export, for retention
+ADD_EXPORT_ACCESSED_COLUMN = """
+    ALTER TABLE main.export ADD COLUMN IF NOT EXISTS accessed_at timestamptz
+"""
+
+ADD_EXPORT_EVICTED_COLUMN = """
+    ALTER TABLE main.export ADD COLUMN IF NOT EXISTS evicted_at timestamptz
+"""
+
+# Point table of each dataset assigned to locations
+LOCATION_TABLES = {"occurrence": "main.occurrence", "mci": "main.mci"}
+
+# Link tables of the points and the column holding the point's id
+LOCATION_LINK_TABLES = {
+    "main.location": "occurrence_id",
+    "main.mci_location": "mci_id"
+}
+
+# Points waiting to be assigned to locations, queued by triggers as rows are
+# inserted or moved so runs see every committed row whatever its id
+CREATE_LOCATION_PENDING_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.location_pending (
+        dataset text NOT NULL,
+        id bigint NOT NULL,
+        PRIMARY KEY (dataset, id)
+    )
+"""
+
+CREATE_QUEUE_LOCATION_ASSIGNMENT_FUNCTION = """
+    CREATE OR REPLACE FUNCTION main.queue_location_assignment()
+    RETURNS trigger AS $$
+    BEGIN
+        IF TG_LEVEL = 'STATEMENT' THEN
+            INSERT INTO main.location_pending (dataset, id)
+            SELECT TG_ARGV[0], id FROM inserted
+            ON CONFLICT DO NOTHING;
+        ELSE
+            INSERT INTO main.location_pending (dataset, id)
+            VALUES (TG_ARGV[0], NEW.id)
+            ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# Serves the point in polygon join assigning locations
+CREATE_LOCATIONREF_POLYGON_INDEX = """
+    CREATE INDEX IF NOT EXISTS locationref_polygon_idx
+    ON main.locationref USING gist (polygon)
+"""
+
+# Location names must be unique for loads to upsert on them, the migrations
+# may already provide this through a key
+CREATE_LOCATIONREF_NAME_INDEX = """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_index
+            JOIN pg_attribute ON pg_attribute.attrelid = pg_index.indrelid
+                AND pg_attribute.attnum = pg_index.indkey[0]
+            WHERE pg_index.indrelid = 'main.locationref'::regclass
+            AND pg_index.indisunique AND pg_index.indnatts = 1
+            AND pg_index.indpred IS NULL
+            AND pg_attribute.attname = 'name'
+        ) THEN
+            CREATE UNIQUE INDEX locationref_name_key
+            ON main.locationref (name);
+        END IF;
+    END
+    $$
+"""
+
+# Pre-aggregated counts per month and taxonomy, once over every occurrence
+# and once per location they fall in
+CREATE_OCCURRENCE_SUMMARY_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.occurrence_summary (
+        month date NOT NULL,
+        by_location boolean NOT NULL,
+        location_name text,
+        locationtype text,
+        occurrence_kingdom text,
+        occurrence_phylum text,
+        occurrence_class text,
+        occurrence_order text,
+        occurrence_family text,
+        occurrence_genus text,
+        occurrence_species text,
+        occurrences bigint NOT NULL,
+        individuals bigint
+    )
+"""
+
+CREATE_OCCURRENCE_SUMMARY_INDEX = """
+    CREATE INDEX IF NOT EXISTS occurrence_summary_month_idx
+    ON main.occurrence_summary (by_location, month)
+"""
+
+# Pre-aggregated MCI values per month, indicator, catchment and landcover
+CREATE_MCI_SUMMARY_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.mci_summary (
+        month date NOT NULL,
+        by_location boolean NOT NULL,
+        location_name text,
+        locationtype text,
+        indicator text,
+        river_catchment text,
+        landcover_type text,
+        measurements bigint NOT NULL,
+        value_sum double precision,
+        value_min double precision,
+        value_max double precision
+    )
+"""
+
+CREATE_MCI_SUMMARY_INDEX = """
+    CREATE INDEX IF NOT EXISTS mci_summary_month_idx
+    ON main.mci_summary (by_location, month)
+"""
+
+# Id of the transaction writing a row. Ids are handed out as transactions
+# first write, so unlike their start times they tell which writers can
+# still commit: every id below the oldest one running has ended.
+CURRENT_TRANSACTION_ID = "CAST(CAST(pg_current_xact_id() AS text) AS bigint)"
+
+# Stamps rows with the time and the transaction they were last written in,
+# summaries refresh the months of rows written since they last ran
+CREATE_TOUCH_UPDATED_AT_FUNCTION = f"""
+    CREATE OR REPLACE FUNCTION main.touch_updated_at() RETURNS trigger AS $$
+    BEGIN
+        NEW.updated_at = now();
+        NEW.updated_xid = {CURRENT_TRANSACTION_ID};
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# Tables whose summaries and change feeds are read from their writes
+SUMMARISED_TABLES = ["main.occurrence", "main.mci"]
+
+# Transaction id each dataset's summary has seen every row written below
+CREATE_SUMMARY_WATERMARK_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.summary_watermark (
+        dataset text PRIMARY KEY,
+        updated_xid bigint NOT NULL DEFAULT 0,
+        refreshed_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+# Months whose summaries are stale in ways the row stamps do not show, such
+# as rows moved out of them, deleted or linked to other locations. Appended to
+# without a key so writers never wait on each other.
+CREATE_SUMMARY_PENDING_TABLE = """
+    CREATE TABLE IF NOT EXISTS main.summary_pending (
+        dataset text NOT NULL,
+        month date NOT NULL
+    )
+"""
+
+CREATE_QUEUE_SUMMARY_MONTHS_FUNCTION = """
+    CREATE OR REPLACE FUNCTION main.queue_summary_months()
+    RETURNS trigger AS $$
+    BEGIN
+        IF TG_LEVEL = 'STATEMENT' THEN
+            INSERT INTO main.summary_pending (dataset, month)
+            SELECT DISTINCT TG_ARGV[0],
+                CAST(date_trunc('month', observation_date) AS date)
+            FROM deleted
+            WHERE observation_date IS NOT NULL;
+        ELSIF OLD.observation_date IS NOT NULL THEN
+            INSERT INTO main.summary_pending (dataset, month)
+            VALUES (TG_ARGV[0],
+                CAST(date_trunc('month', OLD.observation_date) AS date));
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# Serve the month range scans refreshing summaries
+OBSERVATION_DATE_INDEXES = [
+    ("occurrence_observation_date_idx", "main.occurrence (observation_date)"),
+    ("mci_observation_date_idx", "main.mci (observation_date)")
+]
+
+# Tables whose latitude and longitude are kept as a point for spatial filters
+SPATIAL_TABLES = ["main.occurrence", "main.mci"]
+
+# Occurrence columns taxonomy filters match against
+TAXONOMY_COLUMNS = [
+    "scientific_name",
+    "occurrence_kingdom",
+    "occurrence_phylum",
+    "occurrence_class",
+    "occurrence_order",
+    "occurrence_family",
+    "occurrence_genus",
+    "occurrence_species"
+]
+
+CREATE_TRIGRAM_EXTENSION = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+
+# Serve the location semi-joins of the filter queries
+LOCATION_LINK_INDEXES = [
+    ("location_occurrence_id_idx", "main.location (occurrence_id)"),
+    ("mci_location_mci_id_idx", "main.mci_location (mci_id)")
+]
+
+# Key each point's link to a location, so assignments never duplicate them
+LOCATION_LINK_KEYS = [
+    (table.split(".")[-1] + "_location_key",
+        f"{table} ({column}, location_name)")
+    for table, column in LOCATION_LINK_TABLES.items()
+]
+
+# Case folded and range lookups of the filter queries, so selective filters
+# never scan the large tables
+FILTER_INDEXES = [
+    ("location_name_lower_idx",
+        "main.location (LOWER(location_name), occurrence_id)"),
+    ("mci_location_name_lower_idx",
+        "main.mci_location (LOWER(location_name), mci_id)"),
+    ("mci_indicator_lower_idx", "main.mci (LOWER(indicator))"),
+    ("mci_river_catchment_lower_idx",
+        "main.mci (LOWER(river_catchment) text_pattern_ops)"),
+    ("mci_landcover_type_lower_idx", "main.mci (LOWER(landcover_type))"),
+    ("mci_value_idx", "main.mci (value)")
+]
+
+# Finds whether an index of the main schema exists and finished building
+GET_INDEX_VALID_QUERY = """
+    SELECT pg_index.indisvalid
+    FROM pg_index
+    JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+    JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+    WHERE pg_namespace.nspname = 'main' AND pg_class.relname = :name
+"""
+
+
+# Builds statements attaching the version trigger to a table
+def buildVersionTriggerStatements(table: str):
+    trigger = table.split(".")[-1] + "_table_version"
+    return [
+        f"DROP TRIGGER IF EXISTS {trigger} ON {table}",
+        f"""CREATE TRIGGER {trigger}
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION main.bump_table_version()"""
+    ]
+
+# Builds statements adding an updated_at and the id of the transaction
+# writing the row, kept current by a trigger. Rows written before the id
+# was added take 0 without the table being rewritten.
+def buildUpdatedAtStatements(table: str):
+    name = table.split(".")[-1]
+    return [
+        f"""ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at
+            timestamptz NOT NULL DEFAULT now()""",
+        f"""ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_xid
+            bigint NOT NULL DEFAULT 0""",
+        f"""ALTER TABLE {table} ALTER COLUMN updated_xid
+            SET DEFAULT {CURRENT_TRANSACTION_ID}""",
+        f"DROP TRIGGER IF EXISTS {name}_updated_at ON {table}",
+        f"""CREATE TRIGGER {name}_updated_at
+            BEFORE UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION main.touch_updated_at()"""
+    ]
+
+# Builds statements queueing points of a dataset for location assignment
+# when inserted or moved
+def buildLocationQueueStatements(dataset: str, table: str):
+    name = table.split(".")[-1]
+    return [
+        f"DROP TRIGGER IF EXISTS {name}_location_insert ON {table}",
+        f"""CREATE TRIGGER {name}_location_insert
+            AFTER INSERT ON {table} REFERENCING NEW TABLE AS inserted
+            FOR EACH STATEMENT
+            EXECUTE FUNCTION main.queue_location_assignment('{dataset}')""",
+        f"DROP TRIGGER IF EXISTS {name}_location_move ON {table}",
+        f"""CREATE TRIGGER {name}_location_move
+            AFTER UPDATE OF occurrence_latitude, occurrence_longitude
+            ON {table} FOR EACH ROW
+            WHEN (OLD.occurrence_latitude IS DISTINCT FROM
+                    NEW.occurrence_latitude
+                OR OLD.occurrence_longitude IS DISTINCT FROM
+                    NEW.occurrence_longitude)
+            EXECUTE FUNCTION main.queue_location_assignment('{dataset}')"""
+    ]
+
+# Builds statement removing duplicate links of a point to a location, so
+# the links can be keyed on them
+def buildLinkDeduplicateStatement(table: str, column: str):
+    return f"""DELETE FROM {table} AS duplicate
+        USING {table} AS kept
+        WHERE duplicate.{column} = kept.{column}
+        AND duplicate.location_name = kept.location_name
+        AND duplicate.ctid > kept.ctid"""
+
+# Builds statements queueing the months rows leave, by a change of their
+# observation date or by being deleted, as their new months show through
+# the row stamps alone
+def buildSummaryQueueStatements(dataset: str, table: str):
+    name = table.split(".")[-1]
+    return [
+        f"DROP TRIGGER IF EXISTS {name}_summary_move ON {table}",
+        f"""CREATE TRIGGER {name}_summary_move
+            AFTER UPDATE OF observation_date ON {table} FOR EACH ROW
+            WHEN (OLD.observation_date IS DISTINCT FROM NEW.observation_date)
+            EXECUTE FUNCTION main.queue_summary_months('{dataset}')""",
+        f"DROP TRIGGER IF EXISTS {name}_summary_delete ON {table}",
+        f"""CREATE TRIGGER {name}_summary_delete
+            AFTER DELETE ON {table} REFERENCING OLD TABLE AS deleted
+            FOR EACH STATEMENT
+            EXECUTE FUNCTION main.queue_summary_months('{dataset}')"""
+    ]
+
+# Builds index ordered by writing transaction and id, so summaries find
+# changed rows and change feeds can seek past a sync token
+def buildUpdatedXidIndex(table: str) -> Tuple[str, str]:
+    return (table.split(".")[-1] + "_updated_xid_id_idx",
+        f"{table} (updated_xid, id)")
+
+# Builds index finding where change feeds read from a time given
+def buildUpdatedAtIndex(table: str) -> Tuple[str, str]:
+    return (table.split(".")[-1] + "_updated_at_idx",
+        f"{table} (updated_at)")
+
+# Builds case folded index serving exact and prefix taxonomy matches
+def buildTaxonomyIndex(column: str) -> Tuple[str, str]:
+    return (f"occurrence_{column}_lower_idx",
+        f"main.occurrence (LOWER({column}) text_pattern_ops)")
+
+# Builds trigram index serving substring taxonomy matches
+def buildTaxonomyTrigramIndex(column: str) -> Tuple[str, str]:
+    return (f"occurrence_{column}_trgm_idx",
+        f"main.occurrence USING gin (LOWER({column}) gin_trgm_ops)")
+
+# Builds statement adding a point generated from the coordinates
+def buildPointColumnStatement(table: str):
+    return f"""ALTER TABLE {table} ADD COLUMN IF NOT EXISTS geom
+        geometry(Point, 4326) GENERATED ALWAYS AS (ST_SetSRID(
+            ST_MakePoint(occurrence_longitude, occurrence_latitude), 
+            4326)) STORED"""
+
+# Builds spatial index of the generated point
+def buildPointIndex(table: str) -> Tuple[str, str]:
+    return (table.split(".")[-1] + "_geom_idx", f"{table} USING gist (geom)")
+
+
+SCHEMA_STATEMENTS = [
+    CREATE_TABLE_VERSION_TABLE,
+    CREATE_BUMP_TABLE_VERSION_FUNCTION,
+    *[statement for table in VERSIONED_TABLES
+        for statement in buildVersionTriggerStatements(table)],
+    CREATE_EXPORT_CACHE_TABLE,
+    CREATE_EXPORT_TABLE,
+    CREATE_GRID_CACHE_TABLE,
+    CREATE_EXPORT_JOB_TABLE,
+    ADD_EXPORT_FORMAT_COLUMN,
+    ADD_EXPORT_ENCODING_COLUMN,
+    ADD_EXPORT_ACCESSED_COLUMN,
+    ADD_EXPORT_EVICTED_COLUMN,
+    CREATE_LOCATION_PENDING_TABLE,
+    CREATE_QUEUE_LOCATION_ASSIGNMENT_FUNCTION,
+    *[statement for dataset, table in LOCATION_TABLES.items()
+        for statement in buildLocationQueueStatements(dataset, table)],
+    CREATE_LOCATIONREF_POLYGON_INDEX,
+    CREATE_LOCATIONREF_NAME_INDEX,
+    CREATE_OCCURRENCE_SUMMARY_TABLE,
+    CREATE_OCCURRENCE_SUMMARY_INDEX,
+    CREATE_MCI_SUMMARY_TABLE,
+    CREATE_MCI_SUMMARY_INDEX,
+    CREATE_TOUCH_UPDATED_AT_FUNCTION,
+    *[statement for table in SUMMARISED_TABLES
+        for statement in buildUpdatedAtStatements(table)],
+    CREATE_SUMMARY_WATERMARK_TABLE,
+    CREATE_SUMMARY_PENDING_TABLE,
+    CREATE_QUEUE_SUMMARY_MONTHS_FUNCTION,
+    *[statement for dataset, table in LOCATION_TABLES.items()
+        for statement in buildSummaryQueueStatements(dataset, table)]
+]
+
+# Changes to the large tables that rewrite them under an exclusive lock, so
+# they never run on startup. They belong to the migrations repo, deployments
+# whose migrations do not include them yet apply them in a maintenance
+# window with `python -m app.cli migrate-tables`. Removing duplicate links
+# lets their unique keys build.
+TABLE_MIGRATION_STATEMENTS = [
+    *[buildPointColumnStatement(table) for table in SPATIAL_TABLES],
+    *[buildLinkDeduplicateStatement(table, column)
+        for table, column in LOCATION_LINK_TABLES.items()]
+]
+
+# Names and definitions of the indexes of the large tables. Building them in
+# the schema transaction would block writes to the tables for as long as a
+# build takes, so they are built concurrently once the app is up.
+TABLE_INDEXES = [
+    *[buildTaxonomyIndex(column) for column in TAXONOMY_COLUMNS],
+    *LOCATION_LINK_INDEXES,
+    *FILTER_INDEXES,
+    *[buildUpdatedXidIndex(table) for table in SUMMARISED_TABLES],
+    *[buildUpdatedAtIndex(table) for table in SUMMARISED_TABLES],
+    *OBSERVATION_DATE_INDEXES,
+    *[buildPointIndex(table) for table in SPATIAL_TABLES]
+]
+
+# Unique indexes of the large tables, built the same way
+UNIQUE_TABLE_INDEXES = [*LOCATION_LINK_KEYS]
+
+# Substring matching needs the pg_trgm extension so is opt in
+if TAXONOMY_TRIGRAM_INDEXES:
+    SCHEMA_STATEMENTS.append(CREATE_TRIGRAM_EXTENSION)
+    TABLE_INDEXES += [buildTaxonomyTrigramIndex(column)
+        for column in TAXONOMY_COLUMNS]
+
+
+# Runs schema statements in one transaction, one process at a time
+async def execute_schema_statements(database: Database,
+        statements: List[str]) -> None:
+    async with database.transaction():
+        await database.execute(
+            query = "SELECT pg_advisory_xact_lock(:key)",
+            values = {"key": SCHEMA_LOCK_KEY}
+        )
+        for statement in statements:
+            await database.execute(query = statement)
+
+# Creates objects owned by the app if they do not exist yet
+async def create_app_schema(database: Database) -> None:
+    await execute_schema_statements(database, SCHEMA_STATEMENTS)
+
+# Applies the large table changes the migrations may not include yet
+async def apply_table_migrations(database: Database) -> None:
+    await execute_schema_statements(database, TABLE_MIGRATION_STATEMENTS)
+
+# Builds the missing indexes of the large tables without blocking writes to
+# them, returns names of the indexes built. Runs outside of a transaction as
+# concurrent builds require, skipped while another process is building.
+async def create_table_indexes(database: Database) -> List[str]:
+    built = []
+    async with database.connection() as connection:
+        locked = await connection.fetch_val(
+            query = "SELECT pg_try_advisory_lock(:key)",
+            values = {"key": INDEX_LOCK_KEY}
+        )
+        if not locked:
+            return built
+        try:
+            for name, definition in TABLE_INDEXES + UNIQUE_TABLE_INDEXES:
+                unique = (name, definition) in UNIQUE_TABLE_INDEXES
+                valid = await connection.fetch_val(
+                    query = GET_INDEX_VALID_QUERY,
+                    values = {"name": name}
+                )
+                if valid:
+                    continue
+                try:
+                    # An interrupted build leaves an invalid index behind
+                    if valid is not None:
+                        await connection.raw_connection.execute(
+                            f"DROP INDEX CONCURRENTLY main.{name}")
+                    await connection.raw_connection.execute(
+                        f"CREATE {'UNIQUE ' if unique else ''}INDEX "
+                        f"CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+                    built.append(name)
+                except Exception as e:
+                    # e.g. the point columns are not migrated yet or
+                    # links are duplicated, the remaining indexes are
+                    # still built
+                    logger.warn(f"--- INDEX {name} NOT BUILT ---")
+                    logger.warn(e)
+        finally:
+            await connection.execute(
+                query = "SELECT pg_advisory_unlock(:key)",
+                values = {"key": INDEX_LOCK_KEY}
+            )
+    return built
@@ -1,20 +1,36 @@
+import asyncio
 import os  
 import logging 
 
 from fastapi import FastAPI
 from databases import Database
+from starlette.concurrency import run_in_threadpool
 
-from app.core.config import TEST_DATABASE_URL, DATABASE_URL
+from app.core.config import (
+    DATABASE_URL, 
+    EXPORT_RETENTION_INTERVAL, 
+    FILTER_STATEMENT_CACHE_SIZE, 
+    SUMMARY_REFRESH_INTERVAL,
+    TEST_DATABASE_URL
+)
+from app.db.repositories.export import ExportRepository
+from app.db.repositories.jobs import ExportJobRepository
+from app.db.repositories.location import LOCATION_DATASETS, LocationRepository
+from app.db.repositories.summary import SUMMARY_DATASETS, SummaryRepository
+from app.db.repositories.tile import evictTiles
+from app.db.schema import create_app_schema, create_table_indexes
 
 logger = logging.getLogger(__name__)
 
 async def connect_to_db(app: FastAPI) -> None:
     DB_URL =  TEST_DATABASE_URL if os.environ.get("TESTING") else DATABASE_URL
     # these can be configured in config as well
-    database = Database(DB_URL, min_size=2, max_size=10)  
+    database = Database(DB_URL, min_size=2, max_size=10,
+        statement_cache_size=FILTER_STATEMENT_CACHE_SIZE)
     
     try:
         await database.connect()
+        await create_app_schema(database)
         app.state._db = database
     except Exception as e:
         logger.warn("--- DB CONNECTION ERROR ---")
@@ -28,3 +44,106 @@ async def close_db_connection(app: FastAPI) -> None:
         logger.warn("--- DB DISCONNECT ERROR ---")
         logger.warn(e)
         logger.warn("--- DB DISCONNECT ERROR ---")
+
+# Expires export jobs, evicts downloads over the disk quota or age limit and
+# cached tiles over theirs, at a fixed interval
+async def run_export_retention(database: Database, interval: int) -> None:
+    export_repo = ExportRepository(database)
+    job_repo = ExportJobRepository(database)
+    while True:
+        try:
+            await job_repo.expire_jobs()
+            eviction = await export_repo.evict_exports()
+            if eviction.abandoned:
+                logger.warn(f"Failed {len(eviction.abandoned)} exports left "
+                    "running")
+            if eviction.evicted or eviction.files_removed:
+                logger.info(f"Evicted {len(eviction.evicted)} downloads, "
+                    f"removed {eviction.files_removed} unregistered files")
+            tile_eviction = await run_in_threadpool(evictTiles)
+            if tile_eviction.tiles_removed:
+                logger.info(f"Evicted {tile_eviction.tiles_removed} tiles, "
+                    f"freeing {tile_eviction.bytes_freed} bytes")
+        except Exception as e:
+            logger.warn("--- EXPORT RETENTION ERROR ---")
+            logger.warn(e)
+            logger.warn("--- EXPORT RETENTION ERROR ---")
+        await asyncio.sleep(interval)
+
+def start_export_retention(app: FastAPI) -> None:
+    database = getattr(app.state, "_db", None)
+    if database:
+        app.state._retention = asyncio.create_task(run_export_retention(
+            database, EXPORT_RETENTION_INTERVAL))
+
+async def stop_export_retention(app: FastAPI) -> None:
+    task = getattr(app.state, "_retention", None)
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions = True)
+
+# Assigns points written since the last cycle to locations, then rebuilds
+# the summaries of the months they changed
+async def refresh_summary_tables(database: Database) -> None:
+    location_repo = LocationRepository(database)
+    summary_repo = SummaryRepository(database)
+    for dataset in LOCATION_DATASETS:
+        assignment = await location_repo.assign_locations(dataset = dataset)
+        if assignment.waiting:
+            logger.warn(f"Assigning {dataset} points waits for the location "
+                "link key to be built")
+        elif assignment.points:
+            logger.info(f"Assigned {assignment.points} {dataset} points to "
+                f"{assignment.locations} locations")
+    for dataset in SUMMARY_DATASETS:
+        refresh = await summary_repo.refresh_summaries(dataset = dataset)
+        if refresh.months:
+            logger.info(f"Refreshed {refresh.months} months of {dataset} "
+                "summaries")
+
+# Keeps summaries current at a fixed interval, whatever wrote the rows
+async def run_summary_refresh(database: Database, interval: int) -> None:
+    while True:
+        try:
+            await refresh_summary_tables(database)
+        except Exception as e:
+            logger.warn("--- SUMMARY REFRESH ERROR ---")
+            logger.warn(e)
+            logger.warn("--- SUMMARY REFRESH ERROR ---")
+        await asyncio.sleep(interval)
+
+def start_summary_refresh(app: FastAPI) -> None:
+    database = getattr(app.state, "_db", None)
+    if database:
+        app.state._summary_refresh = asyncio.create_task(run_summary_refresh(
+            database, SUMMARY_REFRESH_INTERVAL))
+
+async def stop_summary_refresh(app: FastAPI) -> None:
+    task = getattr(app.state, "_summary_refresh", None)
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions = True)
+
+# Builds missing indexes of the large tables once the app is up
+async def run_index_builds(database: Database) -> None:
+    try:
+        built = await create_table_indexes(database)
+        if built:
+            logger.info(f"Built indexes {', '.join(built)}")
+    except Exception as e:
+        logger.warn("--- INDEX BUILD ERROR ---")
+        logger.warn(e)
+        logger.warn("--- INDEX BUILD ERROR ---")
+
+def start_index_builds(app: FastAPI) -> None:
+    database = getattr(app.state, "_db", None)
+    if database:
+        app.state._index_builds = asyncio.create_task(
+            run_index_builds(database))
+
+# Cancelled builds leave invalid indexes, rebuilt on the next start
+async def stop_index_builds(app: FastAPI) -> None:
+    task = getattr(app.state, "_index_builds", None)
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions = True)
@@ -0,0 +1,73 @@
+from datetime import datetime
+from enum import Enum
+from typing import List, Optional
+
+from pydantic import Json
+
+from app.models.core import IDModelMixin, CoreModel
+
+
+class ExportFormat(str, Enum):
+    csv = "csv"
+    parquet = "parquet"
+    geojson = "geojson"
+    ndjson = "ndjson"
+    zip = "zip"
+
+class ExportEncoding(str, Enum):
+    gzip = "gzip"
+    zstd = "zstd"
+
+class ExportJobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+class ExportResult(CoreModel):
+    """
+    Outcome of a finished export, written to a download file
+    """
+    download_id: int
+    row_count: int
+    file_size: int
+
+class ExportJob(CoreModel):
+    """
+    Background export job as reported by the status endpoints
+    """
+    job_id: str
+    dataset: str
+    status: ExportJobStatus = ExportJobStatus.queued
+    download_id: Optional[int]
+    row_count: Optional[int]
+    file_size: Optional[int]
+    error: Optional[str]
+
+class ExportRecord(IDModelMixin, CoreModel):
+    """
+    Entry of the export registry describing a download file
+    """
+    dataset: str
+    format: ExportFormat = ExportFormat.csv
+    encoding: Optional[ExportEncoding]
+    filter: Json
+    owner: Optional[str]
+    path: str
+    status: str
+    row_count: Optional[int]
+    file_size: Optional[int]
+    created_at: datetime
+    completed_at: Optional[datetime]
+    accessed_at: Optional[datetime]
+    evicted_at: Optional[datetime]
+
+class ExportEviction(CoreModel):
+    """
+    Downloads evicted and files removed by a retention run
+    """
+    evicted: List[int] = []
+    # exports left running by a crash or restart, marked failed
+    abandoned: List[int] = []
+    bytes_freed: int = 0
+    files_removed: int = 0
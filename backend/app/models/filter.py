@@ -1,23 +1,119 @@
+import hashlib
+import json
+from datetime import datetime
+from enum import Enum
+from typing import List, Optional, Union
+
 from app.models.core import CoreModel
 
 
-class Filter(CoreModel):
+class TaxonomyMatch(str, Enum):
+    exact = "exact"
+    prefix = "prefix"
+    contains = "contains"
+
+class ExportFilter(CoreModel):
+    """
+    Common fields and logic shared by the export filters
+    """
+    # min lon, min lat, max lon, max lat in WGS 84
+    bbox: Optional[List[float]] = None
+    # WKT or GeoJSON polygon in WGS 84
+    geometry: Optional[Union[dict, str]] = None
+
+    class Config:
+        # Values are stripped as they are given, so the queries bind the
+        # same values the cache key is built from
+        anystr_strip_whitespace = True
+
+    # Returns canonical key identifying the export the filter produces
+    def cache_key(self, dataset: str, format: str = "csv") -> str:
+        fields = {}
+        for name, value in self.dict().items():
+            if value is None or value == "":
+                continue
+            # Matches are case insensitive
+            if isinstance(value, str):
+                value = value.casefold()
+            fields[name] = value
+        # Year overrides any date range given
+        year = fields.pop("year", None)
+        if year:
+            fields["startDate"] = f"{year}-01-01"
+            fields["endDate"] = f"{year}-12-31"
+        # Ranges are only applied when both ends are given
+        for start, end in (("startDate", "endDate"),
+                ("startValue", "endValue")):
+            if not (fields.get(start) and fields.get(end)):
+                fields.pop(start, None)
+                fields.pop(end, None)
+        for name in ("startDate", "endDate"):
+            if name in fields:
+                try:
+                    fields[name] = datetime.strptime(
+                        fields[name], '%Y-%m-%d').date().isoformat()
+                except ValueError:
+                    pass
+        canonical = json.dumps([dataset, format, fields], sort_keys = True,
+            default = str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+class Filter(ExportFilter):
     classification_level: str = ""
     classification_name: str = ""
+    classification_match: TaxonomyMatch = TaxonomyMatch.prefix
     year: int = 0
     startDate: str = ""
     endDate: str = ""
     location_name: str = ""
     location_type: str = ""
 
-class MCIFilter(CoreModel):
+class MCIFilter(ExportFilter):
     startValue: float = None
     endValue: float = None
     indicator: str = ""
-    year: int = None
+    year: Optional[int] = None
     startDate: str = ""
     endDate: str = ""
     location_name: str = ""
     location_type: str = ""
     river_catchment: str = ""
-    landcover_type: str = ""
\ No newline at end of file
+    landcover_type: str = ""
+
+class FilterStatementStats(CoreModel):
+    """
+    Reuse of the compiled statements of a dataset's filter queries
+    """
+    # query texts compiled in this process and lookups of them
+    statements: int
+    compile_hits: int
+    compile_misses: int
+    # statements prepared on the connection asking, and the plans Postgres
+    # made for their executions there
+    prepared: int = 0
+    generic_plans: int = 0
+    custom_plans: int = 0
+    # executions and plannings of the statements across every connection,
+    # only known when pg_stat_statements is installed
+    executions: Optional[int] = None
+    plans: Optional[int] = None
+
+class ExportFilterBatch(CoreModel):
+    """
+    Filters exported together from one pass over a dataset
+    """
+    filters: List[ExportFilter]
+
+    # Returns key identifying the archive the batch produces, which depends
+    # on the filters and their order
+    def cache_key(self, dataset: str, format: str = "csv") -> str:
+        keys = [filter.cache_key(dataset = dataset, format = format)
+            for filter in self.filters]
+        canonical = json.dumps([dataset, "batch", keys])
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+class FilterBatch(ExportFilterBatch):
+    filters: List[Filter]
+
+class MCIFilterBatch(ExportFilterBatch):
+    filters: List[MCIFilter]
@@ -0,0 +1,27 @@
+from enum import Enum
+from typing import List
+
+from app.models.core import CoreModel
+
+
+class GridShape(str, Enum):
+    hexagon = "hexagon"
+    square = "square"
+
+class GridCell(CoreModel):
+    """
+    Occurrences and species counted in one cell of a grid
+    """
+    i: int
+    j: int
+    occurrences: int
+    species: int
+    geometry: dict
+
+class Grid(CoreModel):
+    """
+    Cells of a grid holding occurrences a filter matches
+    """
+    shape: GridShape
+    cell_size: float
+    cells: List[GridCell]
@@ -0,0 +1,25 @@
+from typing import List, Optional
+
+from app.models.core import CoreModel
+from app.models.export import ExportJobStatus
+
+
+class IngestResult(CoreModel):
+    """
+    Outcome of a bulk load, with a sample of the rows rejected
+    """
+    rows_loaded: int = 0
+    rows_rejected: int = 0
+    errors: List[str] = []
+    locations_assigned: Optional[int]
+    months_summarised: Optional[int]
+
+class IngestJob(CoreModel):
+    """
+    Background bulk load as reported by the status endpoint
+    """
+    job_id: str
+    dataset: str
+    status: ExportJobStatus = ExportJobStatus.queued
+    result: Optional[IngestResult]
+    error: Optional[str]
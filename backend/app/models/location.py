@@ -0,0 +1,23 @@
+from typing import List
+
+from app.models.core import CoreModel
+
+
+class LocationAssignment(CoreModel):
+    """
+    Points of a dataset assigned to locations by an assignment run
+    """
+    dataset: str
+    points: int = 0
+    locations: int = 0
+    # points were left queued as the key keeping links unique is not built
+    waiting: bool = False
+
+class LocationLoad(CoreModel):
+    """
+    Outcome of loading a file of location polygons
+    """
+    loaded: int = 0
+    skipped: int = 0
+    repaired: int = 0
+    invalid: List[str] = []
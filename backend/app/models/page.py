@@ -0,0 +1,20 @@
+from typing import List, Optional
+
+from app.models.core import CoreModel
+
+
+class Page(CoreModel):
+    """
+    One page of rows and the cursor of the page following it
+    """
+    results: List[dict]
+    next: Optional[str]
+
+class ChangesPage(CoreModel):
+    """
+    Rows inserted or updated after a sync token, in the order they changed,
+    and the token the changes following them are read from
+    """
+    results: List[dict]
+    token: str
+    more: bool
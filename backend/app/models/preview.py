@@ -0,0 +1,13 @@
+from typing import List, Optional
+
+from app.models.core import CoreModel
+
+
+class Preview(CoreModel):
+    """
+    Size and first rows of the export a filter would produce
+    """
+    estimated_count: int
+    count: Optional[int]
+    exact: bool = False
+    results: List[dict] = []
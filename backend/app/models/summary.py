@@ -0,0 +1,18 @@
+from typing import List
+
+from app.models.core import CoreModel
+
+
+class Summary(CoreModel):
+    """
+    Aggregates of a dataset grouped by the dimensions asked for
+    """
+    group_by: List[str]
+    results: List[dict]
+
+class SummaryRefresh(CoreModel):
+    """
+    Months of a dataset rebuilt by a summary refresh
+    """
+    dataset: str
+    months: int = 0
@@ -0,0 +1,9 @@
+from app.models.core import CoreModel
+
+
+class TileEviction(CoreModel):
+    """
+    Cached map tiles removed by a retention run
+    """
+    tiles_removed: int = 0
+    bytes_freed: int = 0
@@ -0,0 +1,12 @@
+from datetime import datetime
+from typing import Optional
+
+from app.models.core import CoreModel
+
+
+class TableVersion(CoreModel):
+    """
+    Summed write counters of a set of tables and when they last changed
+    """
+    version: int = 0
+    updated_at: Optional[datetime] = None
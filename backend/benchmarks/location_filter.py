@@ -0,0 +1,136 @@
+"""
+Compares plans of the occurrence filter query before and after location
+filtering moved to an EXISTS semi-join.
+
+Seeds synthetic occurrences, each inside one region and one rohe, runs
+EXPLAIN ANALYZE of both queries for a few filters and rolls everything back.
+Run against the test database from the backend directory:
+
+    python -m benchmarks.location_filter --occurrences 1000000
+"""
+import argparse
+import asyncio
+
+from databases import Database
+
+from app.core.config import TEST_DATABASE_URL
+from app.db.repositories.occurrence import OccurrenceRepository
+from app.models.filter import Filter
+
+
+# Occurrence filter query as built before the semi-join, always joining
+# every location row of an occurrence
+LEGACY_FILTER_QUERY = """
+    SELECT main.occurrence.*
+    FROM main.occurrence
+    LEFT JOIN main.location ON main.occurrence.id = main.location.occurrence_id
+    LEFT JOIN main.locationref ON main.location.location_name = \
+        main.locationref.name"""
+
+LEGACY_CONDITIONS = {
+    "classification_pattern": "LOWER(main.occurrence.scientific_name) LIKE \
+        LOWER(:classification_pattern)",
+    "location_name": "LOWER(main.location.location_name) = \
+        LOWER(:location_name)",
+    "location_type": "LOWER(main.locationref.locationtype) = \
+        LOWER(:location_type)"
+}
+
+SEED_LOCATIONREF_QUERY = """
+    INSERT INTO main.locationref (name, polygon, locationtype)
+    SELECT 'Benchmark ' || initcap(type) || ' ' || n, \
+        'SRID=4326;POLYGON((0 0,1 0,1 1,0 1,0 0))', type
+    FROM generate_series(1, :count) AS n, \
+        (VALUES ('region'), ('rohe')) AS types(type)
+"""
+
+SEED_OCCURRENCE_QUERY = """
+    INSERT INTO main.occurrence (scientific_name, observation_count, \
+        observation_date, taxon_rank, occurrence_species, occurrence_genus, \
+        occurrence_kingdom)
+    SELECT 'Benchgenus species' || (n % 500) || ' Author, 1900', 1, \
+        date '2000-01-01' + (n % 7000), 'SPECIES', \
+        'Benchgenus species' || (n % 500), 'Benchgenus', 'Animalia'
+    FROM generate_series(1, :count) AS n
+"""
+
+SEED_LOCATION_QUERY = """
+    INSERT INTO main.location (occurrence_id, location_name)
+    SELECT main.occurrence.id, \
+        'Benchmark ' || initcap(types.type) || ' ' || \
+        (main.occurrence.id % :locations + 1)
+    FROM main.occurrence, (VALUES ('region'), ('rohe')) AS types(type)
+    WHERE main.occurrence.scientific_name LIKE 'Benchgenus %'
+"""
+
+# Filters compared, from no location filter to both name and type
+BENCHMARK_FILTERS = {
+    "taxonomy only": Filter(classification_name = "Benchgenus species7"),
+    "location type": Filter(location_type = "region"),
+    "location name": Filter(location_name = "Benchmark Region 3"),
+    "taxonomy and location": Filter(
+        classification_name = "Benchgenus species7",
+        location_name = "Benchmark Rohe 3",
+        location_type = "rohe"
+    )
+}
+
+
+# Builds filter query as it was built before the semi-join
+def buildLegacyQuery(args: dict) -> str:
+    conditions = [LEGACY_CONDITIONS[name] for name in LEGACY_CONDITIONS
+        if name in args]
+    query = LEGACY_FILTER_QUERY
+    if conditions:
+        query += "\n    WHERE " + "\n    AND ".join(conditions)
+    return query
+
+# Returns plan text and row count of a query
+async def explain(db: Database, query: str, args: dict):
+    plan = await db.fetch_all(
+        query = "EXPLAIN (ANALYZE, BUFFERS) " + query,
+        values = args
+    )
+    count = await db.fetch_val(
+        query = f"SELECT COUNT(*) FROM ({query}) AS results",
+        values = args
+    )
+    return "\n".join(row[0] for row in plan), count
+
+async def run(database_url: str, occurrences: int, locations: int) -> None:
+    db = Database(database_url)
+    await db.connect()
+    transaction = await db.transaction()
+    try:
+        # Seeded rows only live inside this transaction
+        await db.execute(SEED_LOCATIONREF_QUERY, {"count": locations})
+        await db.execute(SEED_OCCURRENCE_QUERY, {"count": occurrences})
+        await db.execute(SEED_LOCATION_QUERY, {"locations": locations})
+        for table in ("main.occurrence", "main.location", "main.locationref"):
+            await db.execute(f"ANALYZE {table}")
+        occurrence_repo = OccurrenceRepository(db)
+        for name, filter in BENCHMARK_FILTERS.items():
+            query, args = occurrence_repo.build_filter_query(filter = filter)
+            legacy_plan, legacy_count = await explain(
+                db, buildLegacyQuery(args), args)
+            plan, count = await explain(db, query, args)
+            print(f"=== {name} ===")
+            print(f"--- before: {legacy_count} rows")
+            print(legacy_plan)
+            print(f"--- after: {count} rows")
+            print(plan)
+            print()
+    finally:
+        await transaction.rollback()
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.strip())
+    parser.add_argument("--database-url", default = str(TEST_DATABASE_URL))
+    parser.add_argument("--occurrences", type = int, default = 1000000)
+    parser.add_argument("--locations", type = int, default = 16,
+        help = "number of regions and of rohe occurrences are spread over")
+    options = parser.parse_args()
+    asyncio.run(run(options.database_url, options.occurrences,
+        options.locations))
@@ -1,6 +1,6 @@
 import warnings
 import os
-import csv
+import subprocess
 import sys
 
 import pytest
@@ -13,7 +13,9 @@ from alembic.config import Config
 
 from app.api.services import auth_service
 from app.models.security import UserInDB, UserCreate, UserUpdateRole
+from app.models.mci import MCIPublic
 from app.models.occurrence import OccurrencePublic, OccurrenceCreate
+from app.db.repositories.location import LocationRepository
 from app.db.repositories.occurrence import OccurrenceRepository
 from app.db.repositories.users import UserRepository
 from app.core.config import JWT_TOKEN_PREFIX, TEST_DATABASE_URL, DATABASE_URL
@@ -26,6 +28,12 @@ def apply_migrations():
     config = Config("alembic.ini")
     
     alembic.command.upgrade(config, "head")
+    # Large table changes the migrations may not include yet
+    subprocess.run([sys.executable, "-m", "app.cli", "migrate-tables"],
+        check = True)
+    # Built in the background by the app, tests need them in place first
+    subprocess.run([sys.executable, "-m", "app.cli", "create-indexes"],
+        check = True)
     yield
     alembic.command.downgrade(config, "base")
 
@@ -94,19 +102,10 @@ async def test_occurrence(db: Database) -> OccurrencePublic:
         occurrence_phylum = 'Chordata',
         occurrence_kingdom = 'Animalia'
     )
-    csv.field_size_limit(sys.maxsize)
-    location_file = csv.DictReader(open(
-        "./location_data/regional_council_boundaries_clipped.csv"
-    ))
-    for row in location_file:
-        name = row['name']
-        polygon = row['polygon']
-        type = row['locationtype']
-        await occurrence_repo.add_location(
-            name = name,
-            polygon = polygon,
-            location_type = type
-        )
+    # Loads region polygons in batches, keeping any already loaded
+    await LocationRepository(db).load_locations(
+        source = "./location_data/regional_council_boundaries_clipped.csv"
+    )
     occurrence = await occurrence_repo.get_occurrence_by_id(id = 1)
     if occurrence:
         return occurrence
@@ -115,6 +114,30 @@ async def test_occurrence(db: Database) -> OccurrencePublic:
     )
     return occurrence
 
+@pytest.fixture
+async def test_mci(db: Database) -> MCIPublic:
+    mci = await db.fetch_one(
+        query = """SELECT id, value, indicator, observation_date, 
+            occurrence_latitude, occurrence_longitude, river_catchment, 
+            landcover_type FROM main.mci WHERE river_catchment = :catchment
+            ORDER BY id LIMIT 1""",
+        values = {"catchment": "Waimakariri"}
+    )
+    if mci:
+        return MCIPublic(**mci)
+    mci = await db.fetch_one(
+        query = """INSERT INTO main.mci (value, indicator, observation_date, 
+            occurrence_latitude, occurrence_longitude, river_catchment, 
+            landcover_type)
+            VALUES (100, 'mci', '2015-05-22', -43.486205, 172.697703, 
+            :catchment, 'pasture')
+            RETURNING id, value, indicator, observation_date, 
+            occurrence_latitude, occurrence_longitude, river_catchment, 
+            landcover_type""",
+        values = {"catchment": "Waimakariri"}
+    )
+    return MCIPublic(**mci)
+
 @pytest.fixture
 def authorized_client(client: AsyncClient, test_user: UserInDB) -> AsyncClient:
     access_token = auth_service.create_token_for_user(user = test_user)
@@ -123,4 +146,24 @@ def authorized_client(client: AsyncClient, test_user: UserInDB) -> AsyncClient:
         **client.headers,
         "Authorization": f"{JWT_TOKEN_PREFIX} {access_token}",
     }
-    return client
\ No newline at end of file
+    return client
+
+@pytest.fixture
+async def admin_client(client: AsyncClient, db: Database) -> AsyncClient:
+    user_repo = UserRepository(db)
+    admin = await user_repo.get_user_by_email(email = "admin@email.io")
+    if not admin:
+        admin = await user_repo.register_new_user(new_user = UserCreate(
+            email = "admin@email.io",
+            password = "adminpassword"
+        ))
+    await user_repo.update_user_role(update_role_user = UserUpdateRole(
+        email = admin.email,
+        role = "ADMIN"
+    ))
+    access_token = auth_service.create_token_for_user(user = admin)
+    client.headers = {
+        **client.headers,
+        "Authorization": f"{JWT_TOKEN_PREFIX} {access_token}",
+    }
+    return client
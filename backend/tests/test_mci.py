@@ -0,0 +1,232 @@
+import io
+import json
+import zipfile
+from typing import Tuple
+
+import pandas as pd
+import pytest
+from httpx import AsyncClient
+from fastapi import FastAPI
+from starlette.status import (
+    HTTP_200_OK,
+    HTTP_202_ACCEPTED,
+    HTTP_401_UNAUTHORIZED
+)
+from databases import Database
+
+from app.models.filter import MCIFilter, MCIFilterBatch
+from app.models.mci import MCIPublic
+from app.db.repositories.mci import MCIRepository
+from app.db.repositories.summary import SummaryRepository
+from tests.test_occurrence import (
+    SCANNED_TABLE_PATTERN,
+    explainWithoutSeqScan,
+    wait_for_job
+)
+
+# decorate all tests with @pytest.mark.asyncio
+pytestmark = pytest.mark.asyncio
+
+# Copies a measurement, returning the id of the copy
+INSERT_MCI_COPY_QUERY = """
+    INSERT INTO main.mci (value, indicator, observation_date,
+        occurrence_latitude, occurrence_longitude, river_catchment,
+        landcover_type)
+    SELECT value, indicator, observation_date, occurrence_latitude,
+        occurrence_longitude, river_catchment, landcover_type
+    FROM main.mci WHERE id = :id
+    RETURNING id
+"""
+
+
+class TestGetMCI:
+    async def test_get_mci_pages_by_cursor(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_mci: MCIPublic
+            ) -> None:
+        await db.fetch_val(query = INSERT_MCI_COPY_QUERY,
+            values = {'id': test_mci.id})
+        path = app.url_path_for('mcidata:get_all_mci_data')
+        res = await authorized_client.get(path, params = {'limit': 1})
+        assert res.status_code == HTTP_200_OK
+        first = res.json()
+        assert len(first.get('results')) == 1
+        assert first.get('next')
+        res = await authorized_client.get(
+            path, params = {'limit': 1, 'cursor': first.get('next')})
+        assert res.status_code == HTTP_200_OK
+        second = res.json()
+        assert len(second.get('results')) == 1
+        assert (second.get('results')[0].get('id')
+            > first.get('results')[0].get('id'))
+
+
+class TestMCIChanges:
+    async def sync(
+            self,
+            app: FastAPI,
+            client: AsyncClient,
+            params: dict
+            ) -> Tuple[list, str]:
+        results = []
+        while True:
+            res = await client.get(
+                app.url_path_for('mcidata:get_mci_changes'),
+                params = {**params, 'limit': 1000}
+            )
+            assert res.status_code == HTTP_200_OK
+            results += res.json().get('results')
+            params = {'token': res.json().get('token')}
+            if not res.json().get('more'):
+                return results, params['token']
+
+    async def test_sync_returns_rows_changed_after_token(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_mci: MCIPublic
+            ) -> None:
+        _, token = await self.sync(app, authorized_client, {})
+        created = await db.fetch_val(query = INSERT_MCI_COPY_QUERY,
+            values = {'id': test_mci.id})
+        await db.execute(
+            query = """UPDATE main.mci SET value = value + 1
+                WHERE id = :id""",
+            values = {'id': test_mci.id}
+        )
+        results, next_token = await self.sync(
+            app, authorized_client, {'token': token})
+        assert {row['id'] for row in results} == {created, test_mci.id}
+        # Caught up syncs return nothing and keep the token
+        results, last_token = await self.sync(
+            app, authorized_client, {'token': next_token})
+        assert results == []
+        assert last_token == next_token
+
+
+class TestMCISummary:
+    async def test_summary_by_indicator_and_year(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_mci: MCIPublic
+            ) -> None:
+        await SummaryRepository(db).refresh_summaries(dataset = "mci")
+        res = await authorized_client.get(
+            app.url_path_for('mcidata:get_mci_summary'),
+            params = {"group_by": ["indicator", "year"]}
+        )
+        assert res.status_code == HTTP_200_OK
+        results = res.json().get('results')
+        assert {"indicator": "mci", "year": 2015} in [
+            {"indicator": row["indicator"], "year": row["year"]}
+            for row in results]
+        assert all(row["measurements"] >= 1 for row in results)
+
+
+class TestMCIPreview:
+    async def test_preview_counts_small_results_exactly(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_mci: MCIPublic
+            ) -> None:
+        filter = MCIFilter(river_catchment = "waimak")
+        res = await authorized_client.post(
+            app.url_path_for('mcidata:preview_mci_data'),
+            data = filter.json(),
+            params = {"limit": 1}
+        )
+        assert res.status_code == HTTP_200_OK
+        preview = res.json()
+        assert preview.get('exact')
+        assert preview.get('count') >= 1
+        assert preview.get('estimated_count') == preview.get('count')
+        assert len(preview.get('results')) == 1
+        assert preview.get('results')[0]['river_catchment'] == 'Waimakariri'
+
+
+class TestMCIBatchExport:
+    async def test_batch_matches_separate_exports(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_mci: MCIPublic
+            ) -> None:
+        filters = [
+            MCIFilter(indicator = "mci"),
+            MCIFilter(river_catchment = "waimak", year = 2015),
+            MCIFilter(river_catchment = "NoSuchCatchment")
+        ]
+        expected = []
+        for filter in filters:
+            res = await authorized_client.post(
+                app.url_path_for('mcidata:create_mci_download'),
+                data = filter.json()
+            )
+            job = await wait_for_job(app, authorized_client,
+                res.json().get('job_id'),
+                name = 'mcidata:get_mci_download_job')
+            expected.append(job.get('row_count'))
+        res = await authorized_client.post(
+            app.url_path_for('mcidata:create_mci_batch_download'),
+            data = MCIFilterBatch(filters = filters).json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        job = await wait_for_job(app, authorized_client,
+            res.json().get('job_id'), name = 'mcidata:get_mci_download_job')
+        assert job.get('status') == 'done'
+        assert job.get('row_count') == sum(expected)
+        res = await authorized_client.get(
+            app.url_path_for(
+                'mcidata:retrieve_mci_download',
+                download_id = job.get('download_id')
+            ),
+            params = {'format': 'zip'}
+        )
+        assert res.status_code == HTTP_200_OK
+        with zipfile.ZipFile(io.BytesIO(res.content)) as archive:
+            manifest = json.loads(archive.read('manifest.json'))
+            assert [member['row_count'] for member in manifest] == expected
+            rows = pd.read_csv(io.BytesIO(archive.read('filter_2.csv')))
+        assert test_mci.id in rows['id'].tolist()
+
+
+class TestMCIFilterIndexes:
+    @pytest.mark.parametrize(
+        "filter",
+        (
+            MCIFilter(startValue = 80, endValue = 120),
+            MCIFilter(indicator = "mci"),
+            MCIFilter(river_catchment = "waimak"),
+            MCIFilter(landcover_type = "pasture"),
+            MCIFilter(year = 2015),
+            MCIFilter(location_name = "Canterbury Region",
+                location_type = "region"),
+            MCIFilter(bbox = [172, -44, 173, -43])
+        )
+    )
+    async def test_mci_filters_use_indexes(
+            self,
+            db: Database,
+            filter: MCIFilter
+            ) -> None:
+        query, args = MCIRepository(db).build_filter_query(filter)
+        plan = await explainWithoutSeqScan(db, query, args)
+        assert not SCANNED_TABLE_PATTERN.search(plan), plan
+
+
+class TestMCIFilterStatements:
+    async def test_statement_stats_need_admin(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient
+            ) -> None:
+        res = await authorized_client.get(
+            app.url_path_for("mcidata:get_mci_statement_stats"))
+        assert res.status_code == HTTP_401_UNAUTHORIZED
@@ -1,25 +1,90 @@
+import asyncio
 import json
+import re
 import time
 import os
 import pandas as pd
 import io
+import zipfile
 from typing import Tuple
 
 import pytest
 from httpx import AsyncClient
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from starlette.status import (
-    HTTP_200_OK
+    HTTP_200_OK,
+    HTTP_202_ACCEPTED,
+    HTTP_206_PARTIAL_CONTENT,
+    HTTP_304_NOT_MODIFIED,
+    HTTP_401_UNAUTHORIZED,
+    HTTP_404_NOT_FOUND,
+    HTTP_410_GONE,
+    HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+    HTTP_422_UNPROCESSABLE_ENTITY
 )
 from databases import Database
 
-from app.models.occurrence import OccurrencePublic
-from app.models.filter import Filter
-from app.db.repositories.occurrence import OccurrenceRepository
+from app.core.config import (
+    EXPORT_BATCH_MAX_FILTERS, 
+    OCCURRENCE_DOWNLOAD_PATH, 
+    TAXONOMY_TRIGRAM_INDEXES,
+    TEST_DATABASE_URL
+)
+from app.models.occurrence import OccurrenceCreate, OccurrencePublic
+from app.models.filter import Filter, FilterBatch
+from app.api.services.export import acceptsEncoding
+from app.api.services.jobs import ExportJobService
+from app.db.repositories.batch import buildBatchCondition
+from app.db.repositories.cache import ExportCacheRepository
+from app.db.repositories.compiler import compileFilterQuery
+from app.db.repositories.export import ExportRepository
+from app.db.repositories.grid import GridRepository
+from app.db.repositories.ingest import IngestRepository
+from app.db.repositories.jobs import ExportJobRepository
+from app.db.repositories.location import LocationRepository
+from app.db.repositories.occurrence import (
+    OCCURRENCE_FILTER_COMPILER, 
+    OccurrenceRepository
+)
+from app.db.repositories.summary import SummaryRepository
+from app.db.repositories.tile import evictTiles, getTilePath
+from app.db.tasks import refresh_summary_tables
 
 # decorate all tests with @pytest.mark.asyncio
 pytestmark = pytest.mark.asyncio  
 
+# Polls download job until it has finished and returns the job
+async def wait_for_job(
+        app: FastAPI, 
+        client: AsyncClient, 
+        job_id: str, 
+        timeout: float = 30,
+        name: str = 'occurrence:get_download_job'
+        ) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        res = await client.get(app.url_path_for(name, job_id = job_id))
+        assert res.status_code == HTTP_200_OK
+        job = res.json()
+        if job.get('status') in ('done', 'failed'):
+            return job
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.1)
+
+# Large tables a selective filter must reach through an index
+SCANNED_TABLE_PATTERN = re.compile(
+    r"Seq Scan on (occurrence|location|mci|mci_location)\b")
+
+SQUARE = "POLYGON((172 -44,173 -44,173 -43,172 -43,172 -44))"
+
+# Returns plan of a query when sequential scans are priced out, so any left
+# are scans no index can replace
+async def explainWithoutSeqScan(db: Database, query: str, args: dict) -> str:
+    async with db.transaction():
+        await db.execute(query = "SET LOCAL enable_seqscan = off")
+        rows = await db.fetch_all(query = "EXPLAIN " + query, values = args)
+    return "\n".join(row["QUERY PLAN"] for row in rows)
+
 class TestGetOccurrence:
     async def test_get_all_occurrences(
             self, 
@@ -31,6 +96,206 @@ class TestGetOccurrence:
             app.url_path_for('occurrence:get_all_occurrences')
         )
         assert res.status_code == HTTP_200_OK
+        assert res.json().get('results')
+
+    async def test_get_occurrences_pages_by_cursor(
+            self, 
+            app: FastAPI, 
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        occurrence_repo = OccurrenceRepository(db)
+        await occurrence_repo.create_occurrence(
+            OccurrenceCreate(**test_occurrence.dict(exclude = {'id'})))
+        path = app.url_path_for('occurrence:get_all_occurrences')
+        res = await authorized_client.get(path, params = {'limit': 1})
+        assert res.status_code == HTTP_200_OK
+        first = res.json()
+        assert len(first.get('results')) == 1
+        assert first.get('next')
+        res = await authorized_client.get(
+            path, params = {'limit': 1, 'cursor': first.get('next')})
+        assert res.status_code == HTTP_200_OK
+        second = res.json()
+        assert len(second.get('results')) == 1
+        assert (second.get('results')[0].get('id') 
+            > first.get('results')[0].get('id'))
+
+    async def test_get_occurrences_projects_fields(
+            self, 
+            app: FastAPI, 
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_all_occurrences'),
+            params = {'fields': 'scientific_name,observation_date'}
+        )
+        assert res.status_code == HTTP_200_OK
+        for row in res.json().get('results'):
+            assert set(row) == {'id', 'scientific_name', 'observation_date'}
+
+    async def test_get_occurrences_answers_if_none_match(
+            self, 
+            app: FastAPI, 
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        path = app.url_path_for('occurrence:get_all_occurrences')
+        res = await authorized_client.get(path)
+        assert res.status_code == HTTP_200_OK
+        etag = res.headers.get('etag')
+        assert etag
+        assert res.headers.get('last-modified')
+        for if_none_match in (etag, 'W/' + etag, f'"other", {etag}'):
+            res = await authorized_client.get(
+                path, headers = {'If-None-Match': if_none_match})
+            assert res.status_code == HTTP_304_NOT_MODIFIED
+            assert res.headers.get('etag') == etag
+            assert res.content == b''
+        # Writes bump the table version so the page is sent again
+        occurrence_repo = OccurrenceRepository(db)
+        await occurrence_repo.create_occurrence(
+            OccurrenceCreate(**test_occurrence.dict(exclude = {'id'})))
+        res = await authorized_client.get(
+            path, headers = {'If-None-Match': etag})
+        assert res.status_code == HTTP_200_OK
+        assert res.headers.get('etag') != etag
+
+    @pytest.mark.parametrize(
+        "params",
+        (
+            {'cursor': 'not-a-cursor'},
+            {'fields': 'password'},
+            {'limit': 0},
+        )
+    )
+    async def test_get_occurrences_rejects_invalid_page(
+            self, 
+            app: FastAPI, 
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic,
+            params: dict
+            ) -> None:
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_all_occurrences'),
+            params = params
+        )
+        assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+
+class TestOccurrenceChanges:
+    async def sync(
+            self,
+            app: FastAPI,
+            client: AsyncClient,
+            params: dict
+            ) -> Tuple[list, str]:
+        results = []
+        while True:
+            res = await client.get(
+                app.url_path_for('occurrence:get_occurrence_changes'),
+                params = {**params, 'limit': 1000}
+            )
+            assert res.status_code == HTTP_200_OK
+            results += res.json().get('results')
+            params = {'token': res.json().get('token')}
+            if not res.json().get('more'):
+                return results, params['token']
+
+    async def test_sync_returns_rows_changed_after_token(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        _, token = await self.sync(app, authorized_client, {})
+        occurrence_repo = OccurrenceRepository(db)
+        created = await occurrence_repo.create_occurrence(
+            OccurrenceCreate(**test_occurrence.dict(exclude = {'id'})))
+        await db.execute(
+            query = """UPDATE main.occurrence 
+                SET observation_count = observation_count + 1
+                WHERE id = :id""",
+            values = {'id': test_occurrence.id}
+        )
+        results, next_token = await self.sync(
+            app, authorized_client, {'token': token})
+        assert {row['id'] for row in results} == {
+            created.id, test_occurrence.id}
+        # Caught up syncs return nothing and keep the token
+        results, last_token = await self.sync(
+            app, authorized_client, {'token': next_token})
+        assert results == []
+        assert last_token == next_token
+
+    async def test_sync_advances_during_open_export(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        _, token = await self.sync(app, authorized_client, {})
+        # An export holds a read only transaction open on its own connection
+        # while a row is written and the feed is read
+        export_db = Database(TEST_DATABASE_URL)
+        await export_db.connect()
+        try:
+            async with export_db.transaction():
+                await export_db.fetch_val(
+                    query = "SELECT COUNT(*) FROM main.occurrence")
+                await db.execute(
+                    query = """UPDATE main.occurrence
+                        SET observation_count = observation_count + 1
+                        WHERE id = :id""",
+                    values = {'id': test_occurrence.id}
+                )
+                results, _ = await self.sync(
+                    app, authorized_client, {'token': token})
+        finally:
+            await export_db.disconnect()
+        assert [row['id'] for row in results] == [test_occurrence.id]
+
+    async def test_sync_from_time_given(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        results, _ = await self.sync(
+            app, authorized_client, {'since': '2000-01-01T00:00:00+00:00'})
+        assert test_occurrence.id in [row['id'] for row in results]
+        results, _ = await self.sync(
+            app, authorized_client, {'since': '2999-01-01T00:00:00+00:00'})
+        assert results == []
+
+    async def test_sync_always_returns_updated_at(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_occurrence_changes'),
+            params = {'fields': 'scientific_name'}
+        )
+        assert res.status_code == HTTP_200_OK
+        for row in res.json().get('results'):
+            assert set(row) == {'id', 'scientific_name', 'updated_at'}
+
+    async def test_sync_rejects_invalid_token(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient
+            ) -> None:
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_occurrence_changes'),
+            params = {'token': 'not-a-token'}
+        )
+        assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
 
 class TestCreateOccurrenceFilter:
     async def test_can_create_empty_filter_download(
@@ -41,24 +306,25 @@ class TestCreateOccurrenceFilter:
             authorized_client: AsyncClient
             ) -> None:
         filter = Filter()
-        previous_download = './occurrence_download/file_0.csv'
-        if(os.path.exists(previous_download)):
-            os.remove(previous_download)
         occurrence_repo = OccurrenceRepository(db)
         occurrences = await occurrence_repo.get_occurrences_by_filter(
             filter = filter)
-        for rec in occurrences: 
-            print(tuple(rec.values()))
         assert occurrences
         res = await authorized_client.post(
             app.url_path_for('occurrence:create_occurrence_download'),
             data = filter.json()
         )
-        print(filter.json())
-        id = res.json().get('download_id')
-        print(id)
-        path = './occurrence_download/' + f'file_{id}.csv'
-        assert os.path.exists(path)
+        assert res.status_code == HTTP_202_ACCEPTED
+        job = await wait_for_job(
+            app, authorized_client, res.json().get('job_id'))
+        assert job.get('status') == 'done'
+        assert job.get('row_count') > 0
+        id = job.get('download_id')
+        export = await ExportRepository(db).get_export(
+            id = id, dataset = 'occurrence')
+        assert export.status == 'done'
+        assert export.row_count == job.get('row_count')
+        assert os.path.exists(export.path)
         res = await authorized_client.get(
             app.url_path_for(
                 'occurrence:retrieve_download',
@@ -75,20 +341,20 @@ class TestCreateOccurrenceFilter:
             ex_startDate, ex_endDate, ex_location_name, ex_location_type, \
             status_code, returns',
             (
-                ("Kingdom", "Animalia", 0, "", "", "", "", 201, True),
-                ("", "Branta canadensis", 0, "", "", "", "", 201, True),
-                ("Family", "Notafamily", 0, "", "", "", "", 201, False),
+                ("Kingdom", "Animalia", 0, "", "", "", "", 202, True),
+                ("", "Branta canadensis", 0, "", "", "", "", 202, True),
+                ("Family", "Notafamily", 0, "", "", "", "", 202, False),
                 ("NotaCLevel", "Animalia", 0, "", "", "","", 422, False),
-                ("", "", 2015, "", "", "", "", 201, True),
-                ("", "", 2007, "", "", "", "", 201, False),
-                ("", "", 2015, "2007-10-15", "2007-10-16", "", "", 201, True),
-                ("", "", 2007, "2015-05-20", "2015-05-22", "", "", 201, False),
+                ("", "", 2015, "", "", "", "", 202, True),
+                ("", "", 2007, "", "", "", "", 202, False),
+                ("", "", 2015, "2007-10-15", "2007-10-16", "", "", 202, True),
+                ("", "", 2007, "2015-05-20", "2015-05-22", "", "", 202, False),
                 ("", "", 0, "NotaDate", "NotaDate", "", "", 422, False),
-                ("", "", 0, "", "", "Canterbury Region", "region", 201, True),
-                ("", "", 0, "", "", "Waikato Region", "region", 201, False),
+                ("", "", 0, "", "", "Canterbury Region", "region", 202, True),
+                ("", "", 0, "", "", "Waikato Region", "region", 202, False),
                 ("", "", 0, "", "", "Not a region", "notalocation", 422, False),
                 ("Kingdom", "Animalia", 0, "2015-05-20", "2015-05-22", \
-                    "Canterbury Region", "region", 201, True)
+                    "Canterbury Region", "region", 202, True)
             )
         )
     
@@ -108,9 +374,6 @@ class TestCreateOccurrenceFilter:
             status_code: int,
             returns: bool,
             ) -> None:     
-        previous_download = './occurrence_download/file_0.csv'
-        if(os.path.exists(previous_download)):
-            os.remove(previous_download)
         filter = Filter(
             classification_level = ex_classification_level,
             classification_name = ex_classification_name,
@@ -120,37 +383,25 @@ class TestCreateOccurrenceFilter:
             location_name = ex_location_name,
             location_type = ex_location_type
         )
-        print(filter.json())
         occurrence_repo = OccurrenceRepository(db)
-        occurrence = await occurrence_repo.get_all_occurrences()
-        for rec in occurrence: 
-            print(tuple(rec.values()))
         if(returns):
             occurrences = await occurrence_repo.get_occurrences_by_filter(
                 filter = filter)
-            for rec in occurrences: 
-                print(tuple(rec.values()))
             assert occurrences
-        new_filter = {
-            "classification_level": ex_classification_level,
-            "classification_name": ex_classification_name,
-            "year": ex_year,
-            "startDate": ex_startDate,
-            "endDate": ex_endDate,
-            "location_name": ex_location_name,
-            "location_type": ex_location_type
-        }
-        print(json.dumps(new_filter))
         res = await authorized_client.post(
             app.url_path_for('occurrence:create_occurrence_download'),
             data = filter.json()
         )
         assert res.status_code == status_code    
-        if status_code == 201:
-            download_id = res.json().get('download_id')
-            print(download_id)
-            path = './occurrence_download/' + f'file_{download_id}.csv'
-            assert os.path.exists(path)
+        if status_code == 202:
+            job = await wait_for_job(
+                app, authorized_client, res.json().get('job_id'))
+            assert job.get('status') == 'done'
+            assert (job.get('row_count') > 0) is returns
+            download_id = job.get('download_id')
+            export = await ExportRepository(db).get_export(
+                id = download_id, dataset = 'occurrence')
+            assert os.path.exists(export.path)
             res = await authorized_client.get(
                 app.url_path_for(
                     'occurrence:retrieve_download',
@@ -161,8 +412,1253 @@ class TestCreateOccurrenceFilter:
             df = pd.read_csv(io.StringIO(content.decode('utf-8')))
             assert df.columns[0] == 'id'
             assert (not df.empty) is returns
-            
 
+    async def test_job_status_read_by_other_processes(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            data = Filter(classification_name = "Chordata").json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        job = await wait_for_job(
+            app, authorized_client, res.json().get('job_id'))
+        # A service that never ran the job, as after a restart or in
+        # another worker, reports it from the job table
+        job_service = ExportJobService()
+        job_service.job_repo = ExportJobRepository(db)
+        other = await job_service.get_job(
+            job_id = job['job_id'], dataset = "occurrence")
+        assert other.status == "done"
+        assert other.download_id == job['download_id']
+        assert other.row_count == job['row_count']
+        assert await job_service.get_job(
+            job_id = job['job_id'], dataset = "mci") is None
+
+
+class TestOccurrenceTaxonomyMatch:
+    @pytest.mark.parametrize(
+        'level, name, match, returns',
+        (
+            ("Species", "branta canadensis", "exact", True),
+            ("", "Branta", "exact", False),
+            ("", "BRANTA CANADENSIS", "prefix", True),
+            ("Class", "Ave", "prefix", True),
+            ("Class", "Ave", "exact", False),
+            ("", "Bran%", "prefix", False),
+            ("", "Bra_ta", "prefix", False),
+            ("", "(Branta)", "prefix", False),
+        )
+    )
+    async def test_taxonomy_match_modes(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic,
+            level: str,
+            name: str,
+            match: str,
+            returns: bool
+            ) -> None:
+        filter = Filter(
+            classification_level = level,
+            classification_name = name,
+            classification_match = match
+        )
+        occurrences = await OccurrenceRepository(db).get_occurrences_by_filter(
+            filter = filter)
+        assert bool(occurrences) is returns
+
+    async def test_substring_match_requires_trigram_indexes(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filter = Filter(classification_name = "canadensis", 
+            classification_match = "contains")
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            data = filter.json()
+        )
+        if TAXONOMY_TRIGRAM_INDEXES:
+            assert res.status_code == HTTP_202_ACCEPTED
+        else:
+            assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+
+
+class TestOccurrenceLocationFilter:
+    async def test_location_tables_only_joined_when_filtered(
+            self,
+            db: Database
+            ) -> None:
+        occurrence_repo = OccurrenceRepository(db)
+        query, _ = occurrence_repo.build_filter_query(
+            filter = Filter(classification_name = "Branta"))
+        assert "main.location" not in query
+        query, _ = occurrence_repo.build_filter_query(
+            filter = Filter(location_name = "Canterbury Region"))
+        assert "EXISTS" in query
+        assert "main.locationref" not in query
+
+    async def test_location_filter_returns_each_occurrence_once(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filter = Filter(location_type = "region")
+        occurrences = await OccurrenceRepository(db).get_occurrences_by_filter(
+            filter = filter)
+        ids = [occurrence["id"] for occurrence in occurrences]
+        assert ids
+        assert len(ids) == len(set(ids))
+
+
+class TestLocationAssignment:
+    async def test_assigns_new_occurrences_to_locations(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        location_repo = LocationRepository(db)
+        assignment = await location_repo.assign_locations(
+            dataset = "occurrence", full = True)
+        assert assignment.points > 0
+        occurrences = await OccurrenceRepository(db).get_occurrences_by_filter(
+            filter = Filter(location_name = "Canterbury Region"))
+        assert test_occurrence.id in [row["id"] for row in occurrences]
+        # Only points added or moved since the last run are checked again
+        assignment = await location_repo.assign_locations(
+            dataset = "occurrence")
+        assert assignment.points == 0
+        assert assignment.locations == 0
+        # Rechecking every point does not duplicate assignments
+        assignment = await location_repo.assign_locations(
+            dataset = "occurrence", full = True)
+        assert assignment.locations == 0
+
+    async def test_reassigns_moved_occurrences(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        location_repo = LocationRepository(db)
+        occurrence_repo = OccurrenceRepository(db)
+        created = await occurrence_repo.create_occurrence(
+            OccurrenceCreate(**test_occurrence.dict(exclude = {'id'})))
+        await location_repo.assign_locations(dataset = "occurrence")
+        filter = Filter(location_name = "Canterbury Region")
+        occurrences = await occurrence_repo.get_occurrences_by_filter(
+            filter = filter)
+        assert created.id in [row["id"] for row in occurrences]
+        # Moving a point queues it again and drops the links it left
+        await db.execute(
+            query = """UPDATE main.occurrence 
+                SET occurrence_latitude = -36.85, 
+                    occurrence_longitude = 174.76
+                WHERE id = :id""",
+            values = {'id': created.id}
+        )
+        assignment = await location_repo.assign_locations(
+            dataset = "occurrence")
+        assert assignment.points >= 1
+        occurrences = await occurrence_repo.get_occurrences_by_filter(
+            filter = filter)
+        assert created.id not in [row["id"] for row in occurrences]
+
+
+class TestOccurrenceSpatialFilter:
+    @pytest.mark.parametrize(
+        'bbox, geometry, returns',
+        (
+            ([172.6, -43.6, 172.8, -43.4], None, True),
+            ([174.7, -36.9, 174.8, -36.8], None, False),
+            (None, "POLYGON((172.6 -43.6, 172.8 -43.6, 172.8 -43.4, "
+                "172.6 -43.4, 172.6 -43.6))", True),
+            (None, {"type": "Polygon", "coordinates": [[[172.6, -43.6], 
+                [172.8, -43.6], [172.8, -43.4], [172.6, -43.4], 
+                [172.6, -43.6]]]}, True),
+            (None, {"type": "Polygon", "coordinates": [[[174.7, -36.9], 
+                [174.8, -36.9], [174.8, -36.8], [174.7, -36.8], 
+                [174.7, -36.9]]]}, False),
+        )
+    )
+    async def test_spatial_filters(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic,
+            bbox: list,
+            geometry,
+            returns: bool
+            ) -> None:
+        filter = Filter(bbox = bbox, geometry = geometry)
+        occurrences = await OccurrenceRepository(db).get_occurrences_by_filter(
+            filter = filter)
+        ids = [occurrence["id"] for occurrence in occurrences]
+        assert (test_occurrence.id in ids) is returns
+
+    @pytest.mark.parametrize(
+        'bbox, geometry',
+        (
+            ([172.8, -43.6, 172.6, -43.4], None),
+            ([172.6, -43.6, 172.8], None),
+            (None, "POINT(172.7 -43.5)"),
+            (None, {"type": "LineString", "coordinates": [[0, 0], [1, 1]]}),
+            (None, "POLYGON((1 2, 3))"),
+            (None, "POLYGON((172.6 -43.6, 172.8 -43.6, 172.8 -43.4))"),
+            (None, {"type": "Polygon", "coordinates": [[[0, 0], [1, 1]]]}),
+        )
+    )
+    async def test_invalid_spatial_filters_rejected(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            bbox: list,
+            geometry
+            ) -> None:
+        filter = Filter(bbox = bbox, geometry = geometry)
+        for route in ('occurrence:create_occurrence_download', 
+                'occurrence:preview_occurrences', 
+                'occurrence:get_occurrence_grid'):
+            res = await authorized_client.post(
+                app.url_path_for(route),
+                data = filter.json()
+            )
+            assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+
+
+class TestOccurrenceIngest:
+    async def test_bulk_load_darwin_core_rows(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        source = io.BytesIO(
+            b"scientificName\teventDate\ttaxonRank\tdecimalLatitude\t"
+            b"decimalLongitude\tindividualCount\tkingdom\n"
+            b"Ingestus testus\t2020-01-02T10:00:00\tSPECIES\t-43.5\t"
+            b"172.7\t3\tAnimalia\n"
+            b"Ingestus testus\t2020-01-03/2020-01-04\tSPECIES\t\t\t\t"
+            b"Animalia\n"
+            b"Ingestus testus\tnot a date\tSPECIES\t-43.5\t172.7\t1\t"
+            b"Animalia\n"
+            b"Ingestus testus\t2020-01-05\tSPECIES\t95\t172.7\t1.5\t"
+            b"Animalia\n"
+        )
+        result = await IngestRepository(db).ingest_occurrences(
+            source = source,
+            delimiter = "\t",
+            assign_locations = False
+        )
+        assert result.rows_loaded == 2
+        assert result.rows_rejected == 2
+        assert result.errors[0].startswith("line 4:")
+        assert "invalid observation_date" in result.errors[0]
+        assert "invalid occurrence_latitude" in result.errors[1]
+        assert "invalid observation_count" in result.errors[1]
+        occurrences = await OccurrenceRepository(db).get_occurrences_by_filter(
+            filter = Filter(classification_name = "Ingestus testus",
+                classification_match = "exact"))
+        assert len(occurrences) >= 2
+
+    async def test_bulk_load_requires_columns(
+            self,
+            db: Database
+            ) -> None:
+        source = io.BytesIO(b"scientific_name,taxon_rank\nA b,SPECIES\n")
+        with pytest.raises(HTTPException) as error:
+            await IngestRepository(db).ingest_occurrences(source = source)
+        assert error.value.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+
+    async def test_ingest_queued_as_job(
+            self,
+            app: FastAPI,
+            admin_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        # Uploads are sent as multipart forms rather than json
+        del admin_client.headers['Content-Type']
+        source = (
+            b"scientific_name,observation_date,taxon_rank\n"
+            b"Queuedus testus,2020-01-02,SPECIES\n"
+            b"Queuedus testus,not a date,SPECIES\n"
+        )
+        res = await admin_client.post(
+            app.url_path_for('occurrence:ingest_occurrences'),
+            files = {'file': ('rows.csv', source)},
+            params = {'assign_locations': False}
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        job = await wait_for_job(app, admin_client, res.json().get('job_id'),
+            name = 'occurrence:get_ingest_job')
+        assert job.get('status') == 'done'
+        assert job.get('result').get('rows_loaded') == 1
+        assert job.get('result').get('rows_rejected') == 1
+        # A load failing its checks fails the job with the reason
+        res = await admin_client.post(
+            app.url_path_for('occurrence:ingest_occurrences'),
+            files = {'file': ('rows.csv', b"scientific_name\nA b\n")}
+        )
+        job = await wait_for_job(app, admin_client, res.json().get('job_id'),
+            name = 'occurrence:get_ingest_job')
+        assert job.get('status') == 'failed'
+        assert job.get('error').startswith("Missing columns")
+
+
+class TestLocationLoad:
+    async def test_load_locations_in_batches(
+            self,
+            db: Database
+            ) -> None:
+        source = (
+            b'name,polygon,locationtype\n'
+            b'"Loader Square","POLYGON((0 0,1 0,1 1,0 1,0 0))",region\n'
+            b'"Loader Bowtie","POLYGON((0 0,1 1,1 0,0 1,0 0))",region\n'
+        )
+        location_repo = LocationRepository(db)
+        result = await location_repo.load_locations(
+            source = io.BytesIO(source), repair = False, batch_size = 1)
+        assert result.invalid == ["Loader Bowtie"]
+        result = await location_repo.load_locations(
+            source = io.BytesIO(source), batch_size = 1)
+        assert result.loaded == 1
+        assert result.repaired == 1
+        assert result.skipped == 1
+        # Reloads replace polygons only when asked to
+        result = await location_repo.load_locations(
+            source = io.BytesIO(source), update = True)
+        assert result.loaded == 2
+        assert result.skipped == 0
+
+    async def test_load_repeated_name_keeps_last(
+            self,
+            db: Database
+            ) -> None:
+        source = (
+            b'name,polygon,locationtype\n'
+            b'"Loader Repeat","POLYGON((0 0,1 0,1 1,0 1,0 0))",region\n'
+            b'"Loader Repeat","POLYGON((0 0,2 0,2 2,0 2,0 0))",district\n'
+        )
+        result = await LocationRepository(db).load_locations(
+            source = io.BytesIO(source), update = True)
+        assert result.loaded == 1
+        assert result.skipped == 1
+        location = await db.fetch_one(
+            query = "SELECT locationtype, ST_XMax(polygon) AS xmax \
+                FROM main.locationref WHERE name = :name",
+            values = {"name": "Loader Repeat"}
+        )
+        assert location["locationtype"] == "district"
+        assert location["xmax"] == 2
+
+
+class TestOccurrenceFilterStatements:
+    async def test_compile_positional_statement(self) -> None:
+        statement, names = compileFilterQuery(
+            query = "SELECT CAST(:a AS date), :b::text WHERE x = :a")
+        assert statement == "SELECT CAST($1 AS date), $2::text WHERE x = $1"
+        assert names == ["a", "b"]
+
+    async def test_filter_shape_reuses_statement(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        occurrence_repo = OccurrenceRepository(db)
+        await occurrence_repo.get_occurrences_by_filter(
+            filter = Filter(classification_name = "Aves", year = 2015))
+        before = await occurrence_repo.get_filter_statement_stats()
+        # Same fields set with other values compile to the same statement
+        occurrences = await occurrence_repo.get_occurrences_by_filter(
+            filter = Filter(classification_name = "Branta", year = 2014))
+        after = await occurrence_repo.get_filter_statement_stats()
+        assert after.compile_hits == before.compile_hits + 1
+        assert after.compile_misses == before.compile_misses
+        assert after.statements == before.statements
+        assert not occurrences
+        # Postgres executed the statement already prepared on the connection
+        assert after.prepared == before.prepared >= 1
+        assert after.generic_plans + after.custom_plans == \
+            before.generic_plans + before.custom_plans + 1
+
+    async def test_statement_stats_need_admin(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient
+            ) -> None:
+        res = await authorized_client.get(
+            app.url_path_for("occurrence:get_filter_statement_stats"))
+        assert res.status_code == HTTP_401_UNAUTHORIZED
+
+
+class TestOccurrenceSummary:
+    async def test_refresh_only_changed_months(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        summary_repo = SummaryRepository(db)
+        await summary_repo.refresh_summaries(dataset = "occurrence")
+        refresh = await summary_repo.refresh_summaries(dataset = "occurrence")
+        assert refresh.months == 0
+        # Updating a row marks its month for the next refresh
+        await db.execute(
+            query = "UPDATE main.occurrence SET observation_count = 1 \
+                WHERE id = :id",
+            values = {"id": test_occurrence.id}
+        )
+        refresh = await summary_repo.refresh_summaries(dataset = "occurrence")
+        assert refresh.months == 1
+
+    async def test_refresh_not_held_back_by_open_reads(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        summary_repo = SummaryRepository(db)
+        await summary_repo.refresh_summaries(dataset = "occurrence")
+        # An export keeps a read only transaction open on another connection
+        # while a row is written and the summaries refreshed
+        async with app.state._db.connection() as connection:
+            async with connection.transaction():
+                await connection.fetch_val(
+                    query = "SELECT COUNT(*) FROM main.occurrence")
+                await db.execute(
+                    query = "UPDATE main.occurrence \
+                        SET observation_count = 1 WHERE id = :id",
+                    values = {"id": test_occurrence.id}
+                )
+                refresh = await summary_repo.refresh_summaries(
+                    dataset = "occurrence")
+        assert refresh.months == 1
+
+    async def test_refresh_months_rows_left(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        summary_repo = SummaryRepository(db)
+        created = await OccurrenceRepository(db).create_occurrence(
+            OccurrenceCreate(**{**test_occurrence.dict(exclude = {'id'}),
+                'observation_date': '1990-01-15'}))
+        await summary_repo.refresh_summaries(dataset = "occurrence")
+        assert await summary_repo.get_summary(dataset = "occurrence",
+            group_by = ["year"], start_year = 1990, end_year = 1990)
+        # The month a row moves out of is rebuilt with the one it moves to
+        await db.execute(
+            query = "UPDATE main.occurrence \
+                SET observation_date = '1991-02-01' WHERE id = :id",
+            values = {"id": created.id}
+        )
+        refresh = await summary_repo.refresh_summaries(dataset = "occurrence")
+        assert refresh.months == 2
+        assert not await summary_repo.get_summary(dataset = "occurrence",
+            group_by = ["year"], start_year = 1990, end_year = 1990)
+        # As is the month of a deleted row
+        await db.execute(
+            query = "DELETE FROM main.occurrence WHERE id = :id",
+            values = {"id": created.id}
+        )
+        refresh = await summary_repo.refresh_summaries(dataset = "occurrence")
+        assert refresh.months == 1
+        assert not await summary_repo.get_summary(dataset = "occurrence",
+            group_by = ["year"], start_year = 1991, end_year = 1991)
+
+    async def test_summary_by_class_and_year(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        await SummaryRepository(db).refresh_summaries(dataset = "occurrence")
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_occurrence_summary'),
+            params = {"group_by": ["class", "year"]}
+        )
+        assert res.status_code == HTTP_200_OK
+        results = res.json().get('results')
+        assert {"class": "Aves", "year": 2015} in [
+            {"class": row["class"], "year": row["year"]} for row in results]
+        assert all(row["occurrences"] >= 1 for row in results)
 
-        
+    async def test_summary_by_location(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        await LocationRepository(db).assign_locations(dataset = "occurrence")
+        await SummaryRepository(db).refresh_summaries(dataset = "occurrence")
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_occurrence_summary'),
+            params = {"group_by": ["location_name"], "start_year": 2015, 
+                "end_year": 2015}
+        )
+        assert res.status_code == HTTP_200_OK
+        names = [row["location_name"] for row in res.json().get('results')]
+        assert "Canterbury Region" in names
 
+    async def test_refresh_cycle_summarises_written_rows(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        # Rows written outside the ingest endpoint show up once the
+        # background task has run
+        await OccurrenceRepository(db).create_occurrence(
+            OccurrenceCreate(**{**test_occurrence.dict(exclude = {'id'}),
+                'observation_date': '1985-03-10'}))
+        await refresh_summary_tables(db)
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_occurrence_summary'),
+            params = {"group_by": ["year"], "start_year": 1985,
+                "end_year": 1985}
+        )
+        assert res.status_code == HTTP_200_OK
+        results = res.json().get('results')
+        assert [row["year"] for row in results] == [1985]
+        assert results[0]["occurrences"] >= 1
+
+    async def test_unknown_dimension_rejected(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient
+            ) -> None:
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_occurrence_summary'),
+            params = {"group_by": ["scientific_name"]}
+        )
+        assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+
+
+class TestOccurrenceFilterIndexes:
+    @pytest.mark.parametrize(
+        "filter",
+        (
+            Filter(classification_level = "class", 
+                classification_name = "Aves"),
+            Filter(classification_name = "Branta", 
+                classification_match = "exact"),
+            Filter(year = 2015),
+            Filter(location_name = "Canterbury Region"),
+            Filter(location_name = "canterbury region", 
+                location_type = "Region"),
+            Filter(bbox = [172, -44, 173, -43]),
+            Filter(geometry = SQUARE)
+        )
+    )
+    async def test_occurrence_filters_use_indexes(
+            self,
+            db: Database,
+            filter: Filter
+            ) -> None:
+        query, args = OccurrenceRepository(db).build_filter_query(
+            filter = filter)
+        plan = await explainWithoutSeqScan(db, query, args)
+        assert not SCANNED_TABLE_PATTERN.search(plan), plan
+
+
+class TestOccurrencePreview:
+    async def test_preview_counts_small_results_exactly(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filter = Filter(classification_level = "class", 
+            classification_name = "Aves")
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:preview_occurrences'),
+            data = filter.json(),
+            params = {"limit": 1}
+        )
+        assert res.status_code == HTTP_200_OK
+        preview = res.json()
+        assert preview.get('exact')
+        assert preview.get('count') >= 1
+        assert preview.get('estimated_count') == preview.get('count')
+        assert len(preview.get('results')) == 1
+        assert preview.get('results')[0]['occurrence_class'] == 'Aves'
+
+    async def test_preview_caps_exact_count(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        occurrence_repo = OccurrenceRepository(db)
+        await occurrence_repo.create_occurrence(
+            OccurrenceCreate(**test_occurrence.dict(exclude = {'id'})))
+        query, args = occurrence_repo.build_filter_query(filter = Filter())
+        preview = await occurrence_repo.preview_filter(
+            compiler = OCCURRENCE_FILTER_COMPILER,
+            query = query,
+            values = args,
+            limit = 0,
+            count_limit = 1
+        )
+        assert not preview.exact
+        assert preview.count is None
+        assert preview.estimated_count >= 2
+        assert preview.results == []
+
+    async def test_preview_explains_compiled_statement(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        occurrence_repo = OccurrenceRepository(db)
+        query, args = occurrence_repo.build_filter_query(
+            filter = Filter(classification_name = "Aves", year = 2015))
+        preview = await occurrence_repo.preview_filter(
+            compiler = OCCURRENCE_FILTER_COMPILER,
+            query = query,
+            values = args,
+            limit = 0
+        )
+        # The estimate is planned from the same positional statement
+        statement, _ = compileFilterQuery(query = query)
+        assert statement in OCCURRENCE_FILTER_COMPILER.compiled_statements()
+        assert preview.exact
+        assert preview.estimated_count == preview.count
+
+    async def test_preview_of_no_matches(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filter = Filter(classification_name = "Not a taxon")
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:preview_occurrences'),
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_200_OK
+        assert res.json().get('exact')
+        assert res.json().get('count') == 0
+        assert res.json().get('results') == []
+
+
+class TestOccurrenceTiles:
+    async def test_tile_cached_until_tables_change(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        url = app.url_path_for('occurrence:get_occurrence_tile', 
+            z = "0", x = "0", y = "0")
+        params = {"classification_level": "class", 
+            "classification_name": "Aves"}
+        res = await authorized_client.get(url, params = params)
+        assert res.status_code == HTTP_200_OK
+        assert res.headers["content-type"] == \
+            "application/vnd.mapbox-vector-tile"
+        assert res.content
+        table_version = await ExportCacheRepository(db).get_table_version(
+            dataset = "occurrence")
+        path = getTilePath(
+            filter = Filter(**params), 
+            table_version = table_version, 
+            z = 0, 
+            x = 0, 
+            y = 0
+        )
+        assert os.path.exists(path)
+        # Writes to the occurrence tables move tiles to a new version
+        await OccurrenceRepository(db).create_occurrence(
+            OccurrenceCreate(**test_occurrence.dict(exclude = {'id'})))
+        res = await authorized_client.get(url, params = params)
+        assert res.status_code == HTTP_200_OK
+        assert not os.path.exists(path)
+
+    async def test_least_recently_read_tiles_evicted(
+            self,
+            tmp_path
+            ) -> None:
+        directory = tmp_path / "occurrence" / "1" / "0"
+        directory.mkdir(parents = True)
+        for index, name in enumerate(["old", "read", "new"]):
+            path = directory / f"{name}.mvt"
+            path.write_bytes(b"x" * 100)
+            os.utime(path, (index, index))
+        # Reading a tile makes it the most recently used
+        os.utime(directory / "read.mvt", (10, 10))
+        eviction = evictTiles(directory = str(tmp_path), quota = 200)
+        assert eviction.tiles_removed == 1
+        assert eviction.bytes_freed == 100
+        assert not (directory / "old.mvt").exists()
+        assert (directory / "read.mvt").exists()
+        eviction = evictTiles(directory = str(tmp_path), quota = 0)
+        assert eviction.tiles_removed == 2
+
+    async def test_unclustered_tile_at_deep_zoom(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        # Tile of zoom 16 holding the test occurrence near Christchurch
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_occurrence_tile', 
+                z = "16", x = "64206", y = "41576")
+        )
+        assert res.status_code == HTTP_200_OK
+        assert res.content
+
+    async def test_tile_outside_zoom_level(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient
+            ) -> None:
+        res = await authorized_client.get(
+            app.url_path_for('occurrence:get_occurrence_tile', 
+                z = "1", x = "2", y = "0")
+        )
+        assert res.status_code == HTTP_404_NOT_FOUND
+
+
+class TestOccurrenceGrid:
+    @pytest.mark.parametrize("shape", ("hexagon", "square"))
+    async def test_grid_counts_occurrences_and_species(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic,
+            shape: str
+            ) -> None:
+        filter = Filter(classification_name = "Branta canadensis")
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:get_occurrence_grid'),
+            params = {"cell_size": 50000, "shape": shape},
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_200_OK
+        cells = res.json().get('cells')
+        assert sum(cell['occurrences'] for cell in cells) >= 1
+        assert all(cell['species'] == 1 for cell in cells)
+        assert cells[0]['geometry']['type'] == 'Polygon'
+
+    async def test_grid_cached_per_filter_and_cell_size(
+            self,
+            db: Database,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        grid_repo = GridRepository(db)
+        filter = Filter(classification_name = "Branta")
+        grid = await grid_repo.get_occurrence_grid(
+            filter = filter, cell_size = 20000)
+        table_version = await ExportCacheRepository(db).get_table_version(
+            dataset = "occurrence")
+        cache_key = filter.cache_key(
+            dataset = "occurrence", format = "hexagon-grid-20000")
+        cells = await grid_repo.get_cached_grid(
+            cache_key = cache_key, table_version = table_version)
+        assert cells == grid.cells
+        cells = await grid_repo.get_cached_grid(
+            cache_key = cache_key, table_version = table_version + 1)
+        assert cells is None
+
+    async def test_grid_cell_size_too_small(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient
+            ) -> None:
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:get_occurrence_grid'),
+            params = {"cell_size": 1},
+            data = Filter().json()
+        )
+        assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+
+    async def test_grid_too_many_cells(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient
+            ) -> None:
+        # Kilometre cells over the whole country are refused, larger cells
+        # over the same area are not
+        filter = Filter(bbox = [166, -47, 179, -34])
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:get_occurrence_grid'),
+            params = {"cell_size": 1000},
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:get_occurrence_grid'),
+            params = {"cell_size": 10000},
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_200_OK
+
+
+class TestExportRetention:
+    async def test_evicted_download_is_gone(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filter = Filter(classification_name = "Branta", year = 2015)
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        job = await wait_for_job(
+            app, authorized_client, res.json().get('job_id'))
+        download_id = job.get('download_id')
+        export_repo = ExportRepository(db)
+        export = await export_repo.get_export(
+            id = download_id, dataset = "occurrence")
+        # Nothing fits a zero byte quota
+        eviction = await export_repo.evict_exports(quota = 0)
+        assert download_id in eviction.evicted
+        assert eviction.bytes_freed >= job.get('file_size')
+        assert not os.path.exists(export.path)
+        res = await authorized_client.get(
+            app.url_path_for(
+                'occurrence:retrieve_download',
+                download_id = download_id
+            )
+        )
+        assert res.status_code == HTTP_410_GONE
+        # Cached results pointing at evicted files are not reused
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        assert res.json().get('download_id') != download_id
+
+    async def test_finished_export_kept_over_quota(
+            self,
+            app: FastAPI,
+            db: Database,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            data = Filter(classification_name = "Anatidae").json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        job = await wait_for_job(
+            app, authorized_client, res.json().get('job_id'))
+        download_id = job.get('download_id')
+        # The export just written outlives the pass it finished in, even
+        # when it alone is over the quota
+        eviction = await ExportRepository(db).evict_exports(
+            quota = 0, keep = download_id)
+        assert download_id not in eviction.evicted
+        res = await authorized_client.get(
+            app.url_path_for(
+                'occurrence:retrieve_download',
+                download_id = download_id
+            )
+        )
+        assert res.status_code == HTTP_200_OK
+
+    async def test_abandoned_export_failed(
+            self,
+            db: Database
+            ) -> None:
+        export_repo = ExportRepository(db)
+        # An export whose process stopped while writing it stays running
+        export = await export_repo.create_export(
+            dataset = "occurrence", filter = Filter())
+        eviction = await export_repo.evict_exports(max_runtime = 3600)
+        assert export.id not in eviction.abandoned
+        eviction = await export_repo.evict_exports(max_runtime = 0)
+        assert export.id in eviction.abandoned
+        export = await export_repo.get_export(
+            id = export.id, dataset = "occurrence")
+        assert export.status == "failed"
+
+    async def test_unregistered_files_removed(
+            self,
+            db: Database
+            ) -> None:
+        os.makedirs(OCCURRENCE_DOWNLOAD_PATH, exist_ok = True)
+        path = os.path.join(OCCURRENCE_DOWNLOAD_PATH, "file_1.csv")
+        with open(path, "w") as file:
+            file.write("id\n")
+        eviction = await ExportRepository(db).evict_exports(min_age = 0)
+        assert eviction.files_removed >= 1
+        assert not os.path.exists(path)
+
+
+class TestOccurrenceExportCache:
+    async def test_equivalent_filters_share_cache_key(self) -> None:
+        filter = Filter(
+            classification_level = "Class",
+            classification_name = "Aves",
+            year = 2015,
+            location_name = "Canterbury Region"
+        )
+        equivalent = Filter(
+            location_name = "canterbury region ",
+            startDate = "2015-01-01",
+            endDate = "2015-12-31",
+            classification_name = "AVES",
+            classification_level = "class"
+        )
+        different = Filter(classification_name = "Aves", year = 2016)
+        assert filter.cache_key("occurrence") == \
+            equivalent.cache_key("occurrence")
+        assert filter.cache_key("occurrence") != \
+            different.cache_key("occurrence")
+        assert filter.cache_key("occurrence") != filter.cache_key("mci")
+        # Filters sharing a key match the same rows
+        assert equivalent.location_name == "canterbury region"
+        assert Filter(classification_name = " Aves").classification_name \
+            == "Aves"
+
+    async def test_repeated_filter_reuses_download(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filter = Filter(classification_level = "Class", 
+            classification_name = "Aves")
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        first = await wait_for_job(
+            app, authorized_client, res.json().get('job_id'))
+        assert first.get('status') == 'done'
+        filter = Filter(classification_level = "class", 
+            classification_name = "aves")
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        assert res.json().get('status') == 'done'
+        assert res.json().get('download_id') == first.get('download_id')
+
+
+class TestOccurrenceParquetExport:
+    async def test_can_create_parquet_download(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filter = Filter(classification_level = "Kingdom", 
+            classification_name = "Animalia")
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            params = {'format': 'parquet'},
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        job = await wait_for_job(
+            app, authorized_client, res.json().get('job_id'))
+        assert job.get('status') == 'done'
+        res = await authorized_client.get(
+            app.url_path_for(
+                'occurrence:retrieve_download',
+                download_id = job.get('download_id')
+            ),
+            params = {'format': 'csv'}
+        )
+        assert res.status_code == HTTP_404_NOT_FOUND
+        res = await authorized_client.get(
+            app.url_path_for(
+                'occurrence:retrieve_download',
+                download_id = job.get('download_id')
+            ),
+            params = {'format': 'parquet'}
+        )
+        assert res.status_code == HTTP_200_OK
+        df = pd.read_parquet(io.BytesIO(res.content))
+        assert len(df) == job.get('row_count')
+        assert df.columns[0] == 'id'
+        assert str(df['occurrence_latitude'].dtype) == 'float64'
+        assert str(df['occurrence_kingdom'].dtype) == 'category'
+
+
+class TestOccurrenceGeoJsonExport:
+    async def create_download(
+            self,
+            app: FastAPI,
+            client: AsyncClient,
+            format: str
+            ) -> Tuple[dict, bytes]:
+        filter = Filter(classification_level = "Kingdom", 
+            classification_name = "Animalia")
+        res = await client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            params = {'format': format},
+            data = filter.json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        job = await wait_for_job(app, client, res.json().get('job_id'))
+        assert job.get('status') == 'done'
+        res = await client.get(
+            app.url_path_for(
+                'occurrence:retrieve_download',
+                download_id = job.get('download_id')
+            ),
+            params = {'format': format}
+        )
+        assert res.status_code == HTTP_200_OK
+        return job, res.content
+
+    async def test_can_create_geojson_download(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        job, content = await self.create_download(
+            app, authorized_client, 'geojson')
+        collection = json.loads(content)
+        assert collection['type'] == 'FeatureCollection'
+        assert len(collection['features']) == job.get('row_count')
+        feature = [feature for feature in collection['features']
+            if feature['id'] == test_occurrence.id][0]
+        assert feature['geometry'] == {
+            'type': 'Point',
+            'coordinates': [test_occurrence.occurrence_longitude, 
+                test_occurrence.occurrence_latitude]
+        }
+        assert feature['properties']['observation_date'] == '2015-05-22'
+        assert 'occurrence_latitude' not in feature['properties']
+
+    async def test_can_create_ndjson_download(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        job, content = await self.create_download(
+            app, authorized_client, 'ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        assert len(rows) == job.get('row_count')
+        assert test_occurrence.id in [row['id'] for row in rows]
+
+
+class TestOccurrenceBatchExport:
+    async def test_batch_conditions_do_not_share_parameters(
+            self,
+            db: Database
+            ) -> None:
+        occurrence_repo = OccurrenceRepository(db)
+        filter = Filter(classification_name = "Branta", year = 2015, 
+            location_type = "region")
+        conditions, args = occurrence_repo.build_filter_conditions(
+            filter = filter)
+        condition, condition_args = buildBatchCondition(
+            conditions = conditions, 
+            args = args, 
+            index = 3
+        )
+        assert 'WHERE main.location' in condition
+        assert not condition.startswith('WHERE')
+        assert condition.count(') AND (') == len(conditions) - 1
+        _, names = compileFilterQuery(query = condition)
+        assert set(names) == set(condition_args)
+        assert all(name.startswith('f3_') for name in names)
+        # Filters without conditions match every row
+        conditions, args = occurrence_repo.build_filter_conditions(
+            filter = Filter())
+        assert buildBatchCondition(conditions, args, 0) == ("TRUE", {})
+
+    async def test_batch_matches_separate_exports(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filters = [
+            Filter(classification_level = "Kingdom", 
+                classification_name = "Animalia"),
+            Filter(classification_name = "Branta", year = 2015),
+            Filter(classification_name = "NoSuchName")
+        ]
+        expected = []
+        for filter in filters:
+            res = await authorized_client.post(
+                app.url_path_for('occurrence:create_occurrence_download'),
+                data = filter.json()
+            )
+            job = await wait_for_job(
+                app, authorized_client, res.json().get('job_id'))
+            expected.append(job.get('row_count'))
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_batch_download'),
+            data = FilterBatch(filters = filters).json()
+        )
+        assert res.status_code == HTTP_202_ACCEPTED
+        job = await wait_for_job(
+            app, authorized_client, res.json().get('job_id'))
+        assert job.get('status') == 'done'
+        assert job.get('row_count') == sum(expected)
+        res = await authorized_client.get(
+            app.url_path_for(
+                'occurrence:retrieve_download',
+                download_id = job.get('download_id')
+            ),
+            params = {'format': 'zip'}
+        )
+        assert res.status_code == HTTP_200_OK
+        assert res.headers.get('content-type') == 'application/zip'
+        with zipfile.ZipFile(io.BytesIO(res.content)) as archive:
+            manifest = json.loads(archive.read('manifest.json'))
+            assert [member['row_count'] for member in manifest] == expected
+            files = {member['file']: pd.read_csv(
+                io.BytesIO(archive.read(member['file'])))
+                for member in manifest}
+        for member in manifest:
+            assert len(files[member['file']]) == member['row_count']
+        assert test_occurrence.id in files['filter_2.csv']['id'].tolist()
+
+    @pytest.mark.parametrize("count", [0, EXPORT_BATCH_MAX_FILTERS + 1])
+    async def test_batch_size_is_limited(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            count: int
+            ) -> None:
+        batch = FilterBatch(filters = [Filter(year = 2015)] * count)
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_batch_download'),
+            data = batch.json()
+        )
+        assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+
+    async def test_zip_is_not_a_row_format(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient
+            ) -> None:
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            params = {'format': 'zip'},
+            data = Filter(year = 2015).json()
+        )
+        assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+
+class TestOccurrenceCompressedDownload:
+    async def test_download_encoding_follows_accept_encoding(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filter = Filter(classification_name = "Branta")
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            data = filter.json()
+        )
+        job = await wait_for_job(
+            app, authorized_client, res.json().get('job_id'))
+        assert job.get('status') == 'done'
+        path = app.url_path_for(
+            'occurrence:retrieve_download',
+            download_id = job.get('download_id')
+        )
+        res = await authorized_client.get(
+            path, headers = {'Accept-Encoding': 'gzip'})
+        assert res.status_code == HTTP_200_OK
+        assert res.headers.get('content-encoding') == 'gzip'
+        encoded = pd.read_csv(io.StringIO(res.content.decode('utf-8')))
+        res = await authorized_client.get(
+            path, headers = {'Accept-Encoding': 'identity'})
+        assert res.status_code == HTTP_200_OK
+        assert 'content-encoding' not in res.headers
+        decoded = pd.read_csv(io.StringIO(res.content.decode('utf-8')))
+        assert encoded.equals(decoded)
+        assert not decoded.empty
+        # An explicit q=0 refuses the encoding wherever it appears
+        res = await authorized_client.get(
+            path, headers = {'Accept-Encoding': 'gzip, gzip;q=0'})
+        assert res.status_code == HTTP_200_OK
+        assert 'content-encoding' not in res.headers
+
+    @pytest.mark.parametrize(
+        "accept_encoding, encoding, accepted",
+        (
+            (None, "gzip", False),
+            ("gzip", "gzip", True),
+            ("deflate, gzip;q=0.5", "gzip", True),
+            ("gzip;q=0", "gzip", False),
+            ("gzip, gzip;q=0", "gzip", False),
+            ("gzip;q=0, *", "gzip", False),
+            ("*;q=1, zstd;q=0", "zstd", False),
+            ("*", "zstd", True),
+            ("*;q=0", "gzip", False),
+            ("identity", "gzip", False),
+        ),
+    )
+    async def test_accept_encoding_entries_all_read(
+            self,
+            accept_encoding: str,
+            encoding: str,
+            accepted: bool
+            ) -> None:
+        assert acceptsEncoding(accept_encoding, encoding) == accepted
+
+
+class TestOccurrenceRangeDownload:
+    async def test_download_supports_ranges_and_validators(
+            self,
+            app: FastAPI,
+            authorized_client: AsyncClient,
+            test_occurrence: OccurrencePublic
+            ) -> None:
+        filter = Filter(classification_name = "Branta")
+        res = await authorized_client.post(
+            app.url_path_for('occurrence:create_occurrence_download'),
+            params = {'format': 'parquet'},
+            data = filter.json()
+        )
+        job = await wait_for_job(
+            app, authorized_client, res.json().get('job_id'))
+        assert job.get('status') == 'done'
+        path = app.url_path_for(
+            'occurrence:retrieve_download',
+            download_id = job.get('download_id')
+        )
+        res = await authorized_client.get(path)
+        assert res.status_code == HTTP_200_OK
+        assert int(res.headers.get('content-length')) == job.get('file_size')
+        assert res.headers.get('accept-ranges') == 'bytes'
+        etag = res.headers.get('etag')
+        assert etag
+        # Parquet files start and end with their magic number
+        res = await authorized_client.get(
+            path, headers = {'Range': 'bytes=0-3', 'If-Range': etag})
+        assert res.status_code == HTTP_206_PARTIAL_CONTENT
+        assert res.content == b'PAR1'
+        res = await authorized_client.get(
+            path, headers = {'Range': 'bytes=-4'})
+        assert res.status_code == HTTP_206_PARTIAL_CONTENT
+        assert res.content == b'PAR1'
+        # Changed file validators ignore the range
+        res = await authorized_client.get(
+            path, headers = {'Range': 'bytes=0-3', 'If-Range': '"stale"'})
+        assert res.status_code == HTTP_200_OK
+        assert len(res.content) == job.get('file_size')
+        res = await authorized_client.get(
+            path, headers = {'Range': f"bytes={job.get('file_size')}-"})
+        assert res.status_code == HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+        res = await authorized_client.get(
+            path, headers = {'If-None-Match': etag})
+        assert res.status_code == HTTP_304_NOT_MODIFIED
@@ -8,6 +8,7 @@ from starlette.status import (
     HTTP_201_CREATED, 
     HTTP_404_NOT_FOUND,
     HTTP_200_OK,
+    HTTP_304_NOT_MODIFIED,
     HTTP_401_UNAUTHORIZED
 )
 
@@ -21,7 +22,12 @@ from app.core.config import (
     JWT_AUDIENCE, 
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
-from app.models.security import UserInDB, UserPublic
+from app.models.security import (
+    UserCreate, 
+    UserInDB, 
+    UserPublic, 
+    UserUpdateRole
+)
 from app.db.repositories.users import UserRepository
 from app.api.services import auth_service
 
@@ -342,3 +348,45 @@ class TestUserMe:
             headers={"Authorization": f"{jwt_prefix} {token}"}
         )
         assert res.status_code == HTTP_401_UNAUTHORIZED
+
+
+class TestUserList:
+    async def test_unchanged_users_not_modified(
+            self,
+            app: FastAPI,
+            admin_client: AsyncClient
+            ) -> None:
+        path = app.url_path_for("users:get_all_users")
+        res = await admin_client.get(path)
+        assert res.status_code == HTTP_200_OK
+        etag = res.headers.get("etag")
+        assert etag
+        res = await admin_client.get(path, headers = {"If-None-Match": etag})
+        assert res.status_code == HTTP_304_NOT_MODIFIED
+        assert res.headers.get("etag") == etag
+        assert not res.content
+
+    async def test_changed_users_change_etag(
+            self,
+            app: FastAPI,
+            db: Database,
+            admin_client: AsyncClient
+            ) -> None:
+        path = app.url_path_for("users:get_all_users")
+        res = await admin_client.get(path)
+        assert res.status_code == HTTP_200_OK
+        etag = res.headers.get("etag")
+        user_repo = UserRepository(db)
+        if not await user_repo.get_user_by_email(email = "etag@email.io"):
+            await user_repo.register_new_user(new_user = UserCreate(
+                email = "etag@email.io",
+                password = "etagpassword"
+            ))
+        await user_repo.update_user_role(update_role_user = UserUpdateRole(
+            email = "etag@email.io",
+            role = "USER"
+        ))
+        res = await admin_client.get(path, headers = {"If-None-Match": etag})
+        assert res.status_code == HTTP_200_OK
+        assert res.headers.get("etag") != etag
+        assert "etag@email.io" in [user["email"] for user in res.json()]
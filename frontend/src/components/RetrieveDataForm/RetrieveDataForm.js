@@ -20,7 +20,7 @@ import { extractErrorMessages } from "../../utils/errors"
 const RetrieveDataFormWrapper = styled.div`
   padding: 2rem;
 `
-function RetrieveDataForm({ occurrenceError, isLoading, requestData, retrieveData, data}) {
+function RetrieveDataForm({ occurrenceError, isLoading, requestData, waitForDownload, retrieveData, data}) {
   const [form, setForm] = React.useState({
     classificationLevel: "",
     classificationName: "",
@@ -101,7 +101,12 @@ function RetrieveDataForm({ occurrenceError, isLoading, requestData, retrieveDat
       location_type: form.locationType
     })
     if(res.success) {
-      const downloadID = res.data?.download_id
+      const job = await waitForDownload({job_id: res.data?.job_id})
+      if(!job.success) {
+        setErrors((errors) => ({ ...errors, form: job.error || "Data export failed, please try again"}))
+        return
+      }
+      const downloadID = job.data?.download_id
       const action = await retrieveData({download_id: downloadID}) 
       if(action.success) {
         addToast({
@@ -291,6 +296,7 @@ export default connect(
   }),
   {
     requestData: occurrenceActions.requestData,
+    waitForDownload: occurrenceActions.waitForDownload,
     retrieveData: occurrenceActions.retrieveData
   }
 )(RetrieveDataForm)
\ No newline at end of file
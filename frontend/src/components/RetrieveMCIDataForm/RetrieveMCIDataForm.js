@@ -20,7 +20,7 @@ import { extractErrorMessages } from "../../utils/errors"
 const RetrieveDataFormWrapper = styled.div`
   padding: 2rem;
 `
-function RetrieveDataForm({ mciError, isLoading, requestData, retrieveData}) {
+function RetrieveDataForm({ mciError, isLoading, requestData, waitForDownload, retrieveData}) {
   const [form, setForm] = React.useState({
     // classificationLevel: "",
     // classificationName: "",
@@ -135,7 +135,12 @@ function RetrieveDataForm({ mciError, isLoading, requestData, retrieveData}) {
       landcover_type: form.landcoverType
     })
     if(res.success) {
-      const downloadID = res.data?.download_id
+      const job = await waitForDownload({job_id: res.data?.job_id})
+      if(!job.success) {
+        setErrors((errors) => ({ ...errors, form: job.error || "Data export failed, please try again"}))
+        return
+      }
+      const downloadID = job.data?.download_id
       const action = await retrieveData({download_id: downloadID}) 
       if(action.success) {
         addToast({
@@ -366,6 +371,7 @@ export default connect(
   }),
   {
     requestData: mciActions.requestData,
+    waitForDownload: mciActions.waitForDownload,
     retrieveData: mciActions.retrieveData
   }
 )(RetrieveDataForm)
\ No newline at end of file
@@ -7,6 +7,11 @@ export const REQUEST_DATA_FAILURE = "@@occurrence/REQUEST_DATA_FAILURE"
 export const FETCH_DATA_BY_ID = "@@occurrence/FETCH_DATA_BY_ID"
 export const FETCH_DATA_BY_ID_SUCCESS = "@@occurrence/FETCH_DATA_BY_ID_SUCCESS"
 export const FETCH_DATA_BY_ID_FAILURE = "@@occurrence/FETCH_DATA_BY_ID_FAILURE"
+export const FETCH_JOB_STATUS = "@@occurrence/FETCH_JOB_STATUS"
+export const FETCH_JOB_STATUS_SUCCESS = "@@occurrence/FETCH_JOB_STATUS_SUCCESS"
+export const FETCH_JOB_STATUS_FAILURE = "@@occurrence/FETCH_JOB_STATUS_FAILURE"
+
+const JOB_POLL_INTERVAL_MS = 1000
 
 export default function occurrenceReducer(state = initialState.occurrences, action={}) {
     switch (action.type) {
@@ -49,6 +54,24 @@ export default function occurrenceReducer(state = initialState.occurrences, acti
                 isLoading: false,
                 error: action.error
             }
+        case FETCH_JOB_STATUS:
+            return{
+                ...state,
+                isLoading: true
+            }
+        case FETCH_JOB_STATUS_SUCCESS:
+            return{
+                ...state,
+                isLoading: action.data?.status === "queued" || action.data?.status === "running",
+                error: null,
+                job: action.data
+            }
+        case FETCH_JOB_STATUS_FAILURE:
+            return{
+                ...state,
+                isLoading: false,
+                error: action.error
+            }
         default:
             return state
     }
@@ -56,7 +79,7 @@ export default function occurrenceReducer(state = initialState.occurrences, acti
 
 export const Actions = {}
 
-Actions.requestData = ({ classification_level, classification_name, year, startDate, endDate, location_name, location_type }) => {
+Actions.requestData = ({ classification_level, classification_name, year, startDate, endDate, location_name, location_type, bbox, geometry }) => {
     return apiClient({
         url: `/occurrence/`,
         method: `POST`,
@@ -66,7 +89,7 @@ Actions.requestData = ({ classification_level, classification_name, year, startD
             FAILURE: REQUEST_DATA_FAILURE,
         },
         options: {
-            data: { classification_level, classification_name, year, startDate, endDate, location_name, location_type },
+            data: { classification_level, classification_name, year, startDate, endDate, location_name, location_type, bbox, geometry },
             params: {},
         }
     })
@@ -86,4 +109,36 @@ Actions.retrieveData = ({ download_id }) => {
             params: {}
         }
     })
-}
\ No newline at end of file
+}
+
+Actions.fetchJobStatus = ({ job_id }) => {
+    return apiClient({
+        url: `/occurrence/jobs/${job_id}`,
+        method: `GET`,
+        types: {
+            REQUEST: FETCH_JOB_STATUS,
+            SUCCESS: FETCH_JOB_STATUS_SUCCESS,
+            FAILURE: FETCH_JOB_STATUS_FAILURE
+        },
+        options: {
+            data: {},
+            params: {}
+        }
+    })
+}
+
+// Polls the export job until it has finished or failed
+Actions.waitForDownload = ({ job_id }) => {
+    return async (dispatch) => {
+        while (true) {
+            const res = await dispatch(Actions.fetchJobStatus({ job_id }))
+            if (!res.success || res.data?.status === "done") {
+                return res
+            }
+            if (res.data?.status === "failed") {
+                return { ...res, success: false, error: res.data?.error }
+            }
+            await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS))
+        }
+    }
+}